@@ -29,9 +29,14 @@ from zope.interface import Attribute, Interface, implements
 import pendrell
 from pendrell import log
 from pendrell.error import (RedirectedResponse, TooManyConnections,
-        UnauthorizedResponse, InsecureAuthentication)
-from pendrell.messages import Request
-from pendrell.requester import Multiplexer, HTTPRequester, HTTPSRequester
+        UnauthorizedResponse, InsecureAuthentication, WebError)
+from pendrell import http2
+from pendrell.eyeballs import HappyEyeballs
+from pendrell.resolver import CachingResolver, SimpleLookup
+from pendrell.sockets import SocketProfile
+from pendrell.messages import HeaderTemplate, Request
+from pendrell.requester import (Multiplexer, HTTPRequester, HTTPSRequester,
+        HTTPUNIXRequester)
 from pendrell.proxy import Proxy, Proxyer
 
 
@@ -70,7 +75,7 @@ def getPage(url, agent=None, **kw):
     return agent.open(url, **kw)
  
 
-def downloadPage(url, downloadTo, **kw):
+def downloadPage(url, downloadTo, sync=False, **kw):
     """Request and download it directyl to disk..
 
     Similar to twisted.web.dowloadPage.
@@ -80,12 +85,20 @@ def downloadPage(url, downloadTo, **kw):
         pathOrStream --
                 A file path (str) or object (file) to which the response will be
                 written.
+    Keyword Arguments:
+        sync --  If True (and downloadTo is a path), the ETag and Last-Modified
+                 validators of the download are stored alongside the file and
+                 sent with subsequent requests, so that the file is left alone
+                 when the server responds 304 Not Modified.  Otherwise, the
+                 file is atomically replaced with the new content.
     Returns:
         A Deferred:
             Callback --  an instance of Response
             Errback --   most likely an instance of WebError
     """
     kw["downloadTo"] = downloadTo
+    if sync:
+        kw["syncDownload"] = True
     return getPage(url, **kw)
 
 
@@ -102,12 +115,25 @@ class Agent(object):
 
     maxConnections = _MAX_TOTAL_CONNECTIONS
     maxConnectionsPerSite = _MAX_CONNECTIONS_PER_SITE
+    maxBulkConnectionsPerSite = 0
+    bulkThreshold = 1024 * 1024
+    expectContinueThreshold = 1024 * 1024
+    compressRequest = False
+    compressRequestThreshold = 1024
+
+    # Content-Types (or their prefixes) that are already compressed.
+    compressedTypes = ("application/gzip", "application/x-gzip",
+            "application/zip", "application/x-bzip2", "application/x-xz",
+            "application/x-7z-compressed", "application/zstd", "audio/",
+            "font/woff", "image/", "video/")
     
     preferredTransferEncodings = ("gzip", "deflate", )
     preferredConnection = "keep-alive"
 
     requestClass = Request
     followRedirect = True
+    pipelineDepth = 0
+    http2 = False
 
 
     def __init__(self, **kw):
@@ -115,15 +141,89 @@ class Agent(object):
         
         Keyword Arguments:
             authenticators -- A list of IAuthenticators [default: []]
+            caCertsFile --  A PEM file of the CA certificates trusted to
+                            issue server certificates.  [default: the
+                            default OpenSSL trust store]
+            bulkThreshold --  Responses of at least this many bytes are
+                              considered bulk transfers; smaller requests are
+                              not queued behind them. [default: 1MB]
+            compressRequest --  "gzip" or "deflate" (or True, for gzip)
+                    to compress request bodies as they are sent.  Bodies
+                    smaller than compressRequestThreshold, and bodies whose
+                    Content-Type is in compressedTypes, are sent as they
+                    are.  When a site answers a compressed body with 415
+                    Unsupported Media Type, the request is sent again
+                    uncompressed, and later bodies sent to the site are not
+                    compressed.  Request(compressRequest=...) overrides
+                    this. [default: False]
+            compressRequestThreshold --  [default: 1KB]
             cookieJar -- [default: cookielib.CookieJar()]
+            dialer --  Makes connections, with the reactor's connectTCP and
+                       connectSSL methods.  A pendrell.eyeballs.HappyEyeballs
+                       races connections to each of a site's addresses, and
+                       remembers which one connected.  Pass the reactor to
+                       connect to the first address only.
+                       [default: a HappyEyeballs using resolver]
+            expectContinueThreshold --
+                    Request bodies of at least this many bytes are sent with
+                    "Expect: 100-continue", and withheld until the server
+                    asks for them, so that a body the server would refuse
+                    (e.g. 401 or 413) is not uploaded.  None disables this;
+                    Request(expectContinue=...) overrides it.
+                    [default: 1MB]
             followRedirect --  [default: True]
+            hostOverrides --  A dict mapping host names to the address (or
+                              list of addresses) to use instead of
+                              resolving them. [default: {}]
+            http2 --  True to negotiate HTTP/2 with https sites (via ALPN,
+                      falling back to HTTP/1.1), or "prior-knowledge" to
+                      also speak HTTP/2 to http sites.  Requires the h2
+                      package. [default: False]
             identifier --  [default: self.identifier]
             maxConnections --  [default: self.maxConnections]
             maxConnectionsPerSite --  [default: self.maxConnectionsPerSite]
+            maxBulkConnectionsPerSite --
+                    If non-zero, the number of each site's connections
+                    set aside for bulk transfers. [default: 0]
+            pipelineDepth --  Number of idempotent requests that may be
+                              sent on a connection while a response is
+                              outstanding.  When all connections to a site
+                              are busy, requests are pipelined onto the
+                              least-loaded connection.  0 disables
+                              pipelining. [default: 0]
+            originHeaders --  A dict mapping origins (e.g.
+                              "https://api.example.com") to dicts of
+                              default headers for their requests.
+                              [default: {}]
             preferredConnection --  [default: "keep-alive"]
             preferredTransferEncodings -- [default: ("gzip", "deflate")]
             requestClass --  [default: Request]
-            resolver --  [default: reactor.resolver]
+            resolver --  A pendrell.resolver.CachingResolver, or an
+                         IResolverSimple (e.g. reactor.resolver) whose
+                         answers are cached. [default: a CachingResolver]
+            socketProfile --  A pendrell.sockets.SocketProfile (or dict of
+                              its options, or the name of one of
+                              pendrell.sockets.PROFILES) applied to each
+                              connection. [default: "default", which
+                              disables Nagle's algorithm]
+            socketProfiles --  A dict mapping origins (e.g.
+                               "https://example.com") to the socket
+                               profiles of their connections. [default: {}]
+            unixSockets --  A dict mapping origins (e.g. "http://api.local")
+                            to the Unix socket paths that serve them.
+                            [default: {}]
+            timeout --  A number of seconds, or a pendrell.timeouts.Timeouts
+                        (or dict) of connect, handshake, firstByte, idle and
+                        total timeouts.  A number times connecting and each
+                        wait for the server.  "adaptive" (or an
+                        AdaptiveTimeouts) learns timeouts per site.
+                        [default: None]
+            tlsContexts --  A pendrell.tls.TLSContextCache, which keeps the
+                            TLS context and session of each https site.
+                            [default: one per Agent]
+            verifyCertificates --  Verify that https servers' certificates
+                                   are trusted and issued for the site.
+                                   [default: True]
         """
         self.secure = kw.pop("secure", False)
         self.identifier = kw.pop("identifier", self.identifier)
@@ -136,6 +236,23 @@ class Agent(object):
             self.maxConnections = int(kw["maxConnections"])
         if "maxConnectionsPerSite" in kw:
             self.maxConnectionsPerSite = int(kw["maxConnectionsPerSite"])
+        if "maxBulkConnectionsPerSite" in kw:
+            self.maxBulkConnectionsPerSite = int(
+                    kw["maxBulkConnectionsPerSite"])
+        if "bulkThreshold" in kw:
+            self.bulkThreshold = kw["bulkThreshold"]
+        if "expectContinueThreshold" in kw:
+            self.expectContinueThreshold = kw["expectContinueThreshold"]
+        if "compressRequest" in kw:
+            self.compressRequest = kw["compressRequest"]
+        if "compressRequestThreshold" in kw:
+            self.compressRequestThreshold = kw["compressRequestThreshold"]
+        if "pipelineDepth" in kw:
+            self.pipelineDepth = int(kw["pipelineDepth"])
+        if "http2" in kw:
+            self.http2 = kw["http2"]
+        if self.http2 and http2.H2Connection is None:
+            raise ImportError("HTTP/2 requires the h2 package")
         if "preferredConnection" in kw:
             self.preferredConnection = kw["preferredConnection"]
         if "preferredTransferEncodings" in kw:
@@ -144,13 +261,39 @@ class Agent(object):
             self.requestClass = kw["requestClass"]
 
         self._timeout = kw.pop("timeout", None)
+        self._tlsContexts = kw.pop("tlsContexts", None)
+        self._verifyCertificates = kw.pop("verifyCertificates", True)
+        self._caCertsFile = kw.pop("caCertsFile", None)
+        self.socketProfile = SocketProfile.fromValue(
+                kw.pop("socketProfile", None))
+        self._socketProfiles = dict((origin, SocketProfile.fromValue(p))
+                for origin, p in kw.pop("socketProfiles", {}).iteritems())
+        self._originHeaders = dict(kw.pop("originHeaders", {}))
+        self._headerTemplate = None
+        self._originHeaderTemplates = dict()
+        self._unixSockets = dict(kw.pop("unixSockets", {}))
+        for origin in self._unixSockets:
+            if not origin.startswith("http://"):
+                raise ValueError("Only http origins may be served over Unix "
+                                 "sockets: %s" % origin)
         self._cookieJar = kw.pop("cookieJar", cookielib.CookieJar())
         self._proxyer = kw.pop("proxyer", Proxyer())
-        self._resolver = kw.pop("resolver", reactor.resolver)
+
+        resolver = kw.pop("resolver", None)
+        if resolver is None:
+            resolver = CachingResolver()
+        elif not hasattr(resolver, "getAddresses"):
+            resolver = CachingResolver(lookup=SimpleLookup(resolver))
+        for host, addresses in kw.pop("hostOverrides", {}).iteritems():
+            resolver.setOverride(host, addresses)
+        self.resolver = resolver
+        self.dialer = kw.pop("dialer", None) or HappyEyeballs(resolver)
+
         self._authorizationCache = dict()
         self._requesterCache = dict()
         self._requesterCacheOrder = []
         self._requestQueue = dict()
+        self._uncompressedOrigins = set()
 
 
     def __str__(self):
@@ -162,6 +305,17 @@ class Agent(object):
     def __del__(self):
         self.cleanup()
 
+
+    @property
+    def tlsContexts(self):
+        """The TLSContextCache shared by this agent's https requesters."""
+        if self._tlsContexts is None:
+            from pendrell.tls import TLSContextCache
+            self._tlsContexts = TLSContextCache(
+                    verify = self._verifyCertificates,
+                    caCertsFile = self._caCertsFile)
+        return self._tlsContexts
+
     @inlineCallbacks
     def open(self, request, authenticator=None, authenticators=None,
             followRedirect=None, proxy=None, _redirectCount=0, _unauthCount=0,
@@ -242,6 +396,24 @@ class Agent(object):
                     **kw)
             self._cacheAuthorization(request, authorization)
 
+        except WebError, we:
+            if we.status != http.UNSUPPORTED_MEDIA_TYPE \
+                    or not request.bodyEncoding \
+                    or not request.bodyReplayable:
+                raise
+
+            log.debug("%s does not accept %s request bodies" % (
+                    self._getRequesterKey(request), request.bodyEncoding))
+            self._uncompressedOrigins.add(self._getRequesterKey(request))
+            response = yield self.open(request.copy(compressRequest=False),
+                    followRedirect = followRedirect,
+                    proxy = proxy,
+                    _redirectCount = _redirectCount,
+                    authenticator = authenticator,
+                    authenticators = authenticators,
+                    _unauthCount = _unauthCount,
+                    **kw)
+
         else:
             response.verifyDigest()
             self.extractCookies(response)
@@ -355,15 +527,19 @@ class Agent(object):
 
         headers = kw.get("headers", dict())
         request.headers.update(headers)
+        request.headerTemplate = self.getHeaderTemplate(request)
 
-        if self.preferredConnection:
-            request.headers.setdefault("Connection", self.preferredConnection)
+        if request.expectContinue is None:
+            # Bodies of unknown length are presumed to be large.
+            length = request.bodyLength
+            request.expectContinue = bool(request.hasBody
+                    and self.expectContinueThreshold is not None
+                    and (length is None
+                         or length >= self.expectContinueThreshold))
 
-        if self.preferredTransferEncodings:
-            request.headers.setdefault("TE",
-                    ",".join(self.preferredTransferEncodings))
-
-        request.headers.setdefault("User-agent", str(self.identifier))
+        encoding = self.getRequestEncoding(request)
+        if encoding:
+            request.encodeBody(encoding)
 
         unredirected = kw.pop("unredirectedHeaders", dict())
         request.unredirectedHeaders.update(unredirected)
@@ -379,20 +555,106 @@ class Agent(object):
     _requesterClasses = {
         "http": HTTPRequester,
         "https": HTTPSRequester,
+        "http+unix": HTTPUNIXRequester,
         }
 
     def _buildRequester(self, request, **kw):
         scheme = request.scheme
 
         kw.setdefault("maxConnections", self.maxConnectionsPerSite)
+        kw.setdefault("pipelineDepth", self.pipelineDepth)
+        kw.setdefault("maxBulkConnections", self.maxBulkConnectionsPerSite)
+        kw.setdefault("bulkThreshold", self.bulkThreshold)
 
         host, port = request.host, request.port
         requesterClass = self._requesterClasses[scheme]
+
+        kw.setdefault("dialer", self.dialer)
+        kw.setdefault("socketProfile", self.getSocketProfile(request))
+        if scheme == "https":
+            kw.setdefault("tlsContexts", self.tlsContexts)
+
+        socketPath = self._unixSockets.get(self._getRequesterKey(request))
+        if socketPath:
+            requesterClass = HTTPUNIXRequester
+            kw.setdefault("socketPath", socketPath)
+
+        elif self._speaksHTTP2(scheme):
+            return http2.HTTP2Requester(scheme, host, port, **kw)
+
         requester = Multiplexer(requesterClass, scheme, host, port, **kw)
 
         return requester
 
 
+    @property
+    def headerTemplate(self):
+        """The default headers of every request, serialized once."""
+        if self._headerTemplate is None:
+            headers = list()
+            if self.preferredConnection:
+                headers.append(("Connection", self.preferredConnection))
+            if self.preferredTransferEncodings:
+                headers.append(("TE",
+                        ",".join(self.preferredTransferEncodings)))
+            headers.append(("User-agent", str(self.identifier)))
+            self._headerTemplate = HeaderTemplate(headers)
+        return self._headerTemplate
+
+
+    def getHeaderTemplate(self, request):
+        """The default headers of requests to request's origin."""
+        key = self._getRequesterKey(request)
+        if key not in self._originHeaders:
+            return self.headerTemplate
+
+        template = self._originHeaderTemplates.get(key)
+        if template is None:
+            template = self._originHeaderTemplates[key] = \
+                    self.headerTemplate.extend(
+                            self._originHeaders[key].iteritems())
+        return template
+
+
+    def getRequestEncoding(self, request):
+        """The Content-Encoding to compress request's body with, or None.
+        """
+        encoding = request.compressRequest
+        if encoding is None:
+            encoding = self.compressRequest
+        if not encoding or not request.hasBody or request.bodyEncoding \
+                or "Content-Encoding" in request.headers \
+                or self._getRequesterKey(request) in self._uncompressedOrigins:
+            return None
+
+        length = request.bodyLength
+        if length is not None and length < self.compressRequestThreshold:
+            return None
+
+        contentType = request.headers.get("Content-Type", "")
+        contentType = contentType.split(";")[0].strip().lower()
+        for compressedType in self.compressedTypes:
+            if contentType == compressedType or (compressedType.endswith("/")
+                    and contentType.startswith(compressedType)):
+                return None
+
+        if encoding is True:
+            encoding = "gzip"
+        return encoding
+
+
+    def getSocketProfile(self, request):
+        """The SocketProfile of connections to request's origin."""
+        return self._socketProfiles.get(self._getRequesterKey(request),
+                self.socketProfile)
+
+
+    def _speaksHTTP2(self, scheme):
+        if scheme == "https":
+            return bool(self.http2)
+        return scheme == "http" and self.http2 == "prior-knowledge"
+
+
 
     def cleanup(self):
         deferreds = list()
@@ -0,0 +1,99 @@
+"""Benchmark of chunked transfer-coding decoding.
+
+A body is chunked a few ways and fed to the decoder in socket-sized reads;
+the buffering decoder that preceded ChunkingIncrementalDecoder is timed
+alongside it:
+
+    python -m pendrell.cases.bench_chunked [-s body MB] [-r read KB]
+"""
+
+import sys, time
+from optparse import OptionParser
+
+from pendrell.decoders import ChunkingIncrementalDecoder
+from pendrell.util import CRLF
+
+
+LAYOUTS = [
+    ("one chunk", None),
+    ("64KB chunks", 64*1024),
+    ("4KB chunks", 4*1024),
+    ("100B chunks", 100),
+    ]
+
+
+
+class BufferingChunkDecoder(object):
+    """The previous decoder: reads are appended to a buffer, and a chunk is
+    only returned once it has all arrived.
+    """
+
+    def __init__(self):
+        self._buffer = str()
+        self.finished = False
+
+    def decode(self, raw):
+        self._buffer += raw
+        content = str()
+        while not self.finished:
+            hexLen, crlf, rest = self._buffer.partition(CRLF)
+            if not (hexLen and crlf):
+                break
+            length = int(hexLen, 16)
+            if len(rest) < length + len(CRLF):
+                break
+            content += rest[:length]
+            self._buffer = rest[length+len(CRLF):]
+            self.finished = (length == 0)
+        return content
+
+
+
+def chunk(body, size):
+    size = size or len(body)
+    chunks = ["%x%s%s%s" % (len(body[i:i+size]), CRLF, body[i:i+size], CRLF)
+            for i in xrange(0, len(body), size)]
+    chunks.append("0" + CRLF + CRLF)
+    return "".join(chunks)
+
+
+def timeDecoder(decoderClass, encoded, readSize, bodySize):
+    reads = [encoded[i:i+readSize]
+            for i in xrange(0, len(encoded), readSize)]
+    decoder = decoderClass()
+    decoded = 0
+    start = time.time()
+    for data in reads:
+        decoded += len(decoder.decode(data))
+    elapsed = time.time() - start
+    assert decoder.finished and decoded == bodySize, (decoded, bodySize)
+    return elapsed
+
+
+def run(options):
+    bodySize = options.bodyMB * 1024 * 1024
+    body = "x" * bodySize
+    readSize = options.readKB * 1024
+
+    print "%-14s %16s %16s" % ("layout", "buffering MB/s", "streaming MB/s")
+    for name, size in LAYOUTS:
+        encoded = chunk(body, size)
+        rates = [options.bodyMB / timeDecoder(decoderClass, encoded,
+                        readSize, bodySize)
+                for decoderClass in (BufferingChunkDecoder,
+                                     ChunkingIncrementalDecoder)]
+        print "%-14s %16.1f %16.1f" % ((name,) + tuple(rates))
+
+
+def main(args=sys.argv[1:]):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-s", dest="bodyMB", type="int", default=16,
+            help="Size of the body, in MB [default: %default]")
+    parser.add_option("-r", dest="readKB", type="int", default=64,
+            help="Size of each read, in KB [default: %default]")
+    options, args = parser.parse_args(args)
+    run(options)
+
+
+if __name__ == "__main__":
+    main()
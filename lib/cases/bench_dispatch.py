@@ -0,0 +1,92 @@
+"""Loopback benchmark of request dispatch.
+
+Small requests are issued one after another (the latency each adds) and many
+at once (throughput), against a server that answers from memory:
+
+    python -m pendrell.cases.bench_dispatch [-n requests] [-c concurrency]
+"""
+
+import sys, time
+from optparse import OptionParser
+
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
+from twisted.internet.protocol import Factory, Protocol
+
+from pendrell.agent import Agent
+
+
+_RESPONSE = "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+
+class _FastServer(Protocol):
+    """Answers each request without parsing more than its end."""
+
+    def connectionMade(self):
+        self._buffer = ""
+
+    def dataReceived(self, data):
+        self._buffer += data
+        count = self._buffer.count("\r\n\r\n")
+        if count:
+            self._buffer = self._buffer[self._buffer.rfind("\r\n\r\n") + 4:]
+            self.transport.write(_RESPONSE * count)
+
+
+
+@inlineCallbacks
+def timeSequential(agent, url, count):
+    start = time.time()
+    for i in xrange(count):
+        yield agent.open(url)
+    returnValue(time.time() - start)
+
+
+@inlineCallbacks
+def timeConcurrent(agent, url, count):
+    start = time.time()
+    yield gatherResults([agent.open(url) for i in xrange(count)])
+    returnValue(time.time() - start)
+
+
+@inlineCallbacks
+def run(options):
+    factory = Factory()
+    factory.protocol = _FastServer
+    listener = reactor.listenTCP(0, factory, interface="127.0.0.1")
+    url = "http://127.0.0.1:%d/" % listener.getHost().port
+
+    agent = Agent(maxConnectionsPerSite=options.concurrency,
+            pipelineDepth=options.pipelineDepth)
+    try:
+        yield timeSequential(agent, url, 100)  # Warm up
+
+        sequential = yield timeSequential(agent, url, options.count)
+        concurrent = yield timeConcurrent(agent, url, options.count)
+        print "sequential: %8.1f requests/s  %7.1f us/request" % (
+                options.count / sequential, 1e6 * sequential / options.count)
+        print "concurrent: %8.1f requests/s  (%d connections, depth %d)" % (
+                options.count / concurrent, options.concurrency,
+                options.pipelineDepth)
+    finally:
+        yield agent.cleanup()
+        yield listener.stopListening()
+        reactor.stop()
+
+
+def main(args=sys.argv[1:]):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", dest="count", type="int", default=5000,
+            help="Requests per test [default: %default]")
+    parser.add_option("-c", dest="concurrency", type="int", default=4,
+            help="Connections for concurrent requests [default: %default]")
+    parser.add_option("-d", dest="pipelineDepth", type="int", default=0,
+            help="Pipeline depth [default: %default]")
+    options, args = parser.parse_args(args)
+
+    reactor.callWhenRunning(run, options)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Loopback benchmark of socket profiles.
+
+Each profile (and each option on its own) is timed issuing small requests
+one after another, pipelining them, and downloading a large response:
+
+    python -m pendrell.cases.bench_sockets [-n requests] [-s bulk MB]
+"""
+
+import sys, time
+from optparse import OptionParser
+
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
+from twisted.web import server
+from twisted.web.resource import Resource
+
+from pendrell.agent import Agent
+from pendrell.sockets import PROFILES, SocketProfile
+
+
+PROFILES_TIMED = [
+    ("system (Nagle on)", PROFILES["system"]),
+    ("noDelay", PROFILES["default"]),
+    ("noDelay+quickAck", PROFILES["latency"]),
+    ("noDelay+buffers", PROFILES["bulk"]),
+    ("noDelay+keepAlive", PROFILES["keepalive"]),
+    ("noDelay+fastOpen", SocketProfile(noDelay=True, fastOpen=True)),
+    ]
+
+
+
+class _BenchResource(Resource):
+    isLeaf = True
+
+    def __init__(self, bulkSize):
+        Resource.__init__(self)
+        self.bulk = "x" * bulkSize
+
+    def render(self, request):
+        if request.path == "/bulk":
+            return self.bulk
+        return request.content.read() or "ok"
+
+
+
+@inlineCallbacks
+def timeProfile(port, profile, count):
+    url = "http://127.0.0.1:%d" % port
+    agent = Agent(socketProfile=profile, pipelineDepth=count,
+            maxConnectionsPerSite=1)
+    yield agent.open(url + "/warm")
+
+    start = time.time()
+    for i in xrange(count):
+        yield agent.open(url + "/small", method="POST", data="b" * 256)
+    sequential = time.time() - start
+
+    start = time.time()
+    yield gatherResults([agent.open(url + "/small") for i in xrange(count)])
+    pipelined = time.time() - start
+
+    start = time.time()
+    yield agent.open(url + "/bulk")
+    bulk = time.time() - start
+
+    yield agent.cleanup()
+    returnValue((sequential, pipelined, bulk))
+
+
+@inlineCallbacks
+def run(options):
+    site = server.Site(_BenchResource(options.bulkMB * 1024 * 1024))
+    listener = reactor.listenTCP(0, site, interface="127.0.0.1")
+    port = listener.getHost().port
+
+    print "%-20s %14s %14s %12s" % ("profile", "sequential ms",
+            "pipelined ms", "bulk MB/s")
+    try:
+        for name, profile in PROFILES_TIMED:
+            sequential, pipelined, bulk = yield timeProfile(port, profile,
+                    options.count)
+            print "%-20s %14.3f %14.3f %12.1f" % (name,
+                    1000 * sequential / options.count,
+                    1000 * pipelined / options.count,
+                    options.bulkMB / bulk)
+    finally:
+        yield listener.stopListening()
+        reactor.stop()
+
+
+def main(args=sys.argv[1:]):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", dest="count", type="int", default=200,
+            help="Small requests per profile [default: %default]")
+    parser.add_option("-s", dest="bulkMB", type="int", default=64,
+            help="Size of the bulk response, in MB [default: %default]")
+    options, args = parser.parse_args(args)
+
+    reactor.callWhenRunning(run, options)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
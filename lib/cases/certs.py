@@ -0,0 +1,71 @@
+"""Certificates and TLS contexts for test servers."""
+
+from twisted.internet import ssl
+
+from OpenSSL import SSL, crypto
+
+
+
+def buildCertificate(commonName="localhost",
+                     altNames="DNS:localhost, IP:127.0.0.1"):
+    """A self-signed certificate and its key, for test servers."""
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.get_subject().CN = commonName
+    extensions = [crypto.X509Extension("basicConstraints", True, "CA:TRUE")]
+    if altNames:
+        extensions.append(crypto.X509Extension(
+                "subjectAltName", False, altNames))
+    cert.add_extensions(extensions)
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, "sha256")
+    return cert, key
+
+
+
+class ServerContextFactory(ssl.ContextFactory):
+    """Serves a certificate, optionally negotiating protocols with ALPN.
+
+    Clients may resume sessions, unless resumable is False.
+    """
+
+    def __init__(self, cert, key, alpnProtocols=None, resumable=True):
+        self.cert, self.key = cert, key
+        self.alpnProtocols = alpnProtocols
+        self.resumable = resumable
+        self._context = None
+
+
+    def getContext(self):
+        # One context, so that its session cache and ticket keys are shared.
+        if self._context is None:
+            ctx = SSL.Context(SSL.SSLv23_METHOD)
+            ctx.use_certificate(self.cert)
+            ctx.use_privatekey(self.key)
+            if self.resumable:
+                ctx.set_session_id("pendrell-tests")
+            else:
+                ctx.set_session_cache_mode(SSL.SESS_CACHE_OFF)
+                ctx.set_options(SSL.OP_NO_TICKET)
+            if self.alpnProtocols:
+                ctx.set_alpn_select_callback(self._selectProtocol)
+            self._context = ctx
+        return self._context
+
+
+    def _selectProtocol(self, connection, offered):
+        for proto in self.alpnProtocols:
+            if proto in offered:
+                return proto
+        return SSL.NO_OVERLAPPING_PROTOCOLS
+
+
+
+__id__ = "$Id: $"[5:-2]
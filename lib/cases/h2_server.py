@@ -0,0 +1,117 @@
+"""A minimal HTTP/2 server for tests.
+
+Serves:
+    /big -- 256KB, more than the default flow-control window
+    /echo -- The request body
+    /status/<code> -- An empty response with the given status
+    anything else -- The request path
+"""
+
+from twisted.internet import protocol, reactor
+
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2 import events as h2Events
+
+
+
+class H2ServerProtocol(protocol.Protocol):
+
+    def connectionMade(self):
+        self.factory.connectionCount += 1
+        self._h2 = H2Connection(H2Configuration(client_side=False))
+        self._h2.initiate_connection()
+        self._requests = dict()  # Stream ID => (headers, body)
+        self._outbound = dict()  # Stream ID => unsent response body
+        self._flush()
+
+
+    def _flush(self):
+        self.transport.write(self._h2.data_to_send())
+
+
+    def dataReceived(self, data):
+        for event in self._h2.receive_data(data):
+            if isinstance(event, h2Events.RequestReceived):
+                self._requests[event.stream_id] = (dict(event.headers), "")
+                self.factory.streamOpened()
+
+            elif isinstance(event, h2Events.DataReceived):
+                headers, body = self._requests[event.stream_id]
+                self._requests[event.stream_id] = (headers, body + event.data)
+                self._h2.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id)
+
+            elif isinstance(event, h2Events.StreamEnded):
+                reactor.callLater(self.factory.delay,
+                        self._respond, event.stream_id)
+
+            elif isinstance(event, h2Events.WindowUpdated):
+                for streamId in self._outbound.keys():
+                    self._send(streamId)
+
+        self._flush()
+
+
+    def _respond(self, streamId):
+        headers, body = self._requests.pop(streamId)
+        self.factory.requests.append(headers)
+        self.factory.streamClosed()
+
+        path = headers[":path"]
+        status = 200
+        if path == "/big":
+            body = "x" * (256 * 1024)
+        elif path.startswith("/status/"):
+            status, body = int(path.split("/")[-1]), ""
+        elif path != "/echo":
+            body = path
+
+        self._h2.send_headers(streamId, [
+                (":status", str(status)),
+                ("content-length", str(len(body))),
+                ("x-protocol", "h2"),
+                ], end_stream=not body)
+        if body:
+            self._outbound[streamId] = body
+            self._send(streamId)
+        self._flush()
+
+
+    def _send(self, streamId):
+        body = self._outbound.pop(streamId)
+        while body:
+            size = min(len(body), self._h2.max_outbound_frame_size,
+                    self._h2.local_flow_control_window(streamId))
+            if size <= 0:
+                self._outbound[streamId] = body
+                break
+            chunk, body = body[:size], body[size:]
+            self._h2.send_data(streamId, chunk, end_stream=not body)
+
+
+
+class H2ServerFactory(protocol.ServerFactory):
+
+    protocol = H2ServerProtocol
+
+    def __init__(self, delay=0):
+        self.delay = delay  # Before responding, so that streams overlap
+        self.connectionCount = 0
+        self.requests = list()
+        self.concurrentStreams = 0
+        self.maxConcurrentStreams = 0
+
+
+    def streamOpened(self):
+        self.concurrentStreams += 1
+        self.maxConcurrentStreams = max(self.maxConcurrentStreams,
+                self.concurrentStreams)
+
+
+    def streamClosed(self):
+        self.concurrentStreams -= 1
+
+
+
+__id__ = "$Id: $"[5:-2]
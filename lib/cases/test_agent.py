@@ -1,7 +1,8 @@
 # TODO
 # - test cookies
 
-import os, random
+import os, random, shutil, socket, tempfile, urllib
+from select import select
 from hashlib import md5
 
 from twisted.cred import portal
@@ -9,11 +10,13 @@ from twisted.cred.error import LoginFailed, UnauthorizedLogin
 from twisted.cred.checkers import ICredentialsChecker
 from twisted.internet import error as netErr, protocol, reactor
 from twisted.internet.defer import (
-        Deferred, gatherResults,
+        Deferred, DeferredList, gatherResults,
         inlineCallbacks, returnValue,
         setDebugging as setDeferredDebugging)
+from twisted.internet.task import deferLater
 from twisted.python import failure
 from twisted.trial import unittest
+from twisted.web import http, server
 from twisted.web.http import HTTPFactory
 from twisted.web.guard import HTTPAuthSessionWrapper
 from twisted.web.iweb import ICredentialFactory
@@ -24,6 +27,7 @@ from zope.interface import Interface, Attribute, implements
 from pendrell import agent as pendrell, auth, error, log, messages
 from pendrell.cases.http_server import Site
 from pendrell.cases.util import PendrellTestMixin, trialIsOnline
+from pendrell.protocols import HTTPProtocol
 
 setDeferredDebugging(True)
 
@@ -114,6 +118,545 @@ class DownloadTest(AgentTest):
         return d
 
 
+class SyncDownloadTest(PendrellTestMixin, unittest.TestCase):
+    """Test conditional (synced) downloads against a local server."""
+
+    timeout = 5
+    _port = 8057
+
+    class Resource(Resource):
+
+        isLeaf = True
+
+        def __init__(self):
+            Resource.__init__(self)
+            self.content = "Me encanta los tacos!\n"
+            self.etag = '"tacos"'
+            self.renderCount = 0
+
+        def render_GET(self, request):
+            if request.setETag(self.etag) is http.CACHED:
+                return ""
+            self.renderCount += 1
+            return self.content
+
+
+    def setUp(self):
+        from tempfile import mkdtemp
+        PendrellTestMixin.setUp(self)
+        self.resource = self.Resource()
+        self.server = reactor.listenTCP(self._port, Site(self.resource),
+                interface="127.0.0.1")
+        self.tempDir = mkdtemp()
+        self.path = os.path.join(self.tempDir, "tacos.txt")
+        self.url = "http://127.0.0.1:%d/" % self._port
+
+
+    @inlineCallbacks
+    def tearDown(self):
+        from shutil import rmtree
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+        rmtree(self.tempDir)
+
+
+    def download(self):
+        return pendrell.downloadPage(self.url, self.path, sync=True,
+                agent=self.agent)
+
+
+    @inlineCallbacks
+    def test_syncUnchanged(self):
+        response = yield self.download()
+        self.assertEquals(200, response.status)
+        self.assertEquals(self.resource.content, open(self.path).read())
+        self.assertTrue(os.path.exists(
+                messages.Validators.pathFor(self.path)))
+
+        mtime = os.stat(self.path).st_mtime
+        response = yield self.download()
+        self.assertEquals(304, response.status)
+        self.assertEquals(1, self.resource.renderCount)
+        self.assertEquals(mtime, os.stat(self.path).st_mtime)
+        self.assertEquals(self.resource.content, open(self.path).read())
+        # No temporary files are left behind.
+        self.assertEquals(["tacos.txt", "tacos.txt.validators"],
+                sorted(os.listdir(self.tempDir)))
+
+
+    @inlineCallbacks
+    def test_syncChanged(self):
+        yield self.download()
+
+        self.resource.content = "Me encantan los burritos!\n"
+        self.resource.etag = '"burritos"'
+        response = yield self.download()
+        self.assertEquals(200, response.status)
+        self.assertEquals(2, self.resource.renderCount)
+        self.assertEquals(self.resource.content, open(self.path).read())
+
+        validators = messages.Validators.load(self.path)
+        self.assertEquals('"burritos"', validators.etag)
+
+
+    @inlineCallbacks
+    def test_syncMode(self):
+        umask = os.umask(022)
+        try:
+            yield self.download()
+        finally:
+            os.umask(umask)
+        for path in (self.path, messages.Validators.pathFor(self.path)):
+            self.assertEquals(0644, os.stat(path).st_mode & 0777)
+
+        # A changed file keeps its mode.
+        os.chmod(self.path, 0640)
+        self.resource.content = "Me encantan los burritos!\n"
+        self.resource.etag = '"burritos"'
+        yield self.download()
+        self.assertEquals(0640, os.stat(self.path).st_mode & 0777)
+
+
+    @inlineCallbacks
+    def test_syncMissingFile(self):
+        yield self.download()
+        os.unlink(self.path)
+
+        response = yield self.download()
+        self.assertEquals(200, response.status)
+        self.assertEquals(2, self.resource.renderCount)
+        self.assertEquals(self.resource.content, open(self.path).read())
+
+
+    @inlineCallbacks
+    def test_syncTruncated(self):
+        yield self.download()
+
+        factory = protocol.Factory()
+        factory.protocol = _TruncatingServer
+        truncating = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.addCleanup(truncating.stopListening)
+        self.url = "http://127.0.0.1:%d/" % truncating.getHost().port
+
+        yield self.assertFailure(self.download(), error.IncompleteResponse)
+        self.assertEquals(self.resource.content, open(self.path).read())
+        self.assertEquals('"tacos"',
+                messages.Validators.load(self.path).etag)
+        self.assertEquals(["tacos.txt", "tacos.txt.validators"],
+                sorted(os.listdir(self.tempDir)))
+
+
+
+class _TruncatingServer(protocol.Protocol):
+    """Sends 10 of a body's 100 bytes, and then closes the connection."""
+
+    def dataReceived(self, data):
+        if "\r\n\r\n" in data:
+            self.transport.write("HTTP/1.1 200 OK\r\nETag: \"partial\"\r\n"
+                    "Content-Length: 100\r\n\r\n0123456789")
+            self.transport.loseConnection()
+
+
+
+class _OneResponseRequest(server.Request):
+    """Drops the connection after answering the first request on it."""
+
+    def process(self):
+        if getattr(self.channel, "answered", False):
+            return
+        self.channel.answered = True
+        self.channel.site.connectionCount += 1
+        server.Request.process(self)
+
+    def finish(self):
+        transport = self.channel.transport
+        server.Request.finish(self)
+        transport.loseConnection()
+
+
+class _OneResponseSite(server.Site):
+
+    requestFactory = _OneResponseRequest
+    connectionCount = 0
+
+    class Resource(Resource):
+        isLeaf = True
+
+        def render(self, request):
+            return request.path
+
+    def __init__(self):
+        server.Site.__init__(self, self.Resource())
+
+
+class PipelineReplayTest(PendrellTestMixin, unittest.TestCase):
+    """Unanswered pipelined requests are replayed on a new connection."""
+
+    timeout = 5
+    _port = 9799
+
+    def setUp(self):
+        self.agent = pendrell.Agent(pipelineDepth=2, maxConnectionsPerSite=1)
+        self.factory = _OneResponseSite()
+        self.server = reactor.listenTCP(self._port, self.factory,
+                interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    @inlineCallbacks
+    def test_replay(self):
+        url = "http://127.0.0.1:%d/" % self._port
+        responses = yield gatherResults([self.getPage(url + path)
+                for path in ("a", "b", "c")])
+
+        self.assertEquals(["/a", "/b", "/c"], [r.content for r in responses])
+        self.assertEquals(3, self.factory.connectionCount)
+
+
+    @inlineCallbacks
+    def test_noReplayNonIdempotent(self):
+        url = "http://127.0.0.1:%d/" % self._port
+        results = yield DeferredList([
+                self.getPage(url + "a"),
+                self.getPage(url + "b", method="POST", data="b"),
+                self.getPage(url + "c"),
+                ], consumeErrors=True)
+
+        self.assertEquals([True, True, True], [s for s, r in results])
+        self.assertEquals(["/a", "/b", "/c"],
+                [r.content for s, r in results])
+
+
+
+class _KeepAliveChannel(http.HTTPChannel):
+
+    served = 0
+
+    def connectionMade(self):
+        http.HTTPChannel.connectionMade(self)
+        self.site.connectionCount += 1
+        self.site.channels.append(self)
+
+    def connectionLost(self, reason):
+        http.HTTPChannel.connectionLost(self, reason)
+        self.site.closedCount += 1
+
+
+class _KeepAliveRequest(server.Request):
+    """Advertises Keep-Alive parameters and enforces the request limit."""
+
+    def process(self):
+        channel, site = self.channel, self.channel.site
+        channel.served += 1
+        remaining = site.maxRequests - channel.served
+        self.setHeader("Keep-Alive",
+                "timeout=%d, max=%d" % (site.keepAliveTimeout, remaining))
+        if site.closeEach:
+            self.setHeader("Connection", "close")
+        server.Request.process(self)
+
+    def finish(self):
+        channel, site = self.channel, self.channel.site
+        transport = channel.transport
+        server.Request.finish(self)
+        if site.closeEach or channel.served >= site.maxRequests:
+            transport.loseConnection()
+
+
+class _KeepAliveSite(_OneResponseSite):
+
+    protocol = _KeepAliveChannel
+    requestFactory = _KeepAliveRequest
+
+    def __init__(self, keepAliveTimeout=30, maxRequests=100, closeEach=False):
+        _OneResponseSite.__init__(self)
+        self.keepAliveTimeout = keepAliveTimeout
+        self.maxRequests = maxRequests
+        self.closeEach = closeEach
+        self.closedCount = 0
+        self.channels = list()
+
+
+class KeepAliveTest(PendrellTestMixin, unittest.TestCase):
+    """Connections are retired before the server closes them."""
+
+    timeout = 5
+    _port = 9797
+
+    def listen(self, **kw):
+        self.site = _KeepAliveSite(**kw)
+        self.server = reactor.listenTCP(self._port, self.site,
+                interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    @inlineCallbacks
+    def getPaths(self, *paths):
+        url = "http://127.0.0.1:%d/" % self._port
+        responses = list()
+        for path in paths:
+            response = yield self.getPage(url + path)
+            responses.append(response)
+        self.assertEquals(["/%s" % p for p in paths],
+                [r.content for r in responses])
+        self.assertEquals([0] * len(paths),
+                [r.request.replayCount for r in responses])
+        returnValue(responses)
+
+
+    @inlineCallbacks
+    def test_connectionClose(self):
+        self.listen(closeEach=True)
+        yield self.getPaths("a", "b", "c")
+        self.assertEquals(3, self.site.connectionCount)
+
+
+    @inlineCallbacks
+    def test_maxRequests(self):
+        self.listen(maxRequests=2)
+        yield self.getPaths("a", "b", "c", "d", "e")
+        self.assertEquals(3, self.site.connectionCount)
+
+
+    @inlineCallbacks
+    def test_idleTimeout(self):
+        self.listen(keepAliveTimeout=2)
+        yield self.getPaths("a")
+        self.assertEquals(0, self.site.closedCount)
+
+        # Retired keepAliveMargin (1s) before the server's 2s timeout.
+        yield deferLater(reactor, 1.5, lambda: None)
+        self.assertEquals(1, self.site.closedCount)
+
+        yield self.getPaths("b")
+        self.assertEquals(2, self.site.connectionCount)
+
+
+    @inlineCallbacks
+    def test_timeoutSparesIdleConnection(self):
+        self.agent = pendrell.Agent(timeout=0.5)
+        self.listen()
+        yield self.getPaths("a")
+        yield deferLater(reactor, 1, lambda: None)
+        yield self.getPaths("b")
+        self.assertEquals(1, self.site.connectionCount)
+
+
+    @inlineCallbacks
+    def test_adaptiveTimeout(self):
+        self.agent = pendrell.Agent(timeout="adaptive")
+        self.listen()
+        yield self.getPaths("a", "b", "c", "d", "e")
+
+        multiplexer, = self.agent._requesterCache.values()
+        timeouts = multiplexer.timeouts
+        self.assertEquals(5, len(timeouts._firstByteTimes))
+        # A local server is fast, so the floor applies.
+        self.assertEquals(timeouts.floor, timeouts.firstByte)
+
+
+    @inlineCallbacks
+    def test_staleConnection(self):
+        self.listen()
+        yield self.getPaths("a")
+        yield deferLater(reactor, 0.5, lambda: None)
+
+        multiplexer, = self.agent._requesterCache.values()
+        requester, = multiplexer._requesters
+        protocol = requester._currentProtocol
+        self.assertFalse(protocol._isStale())
+
+        # The server closes the connection before the reactor notices.
+        channel, = self.site.channels
+        channel.transport.socket.shutdown(socket.SHUT_RDWR)
+        select([protocol.transport.getHandle()], [], [], 1)
+        self.assertTrue(protocol._isStale())
+
+        yield self.getPaths("b")
+        self.assertEquals(2, self.site.connectionCount)
+
+
+
+class _HostSite(_KeepAliveSite):
+
+    class Resource(Resource):
+        isLeaf = True
+
+        def render(self, request):
+            return "%s %s" % (request.getHeader("host"), request.path)
+
+
+class UnixSocketTest(PendrellTestMixin, unittest.TestCase):
+    """Requests are sent over Unix sockets."""
+
+    timeout = 5
+
+    def setUp(self):
+        self.socketDir = tempfile.mkdtemp()
+        self.socketPath = os.path.join(self.socketDir, "http.sock")
+        self.agent = pendrell.Agent(
+                unixSockets={"http://api.local": self.socketPath})
+        self.site = _HostSite()
+        self.server = reactor.listenUNIX(self.socketPath, self.site)
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+        shutil.rmtree(self.socketDir)
+
+
+    @inlineCallbacks
+    def test_unixScheme(self):
+        url = "http+unix://%s/a" % urllib.quote(self.socketPath, safe="")
+        for i in xrange(2):
+            response = yield self.getPage(url)
+            self.assertEquals("localhost /a", response.content)
+        self.assertEquals(1, self.site.connectionCount)
+
+
+    @inlineCallbacks
+    def test_originOverride(self):
+        response = yield self.getPage("http://api.local/b")
+        self.assertEquals("api.local /b", response.content)
+
+
+    def test_httpsOverride(self):
+        self.assertRaises(ValueError, pendrell.Agent,
+                unixSockets={"https://api.local": self.socketPath})
+
+
+
+class _ExpectChannel(http.HTTPChannel):
+    """Answers "Expect: 100-continue" as its site is told to: "continue",
+    a final status withheld body, or nothing at all.  "early-hints" sends an
+    interim 103 before any response.
+    """
+
+    refused = False
+
+    def allHeadersReceived(self):
+        request = self.requests[-1]
+        expect = request.requestHeaders.getRawHeaders("expect")
+        self.site.expectations.append(expect and expect[0])
+
+        answer = self.site.answer
+        if answer == "early-hints":
+            self.transport.write("HTTP/1.1 103 Early Hints\r\n"
+                                 "Link: </style.css>; rel=preload\r\n\r\n")
+        elif expect and answer == "continue":
+            self.transport.write("HTTP/1.1 100 Continue\r\n\r\n")
+        elif expect and answer is not None:
+            self.transport.write("HTTP/1.1 %d Refused\r\n"
+                                 "Content-Length: 0\r\n\r\n" % answer)
+            self.refused = True
+        http.HTTPChannel.allHeadersReceived(self)
+
+    def rawDataReceived(self, data):
+        self.site.bodyBytes += len(data)
+        if not self.refused:
+            http.HTTPChannel.rawDataReceived(self, data)
+
+
+class _ExpectSite(server.Site):
+
+    protocol = _ExpectChannel
+
+    class Resource(Resource):
+        isLeaf = True
+
+        def render(self, request):
+            return str(len(request.content.read()))
+
+    def __init__(self, answer):
+        server.Site.__init__(self, self.Resource())
+        self.answer = answer
+        self.expectations = list()
+        self.bodyBytes = 0
+
+
+class ExpectContinueTest(PendrellTestMixin, unittest.TestCase):
+    """Large bodies are withheld until the server asks for them."""
+
+    timeout = 5
+    _port = 9790
+    body = "x" * 1024
+
+    def setUp(self):
+        self.agent = pendrell.Agent(expectContinueThreshold=len(self.body))
+        self.server = None
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    def post(self, answer, body=body):
+        self.site = _ExpectSite(answer)
+        self.server = reactor.listenTCP(self._port, self.site,
+                interface="127.0.0.1")
+        return self.getPage("http://127.0.0.1:%d/" % self._port,
+                method="POST", data=body)
+
+
+    @inlineCallbacks
+    def test_continue(self):
+        response = yield self.post("continue")
+        self.assertEquals("1024", response.content)
+        self.assertEquals(["100-continue"], self.site.expectations)
+
+
+    @inlineCallbacks
+    def test_refused(self):
+        try:
+            yield self.post(http.REQUEST_ENTITY_TOO_LARGE)
+        except error.WebError, we:
+            self.assertEquals(http.REQUEST_ENTITY_TOO_LARGE, we.status)
+        else:
+            self.fail("Not refused")
+        self.assertEquals(0, self.site.bodyBytes)
+
+
+    @inlineCallbacks
+    def test_expectationFailed(self):
+        response = yield self.post(http.EXPECTATION_FAILED)
+        self.assertEquals("1024", response.content)
+        self.assertEquals(["100-continue", None], self.site.expectations)
+
+
+    @inlineCallbacks
+    def test_continueTimeout(self):
+        self.patch(HTTPProtocol, "continueTimeout", 0.1)
+        response = yield self.post(None)
+        self.assertEquals("1024", response.content)
+        self.assertEquals(["100-continue"], self.site.expectations)
+
+
+    @inlineCallbacks
+    def test_belowThreshold(self):
+        response = yield self.post("continue", body="x")
+        self.assertEquals("1", response.content)
+        self.assertEquals([None], self.site.expectations)
+
+
+    @inlineCallbacks
+    def test_interimResponse(self):
+        response = yield self.post("early-hints", body="x")
+        self.assertEquals("1", response.content)
+        self.assertEquals(200, response.status)
+        self.assertFalse("link" in response.headers)
+
+
+
 class _TimeoutProtocol(protocol.Protocol):
     def dataReceived(self, data):
         self.transport.write("200")
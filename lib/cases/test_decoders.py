@@ -3,7 +3,9 @@ from twisted.web import http
 
 from pendrell import log
 
-from pendrell.decoders import ChunkingIncrementalDecoder
+from pendrell.decoders import (ChunkingIncrementalDecoder, DecodePipeline,
+        GzipIncrementalDecoder, getIncrementalDecoder)
+from pendrell.error import MalformedResponse
 from pendrell.util import b64random, normalizeBytes
 
 
@@ -60,3 +62,61 @@ class ChunkingIncrementalDecoderTest(TestCase):
         self.assertEquals(chunk, extra)
 
 
+
+
+    def test_partialChunk(self):
+        original = b64random(normalizeBytes(8, "KB"))
+        chunk = str().join(http.toChunk(original))
+
+        # Data is returned before the rest of its chunk arrives.
+        self.assertEquals(original[:1000],
+                self.chunker.decode(chunk[:chunk.index("\r\n") + 2 + 1000]))
+        self.assertEquals(1, self.chunker._chunkCount)
+        self.assertEquals("", self.chunker._line)
+        self.assertFalse(self.chunker.finished)
+
+
+    def test_extensionsAndTrailers(self):
+        data = ("5;name=value\r\nhello\r\n6 ; x\r\n world\r\n0;last\r\n"
+                "X-Checksum: abc\r\nX-Other:1\r\n\r\nHTTP/1.1")
+        self.assertEquals("hello world", self.chunker.decode(data))
+        self.assertTrue(self.chunker.finished)
+        self.assertEquals("HTTP/1.1", self.chunker.getExtra())
+
+        self.chunker.reset()
+        decoded = ""
+        for char in data[:-len("HTTP/1.1")]:
+            decoded += self.chunker.decode(char)
+        self.assertEquals("hello world", decoded)
+        self.assertTrue(self.chunker.finished)
+        self.assertEquals([("X-Checksum", "abc"), ("X-Other", "1")],
+                self.chunker.trailers)
+
+
+    def test_malformed(self):
+        for data in ("zz\r\n", "-1\r\n", "\r\n", "2\r\nabc\r\n",
+                     "0\r\nno colon\r\n"):
+            self.chunker.reset()
+            self.assertRaises(MalformedResponse, self.chunker.decode, data)
+
+
+    def test_lineTooLong(self):
+        self.chunker.maxLineSize = 16
+        self.assertRaises(MalformedResponse, self.chunker.decode, "1" * 17)
+
+
+
+class DecodePipelineTest(TestCase):
+
+    def test_identity(self):
+        pipeline = DecodePipeline()
+        self.assertTrue(pipeline.identity)
+        data = b64random(64)
+        self.assertIdentical(data, pipeline.decode(data))
+
+
+    def test_decoders(self):
+        self.assertIdentical(None, getIncrementalDecoder("identity"))
+        self.assertIdentical(None, getIncrementalDecoder("bogus"))
+        self.assertIdentical(GzipIncrementalDecoder,
+                getIncrementalDecoder(" GZIP"))
@@ -0,0 +1,202 @@
+import socket
+
+from twisted.internet import error as netErr, protocol, reactor
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import Clock
+from twisted.python import failure
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.resource import Resource
+
+from pendrell import agent as pendrell
+from pendrell.cases.util import PendrellTestMixin
+from pendrell.eyeballs import (AddressPreferences, HappyEyeballs,
+        HappyEyeballsConnector)
+
+V4, V6 = socket.AF_INET, socket.AF_INET6
+
+
+
+class _StaticResolver(object):
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+
+    def getAddresses(self, host):
+        return succeed(list(self.addresses))
+
+
+
+class _Client(object):
+    """An attempt's transport, connected or failed when told to."""
+
+    def __init__(self, family, address, attempt):
+        self.family, self.address = family, address
+        self.attempt = attempt
+        self.cancelled = False
+
+    def connect(self):
+        return self.attempt.buildProtocol(None)
+
+    def fail(self):
+        self.attempt.connectionFailed(failure.Failure(
+                netErr.ConnectionRefusedError(self.address)))
+
+    def failIfNotConnected(self, err):
+        self.cancelled = True
+        self.attempt.connectionFailed(failure.Failure(err))
+
+
+
+class _Connector(HappyEyeballsConnector):
+
+    def buildClient(self, family, address, attempt):
+        client = _Client(family, address, attempt)
+        self.eyeballs.clients.append(client)
+        return client
+
+
+
+class _Factory(protocol.ClientFactory):
+
+    protocol = protocol.Protocol
+
+    def __init__(self):
+        self.failures = []
+
+    def clientConnectionFailed(self, connector, reason):
+        self.failures.append(reason)
+
+
+
+class AddressPreferencesTest(unittest.TestCase):
+
+    addresses = [(V4, "10.0.0.1"), (V4, "10.0.0.2"), (V6, "fe80::1"),
+                 (V6, "fe80::2")]
+
+    def test_familiesInterleaved(self):
+        preferences = AddressPreferences()
+        self.assertEquals(
+                ["fe80::1", "10.0.0.1", "fe80::2", "10.0.0.2"],
+                [a for f, a in preferences.order("h", self.addresses)])
+
+
+    def test_connectedFirst(self):
+        preferences = AddressPreferences()
+        preferences.connected("h", V4, "10.0.0.2")
+        self.assertEquals(
+                ["10.0.0.2", "fe80::1", "10.0.0.1", "fe80::2"],
+                [a for f, a in preferences.order("h", self.addresses)])
+        self.assertEquals(
+                ["fe80::1", "10.0.0.1", "fe80::2", "10.0.0.2"],
+                [a for f, a in preferences.order("i", self.addresses)])
+
+
+
+class HappyEyeballsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.eyeballs = HappyEyeballs(reactor=self.clock, attemptDelay=0.25,
+                resolver=_StaticResolver([(V4, "10.0.0.1"), (V6, "fe80::1"),
+                                          (V4, "10.0.0.2")]))
+        self.eyeballs.connectorClass = _Connector
+        self.eyeballs.clients = []
+        self.factory = _Factory()
+
+
+    def connect(self):
+        connector = self.eyeballs.connectTCP("h", 80, self.factory,
+                timeout=None)
+        self.clock.advance(0)
+        return connector
+
+
+    def test_staggered(self):
+        connector = self.connect()
+        first, = self.eyeballs.clients
+        self.assertEquals("fe80::1", first.address)
+
+        self.clock.advance(0.25)
+        first, second = self.eyeballs.clients
+        self.assertEquals("10.0.0.1", second.address)
+
+        self.assertNotIdentical(None, second.connect())
+        self.assertEquals("connected", connector.state)
+        self.assertTrue(first.cancelled)
+        self.assertEquals((V4, "10.0.0.1"),
+                self.eyeballs.preferences.getPreferred("h"))
+
+        # No more attempts are started.
+        self.clock.advance(1)
+        self.assertEquals(2, len(self.eyeballs.clients))
+        self.assertEquals([], self.factory.failures)
+
+
+    def test_failureStartsNextAttempt(self):
+        self.connect()
+        self.eyeballs.clients[0].fail()
+        self.assertEquals(["fe80::1", "10.0.0.1"],
+                [c.address for c in self.eyeballs.clients])
+
+
+    def test_allFailed(self):
+        connector = self.connect()
+        for i in xrange(3):
+            self.eyeballs.clients[i].fail()
+
+        reason, = self.factory.failures
+        reason.trap(netErr.ConnectionRefusedError)
+        self.assertEquals("disconnected", connector.state)
+        self.assertEquals(None, self.eyeballs.preferences.getPreferred("h"))
+
+
+    def test_stopConnecting(self):
+        connector = self.connect()
+        self.clock.advance(0.25)
+        connector.stopConnecting()
+
+        self.assertTrue(all(c.cancelled for c in self.eyeballs.clients))
+        reason, = self.factory.failures
+        reason.trap(netErr.UserError)
+
+        self.clock.advance(1)
+        self.assertEquals(2, len(self.eyeballs.clients))
+
+
+
+class _PathResource(Resource):
+    isLeaf = True
+
+    def render(self, request):
+        return request.path
+
+
+
+class AgentEyeballsTest(PendrellTestMixin, unittest.TestCase):
+    """Addresses that refuse connections are passed over."""
+
+    timeout = 10
+    _port = 9793
+
+    def setUp(self):
+        resolver = _StaticResolver([(V6, "::1"), (V4, "127.0.0.2"),
+                                    (V4, "127.0.0.1")])
+        self.dialer = HappyEyeballs(resolver=resolver)
+        self.agent = pendrell.Agent(dialer=self.dialer, timeout=5)
+        self.server = reactor.listenTCP(self._port,
+                server.Site(_PathResource()), interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    @inlineCallbacks
+    def test_refusedAddresses(self):
+        response = yield self.getPage(
+                "http://example.invalid:%d/a" % self._port)
+        self.assertEquals("/a", response.content)
+        self.assertEquals((V4, "127.0.0.1"),
+                self.dialer.preferences.getPreferred("example.invalid"))
@@ -3,17 +3,24 @@ try:
 except ImportError:
     import simplejson as json
 
+import zlib
+from hashlib import md5
+
 from twisted.internet import reactor
 from twisted.internet.defer import (
         Deferred, DeferredList,
         inlineCallbacks, returnValue)
+from twisted.internet.protocol import Factory, Protocol
 from twisted.trial.unittest import TestCase
 from twisted.web import http
 from twisted.web.resource import Resource
 
-from pendrell import log
-from pendrell.protocols import OKAY_CODES
-from pendrell.error import WebError
+from pendrell import agent as pendrell, log
+from pendrell.protocols import OKAY_CODES, HTTPProtocol
+from pendrell.error import (HeadersTooLarge, MalformedResponse, MD5Mismatch,
+        WebError)
+from pendrell.messages import (HeaderTemplate, Request, Response,
+        ResponseHeaders)
 
 from pendrell.cases.util import PendrellTestMixin
 from pendrell.cases.http_server import Site, NOT_DONE_YET
@@ -393,3 +400,277 @@ class PendrellHTTPMethodTests(PendrellTestMixin, HTTPMethodTestMixin, TestCase):
         yield HTTPMethodTestMixin.tearDown(self)
 
 
+
+
+
+class _CannedServer(Protocol):
+    """Answers each request with the factory's response, written in pieces
+    of pieceSize bytes.
+    """
+
+    def dataReceived(self, data):
+        self.factory.received.append(data)
+        if "\r\n\r\n" in data:
+            self.write(self.factory.response)
+
+    def write(self, data):
+        size = self.factory.pieceSize or len(data)
+        self.transport.write(data[:size])
+        if data[size:]:
+            reactor.callLater(0, self.write, data[size:])
+
+
+
+class HeaderParsingTest(PendrellTestMixin, TestCase):
+    """Response headers are parsed as a block."""
+
+    timeout = 10
+    _port = 9784
+
+    def setUp(self):
+        self.agent = pendrell.Agent(timeout=5)
+        self.factory = Factory()
+        self.factory.protocol = _CannedServer
+        self.factory.pieceSize = None
+        self.factory.received = []
+        self.server = reactor.listenTCP(self._port, self.factory,
+                interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    def get(self, response):
+        self.factory.response = response
+        return self.getPage("http://127.0.0.1:%d/" % self._port)
+
+
+    @inlineCallbacks
+    def test_headers(self):
+        response = yield self.get("\r\nHTTP/1.1 200 OK\r\n"
+                "X-Tight:1\r\n"
+                "X-Folded: one\r\n\t two\r\n"
+                "X-Repeated: a\r\nX-Repeated: b\r\n"
+                "Content-Length: 2\r\n\r\nok")
+        self.assertEquals(200, response.status)
+        self.assertEquals(["1"], response.headers["x-tight"])
+        self.assertEquals(["one two"], response.headers["x-folded"])
+        self.assertEquals(["a", "b"], response.headers["x-repeated"])
+        self.assertEquals("ok", response.content)
+
+
+    @inlineCallbacks
+    def test_pieces(self):
+        self.factory.pieceSize = 1
+        response = yield self.get("HTTP/1.1 100 Continue\r\n\r\n"
+                "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        self.assertEquals(200, response.status)
+        self.assertEquals("ok", response.content)
+
+
+    def test_tooLarge(self):
+        self.patch(HTTPProtocol, "maxHeaderSize", 1024)
+        return self.assertFailure(self.get("HTTP/1.1 200 OK\r\n"
+                "X-Big: %s\r\n\r\n" % ("x" * 1024)), HeadersTooLarge)
+
+
+    def test_tooMany(self):
+        self.patch(HTTPProtocol, "maxHeaders", 10)
+        return self.assertFailure(self.get("HTTP/1.1 200 OK\r\n"
+                + "X-A: a\r\n" * 11 + "\r\n"), HeadersTooLarge)
+
+
+    @inlineCallbacks
+    def test_foldedHeaders(self):
+        # Continuation lines do not count against maxHeaders.
+        self.patch(HTTPProtocol, "maxHeaders", 2)
+        response = yield self.get("HTTP/1.1 200 OK\r\n"
+                "X-Folded: a\r\n b\r\n c\r\nContent-Length: 2\r\n\r\nok")
+        self.assertEquals(["a b c"], response.headers["x-folded"])
+
+
+    def test_malformed(self):
+        return self.assertFailure(self.get("HTTP/1.1 OK\r\n\r\n"),
+                MalformedResponse)
+
+
+    def test_badStatus(self):
+        return self.assertFailure(self.get("HTTP/1.1 1000 Big\r\n\r\n"),
+                MalformedResponse)
+
+
+    @inlineCallbacks
+    def test_chunkTrailers(self):
+        self.factory.pieceSize = 7
+        response = yield self.get("HTTP/1.1 200 OK\r\n"
+                "Transfer-Encoding: chunked\r\n\r\n"
+                "2;ext=1\r\nok\r\n0\r\nX-Trailer: t\r\n\r\n")
+        self.assertEquals("ok", response.content)
+        self.assertEquals(["t"], response.headers["x-trailer"])
+
+
+    @inlineCallbacks
+    def test_codings(self):
+        gzip = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = gzip.compress("x" * 4096) + gzip.flush()
+        deflate = zlib.compress(body)
+        self.factory.pieceSize = 100
+        response = yield self.get("HTTP/1.1 200 OK\r\n"
+                "Content-Encoding: gzip\r\n"
+                "Transfer-Encoding: deflate, chunked\r\n\r\n"
+                "%x\r\n%s\r\n0\r\n\r\n" % (len(deflate), deflate))
+        self.assertEquals("x" * 4096, response.content)
+        self.assertEquals(md5("x" * 4096).hexdigest(),
+                response.contentMD5.hexdigest())
+
+
+    @inlineCallbacks
+    def test_noDigest(self):
+        self.factory.response = "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+        url = "http://127.0.0.1:%d/" % self._port
+        response = yield self.getPage(url, digestContent=False)
+        self.assertEquals("ok", response.content)
+        self.assertIdentical(None, response.contentMD5)
+
+        # A Content-MD5 header is still verified.
+        self.factory.response = ("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n"
+                "Content-MD5: bad\r\n\r\nok")
+        yield self.assertFailure(self.getPage(url, digestContent=False),
+                MD5Mismatch)
+
+
+    def test_badChunk(self):
+        return self.assertFailure(self.get("HTTP/1.1 200 OK\r\n"
+                "Transfer-Encoding: chunked\r\n\r\nxyz\r\n"),
+                MalformedResponse)
+
+
+
+class HeaderTemplateTest(TestCase):
+
+    def setUp(self):
+        self.template = HeaderTemplate([("Connection", "keep-alive"),
+                ("User-agent", "pendrell")])
+
+
+    def test_serialize(self):
+        request = Request("http://example.com/", headers={"Host": "a"},
+                headerTemplate=self.template)
+        self.assertEquals("Host: a\r\nConnection: keep-alive\r\n"
+                "User-agent: pendrell\r\n", request.serializeHeaders())
+
+
+    def test_overridden(self):
+        request = Request("http://example.com/",
+                headers={"user-agent": "other"},
+                headerTemplate=self.template)
+        self.assertEquals([("User-agent", "other"),
+                ("Connection", "keep-alive")], list(request.iterHeaders()))
+        self.assertEquals("User-agent: other\r\nConnection: keep-alive\r\n",
+                request.serializeHeaders())
+
+
+    def test_extend(self):
+        template = self.template.extend([("user-agent", "other"),
+                ("X-Key", 1)])
+        self.assertEquals((("Connection", "keep-alive"),
+                ("user-agent", "other"), ("X-Key", "1")), template.headers)
+
+
+
+class ResponseHeadersTest(TestCase):
+
+    def setUp(self):
+        self.response = Response(Request("http://example.com/"),
+                "http://example.com/")
+        for name, value in (("Content-Type", "text/plain"),
+                            ("X-Repeated", "a"), ("x-repeated", "b")):
+            self.response.gotHeader(name, value)
+        self.headers = self.response.headers
+
+
+    def test_raw(self):
+        self.assertEquals([("content-type", "text/plain"),
+                ("x-repeated", "a"), ("x-repeated", "b")], self.headers.raw)
+        self.assertEquals(["a", "b"],
+                self.headers.getRawHeaders("X-Repeated"))
+        self.assertEquals(None, self.headers.getRawHeaders("x-missing"))
+        self.assertIdentical(None, self.headers._data)
+
+
+    def test_mapping(self):
+        self.assertEquals(["text/plain"], self.headers["CONTENT-TYPE"])
+        self.assertIn("x-repeated", self.headers)
+        self.assertEquals(2, len(self.headers))
+        self.response.gotHeader("X-Repeated", "c")
+        self.assertEquals(["a", "b", "c"], self.headers.get("x-repeated"))
+        self.headers["x-set"] = ["d"]
+        self.assertEquals(["d"], self.headers.getRawHeaders("X-Set"))
+
+
+    def test_copy(self):
+        copied = Response.fromResponse(self.response).headers
+        self.assertEquals(self.headers.raw, copied.raw)
+        copied.addRawHeader("X-Repeated", "c")
+        self.assertEquals(["a", "b"],
+                self.headers.getRawHeaders("x-repeated"))
+
+        headers = ResponseHeaders({"Location": "/a", "Vary": ["a", "b"]})
+        self.assertEquals(["/a"], headers["location"])
+        self.assertEquals(["a", "b"], headers.getRawHeaders("vary"))
+
+
+
+class RequestEmissionTest(PendrellTestMixin, TestCase):
+    """Requests are written with their agent's default headers."""
+
+    timeout = 10
+    _port = 9783
+
+    def setUp(self):
+        self.agent = pendrell.Agent(timeout=5, originHeaders={
+                "http://127.0.0.1:%d" % self._port: {"X-Key": "k",
+                                                     "User-agent": "other"}})
+        self.factory = Factory()
+        self.factory.protocol = _CannedServer
+        self.factory.pieceSize = None
+        self.factory.received = []
+        self.factory.response = "HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"
+        self.server = reactor.listenTCP(self._port, self.factory,
+                interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    @inlineCallbacks
+    def test_originHeaders(self):
+        yield self.getPage("http://127.0.0.1:%d/" % self._port,
+                method="POST", data="body", headers={"X-Own": "1"})
+        received = "".join(self.factory.received)
+        head, body = received.split("\r\n\r\n", 1)
+        lines = head.split("\r\n")
+        self.assertEquals("POST / HTTP/1.1", lines[0])
+        for line in ("X-Own: 1", "X-Key: k", "User-agent: other",
+                     "Connection: keep-alive"):
+            self.assertIn(line, lines)
+        self.assertEquals(1, len([l for l in lines
+                if l.lower().startswith("user-agent:")]))
+        self.assertEquals("body", body)
+
+
+    @inlineCallbacks
+    def test_otherOrigin(self):
+        self.agent._originHeaders = {"http://127.0.0.1:1": {"X-Key": "k"}}
+        request = self.agent.buildRequest("http://127.0.0.1:%d/" % self._port)
+        self.assertIdentical(self.agent.headerTemplate,
+                request.headerTemplate)
+        response = yield self.getPage(request)
+        self.assertEquals(200, response.status)
+        received = "".join(self.factory.received)
+        self.assertIn("User-agent: %s\r\n" % self.agent.identifier, received)
+        self.assertNotIn("X-Key", received)
@@ -0,0 +1,170 @@
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.resource import Resource
+
+from pendrell import agent as pendrell, error
+from pendrell.cases.util import PendrellTestMixin
+from pendrell.http2 import H2Connection
+
+if H2Connection is not None:
+    from pendrell.cases.certs import ServerContextFactory, buildCertificate
+    from pendrell.cases.h2_server import H2ServerFactory
+
+
+
+class HTTP2Test(PendrellTestMixin, unittest.TestCase):
+    """Requests to an h2c server, with prior knowledge."""
+
+    if H2Connection is None:
+        skip = "h2 is not installed"
+
+    timeout = 10
+    _port = 9796
+
+    def setUp(self):
+        self.agent = pendrell.Agent(http2="prior-knowledge", timeout=5)
+        self.factory = H2ServerFactory(delay=0.05)
+        self.server = reactor.listenTCP(self._port, self.factory,
+                interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    def getPath(self, path, **kw):
+        return self.getPage("http://127.0.0.1:%d%s" % (self._port, path), **kw)
+
+
+    @inlineCallbacks
+    def test_get(self):
+        response = yield self.getPath("/a?b=c")
+        self.assertEquals("HTTP/2", response.version)
+        self.assertEquals("/a?b=c", response.content)
+        self.assertEquals(["h2"], response.headers["x-protocol"])
+
+        headers, = self.factory.requests
+        self.assertEquals("127.0.0.1:%d" % self._port, headers[":authority"])
+        self.assertFalse("te" in headers)
+
+
+    @inlineCallbacks
+    def test_expectNotSent(self):
+        yield self.getPath("/a", method="PUT", data="body",
+                expectContinue=True)
+        headers, = self.factory.requests
+        self.assertFalse("expect" in headers)
+
+
+    @inlineCallbacks
+    def test_concurrentStreams(self):
+        paths = ["/%d" % i for i in xrange(10)]
+        responses = yield gatherResults([self.getPath(p) for p in paths])
+
+        self.assertEquals(paths, [r.content for r in responses])
+        self.assertEquals(1, self.factory.connectionCount)
+        self.assertTrue(self.factory.maxConcurrentStreams > 1)
+
+
+    @inlineCallbacks
+    def test_flowControl(self):
+        response = yield self.getPath("/big")
+        self.assertEquals(256 * 1024, len(response.content))
+
+
+    @inlineCallbacks
+    def test_requestBody(self):
+        data = "y" * (200 * 1024)
+        response = yield self.getPath("/echo", method="POST", data=data)
+        self.assertEquals(data, response.content)
+
+
+    @inlineCallbacks
+    def test_streamedRequestBody(self):
+        chunks = ["%d" % i * 1000 for i in xrange(10)] * 20
+        response = yield self.getPath("/echo", method="POST",
+                data=iter(chunks))
+        self.assertEquals("".join(chunks), response.content)
+
+
+    @inlineCallbacks
+    def test_status(self):
+        try:
+            yield self.getPath("/status/404")
+        except error.WebError, we:
+            self.assertEquals(404, we.response.status)
+        else:
+            self.fail("Did not fail")
+
+
+
+class _PathResource(Resource):
+    isLeaf = True
+
+    def render(self, request):
+        return request.path
+
+
+class HTTP2TLSTest(PendrellTestMixin, unittest.TestCase):
+    """HTTP/2 is negotiated with ALPN."""
+
+    if H2Connection is None:
+        skip = "h2 is not installed"
+
+    timeout = 10
+    _port = 9795
+
+    def setUp(self):
+        self.agent = pendrell.Agent(http2=True, verifyCertificates=False)
+        self.cert, self.key = buildCertificate()
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    def listen(self, factory, alpnProtocols):
+        contextFactory = ServerContextFactory(self.cert, self.key,
+                alpnProtocols)
+        self.server = reactor.listenSSL(self._port, factory, contextFactory,
+                interface="127.0.0.1")
+
+
+    def getRequester(self):
+        requester, = self.agent._requesterCache.values()
+        return requester
+
+
+    @inlineCallbacks
+    def test_negotiated(self):
+        self.listen(H2ServerFactory(), ["h2"])
+        url = "https://127.0.0.1:%d/a" % self._port
+        response = yield self.getPage(url)
+        self.assertEquals("HTTP/2", response.version)
+        self.assertEquals("/a", response.content)
+        self.assertTrue(self.getRequester().negotiated)
+
+
+    @inlineCallbacks
+    def test_fallback(self):
+        site = server.Site(_PathResource())
+        self.listen(site, ["http/1.1"])
+        url = "https://127.0.0.1:%d/" % self._port
+        responses = yield gatherResults([self.getPage(url + p)
+                for p in ("a", "b")])
+        self.assertEquals(["HTTP/1.1"] * 2, [r.version for r in responses])
+        self.assertEquals(["/a", "/b"], [r.content for r in responses])
+        self.assertFalse(self.getRequester().negotiated)
+
+
+    @inlineCallbacks
+    def test_fallbackFailure(self):
+        self.listen(server.Site(Resource()), ["http/1.1"])
+        url = "https://127.0.0.1:%d/missing" % self._port
+        failure = yield self.assertFailure(self.getPage(url), error.WebError)
+        self.assertEquals(404, failure.response.status)
+        self.assertFalse(self.getRequester().negotiated)
@@ -0,0 +1,491 @@
+import os, zlib
+from hashlib import md5
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.resource import Resource
+from twisted.web.util import redirectTo
+
+from pendrell import agent as pendrell, producers
+from pendrell.cases.util import PendrellTestMixin
+from pendrell.messages import Request
+from pendrell.producers import (UNKNOWN_LENGTH, EncodingBodyProducer,
+        FileBodyProducer, IteratorBodyProducer, getBodyProducer)
+
+try:
+    from OpenSSL import crypto
+except ImportError:
+    crypto = None
+else:
+    from pendrell.cases.certs import ServerContextFactory, buildCertificate
+
+
+
+class _Consumer(object):
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    @property
+    def content(self):
+        return "".join(self.chunks)
+
+
+
+class _Unseekable(object):
+
+    def __init__(self, data):
+        self._stream = StringIO(data)
+
+    def read(self, size):
+        return self._stream.read(size)
+
+
+
+class FileBodyProducerTest(unittest.TestCase):
+
+    @inlineCallbacks
+    def produce(self, producer):
+        consumer = _Consumer()
+        yield producer.startProducing(consumer)
+        self.chunks = consumer.chunks
+        self.content = consumer.content
+
+
+    @inlineCallbacks
+    def test_restartable(self):
+        stream = StringIO("skip:abcdefghij")
+        stream.seek(5)
+        producer = FileBodyProducer(stream, readSize=4)
+        self.assertEquals(10, producer.length)
+        self.assertTrue(producer.restartable)
+
+        for i in xrange(2):
+            yield self.produce(producer)
+            self.assertEquals(["abcd", "efgh", "ij"], self.chunks)
+
+
+    @inlineCallbacks
+    def test_length(self):
+        producer = FileBodyProducer(StringIO("abcdefghij"), length=3)
+        yield self.produce(producer)
+        self.assertEquals("abc", self.content)
+
+
+    @inlineCallbacks
+    def test_unseekable(self):
+        producer = FileBodyProducer(_Unseekable("abc"))
+        self.assertEquals(UNKNOWN_LENGTH, producer.length)
+        self.assertFalse(producer.restartable)
+        yield self.produce(producer)
+        self.assertEquals("abc", self.content)
+
+
+    @inlineCallbacks
+    def test_iterator(self):
+        producer = IteratorBodyProducer(iter(["a", "", "bc"]))
+        self.assertEquals(UNKNOWN_LENGTH, producer.length)
+        yield self.produce(producer)
+        self.assertEquals(["a", "bc"], self.chunks)
+
+
+    def test_getBodyProducer(self):
+        self.assertIdentical(None, getBodyProducer("abc"))
+        self.assertIdentical(None, getBodyProducer(None))
+        self.assertTrue(isinstance(getBodyProducer(StringIO("a")),
+                FileBodyProducer))
+        self.assertTrue(isinstance(getBodyProducer(iter("a")),
+                IteratorBodyProducer))
+        producer = IteratorBodyProducer([])
+        self.assertIdentical(producer, getBodyProducer(producer))
+        self.assertRaises(TypeError, getBodyProducer, 42)
+
+
+    def test_requestHeaders(self):
+        request = Request("http://example.com/", method="POST",
+                data=StringIO("abc"))
+        request.prepareHeaders()
+        self.assertEquals("3", request.headers["Content-Length"])
+        self.assertTrue(request.bodyReplayable)
+
+        request = Request("http://example.com/", method="POST",
+                data=iter(["abc"]))
+        request.prepareHeaders()
+        self.assertEquals("chunked", request.headers["Transfer-Encoding"])
+        self.assertFalse("Content-Length" in request.headers)
+        self.assertFalse(request.bodyReplayable)
+
+
+
+class _UploadResource(Resource):
+    isLeaf = True
+
+    def render_POST(self, request):
+        if request.path == "/redirect":
+            request.setResponseCode(307)
+            return redirectTo("/echo", request)
+        body = request.content.read()
+        return "%s %d %s" % (request.getHeader("transfer-encoding"),
+                len(body), md5(body).hexdigest())
+
+
+
+class StreamingUploadTest(PendrellTestMixin, unittest.TestCase):
+    """Request bodies are streamed from files and iterators."""
+
+    timeout = 10
+    _port = 9789
+
+    def setUp(self):
+        self.agent = pendrell.Agent(timeout=5, expectContinueThreshold=None)
+        self.server = reactor.listenTCP(self._port,
+                server.Site(_UploadResource()), interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    def post(self, data, path="/echo"):
+        return self.getPage("http://127.0.0.1:%d%s" % (self._port, path),
+                method="POST", data=data)
+
+
+    def expected(self, encoding, body):
+        return "%s %d %s" % (encoding, len(body), md5(body).hexdigest())
+
+
+    @inlineCallbacks
+    def test_file(self):
+        body = "".join(chr(i % 256) for i in xrange(1024 * 1024))
+        response = yield self.post(StringIO(body))
+        self.assertEquals(self.expected(None, body), response.content)
+
+
+    @inlineCallbacks
+    def test_chunked(self):
+        chunks = ["x" * 1000, "y" * 70000, "z"]
+        response = yield self.post(iter(chunks))
+        self.assertEquals(self.expected("chunked", "".join(chunks)),
+                response.content)
+
+
+    @inlineCallbacks
+    def test_redirected(self):
+        body = "abc" * 1000
+        response = yield self.post(StringIO(body), path="/redirect")
+        self.assertEquals(self.expected(None, body), response.content)
+
+
+    @inlineCallbacks
+    def test_pathRedirected(self):
+        # The file is closed after each send and opened again to resend.
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write("abc" * 1000)
+        body = FileBodyProducer.fromPath(path)
+        response = yield self.post(body, path="/redirect")
+        self.assertEquals(self.expected(None, "abc" * 1000), response.content)
+        self.assertTrue(body.stream.closed)
+
+
+    def test_producerFailed(self):
+        def chunks():
+            yield "abc"
+            raise ValueError("Broken")
+        return self.assertFailure(self.post(chunks()), ValueError)
+
+
+    @inlineCallbacks
+    def test_connectionReused(self):
+        yield self.post(iter(["abc"]))
+        response = yield self.post("def")
+        self.assertEquals(self.expected(None, "def"), response.content)
+
+
+
+class SendfileUploadTest(StreamingUploadTest):
+    """Files are copied to plain TCP connections with sendfile(2)."""
+
+    if producers.sendfile is None:
+        skip = "sendfile(2) is not available"
+
+    _port = 9788
+
+    def setUp(self):
+        StreamingUploadTest.setUp(self)
+        self.sendfileCalls = []
+        def sendfile(*args):
+            self.sendfileCalls.append(args)
+            return self.sendfile(*args)
+        self.sendfile = producers.sendfile
+        self.patch(producers, "sendfile", sendfile)
+
+
+    def writeFile(self, body):
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write(body)
+        return path
+
+
+    @inlineCallbacks
+    def test_sendfile(self):
+        body = os.urandom(3 * 1024 * 1024)
+        body = FileBodyProducer.fromPath(self.writeFile("skip" + body))
+        body.stream.seek(4)
+        body = FileBodyProducer(body.stream)
+        response = yield self.post(body)
+        self.assertEquals(self.expected(None, body.stream.read()),
+                response.content)
+        self.assertTrue(self.sendfileCalls)
+
+
+    @inlineCallbacks
+    def test_sendfileTwice(self):
+        path = self.writeFile("abc" * 1000)
+        with open(path, "rb") as f:
+            for i in xrange(2):
+                response = yield self.post(f)
+                self.assertEquals(self.expected(None, "abc" * 1000),
+                        response.content)
+        self.assertEquals(2, len(self.sendfileCalls))
+
+
+    @inlineCallbacks
+    def test_notAFile(self):
+        yield self.post(StringIO("abc"))
+        self.assertEquals([], self.sendfileCalls)
+
+
+    @inlineCallbacks
+    def test_unknownTransport(self):
+        # A transport without the buffer sendfile(2) waits on is read from.
+        self.patch(producers.SendfileWriter, "_bufferAttributes",
+                ("dataBuffer", "_notBuffered"))
+        path = self.writeFile("abc" * 1000)
+        response = yield self.post(FileBodyProducer.fromPath(path))
+        self.assertEquals(self.expected(None, "abc" * 1000), response.content)
+        self.assertEquals([], self.sendfileCalls)
+
+
+
+class TLSUploadTest(StreamingUploadTest):
+    """TLS connections encrypt in user space, so files are read and
+    written rather than sent with sendfile(2).
+    """
+
+    if crypto is None:
+        skip = "pyOpenSSL is not installed"
+
+    _port = 9787
+
+    def setUp(self):
+        cert, key = buildCertificate()
+        path = self.mktemp()
+        with open(path, "w") as pem:
+            pem.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+        self.agent = pendrell.Agent(timeout=5, expectContinueThreshold=None,
+                caCertsFile=path)
+        self.server = reactor.listenSSL(self._port,
+                server.Site(_UploadResource()),
+                ServerContextFactory(cert, key), interface="127.0.0.1")
+        self.sendfileCalls = []
+        self.patch(producers, "sendfile",
+                lambda *args: self.sendfileCalls.append(args))
+
+
+    def post(self, data, path="/echo"):
+        return self.getPage("https://127.0.0.1:%d%s" % (self._port, path),
+                method="POST", data=data)
+
+
+    @inlineCallbacks
+    def test_noSendfile(self):
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write("abc" * 100000)
+        response = yield self.post(FileBodyProducer.fromPath(path))
+        self.assertEquals(self.expected(None, "abc" * 100000),
+                response.content)
+        self.assertEquals([], self.sendfileCalls)
+
+
+
+class _DecodingResource(Resource):
+    isLeaf = True
+
+    def render_POST(self, request):
+        encoding = request.getHeader("content-encoding")
+        if encoding and request.path == "/strict":
+            request.setResponseCode(415)
+            return "No"
+        body = request.content.read()
+        if encoding == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            body = zlib.decompress(body)
+        return "%s %s %s" % (encoding, request.getHeader("transfer-encoding"),
+                md5(body).hexdigest())
+
+
+
+class CompressedUploadTest(PendrellTestMixin, unittest.TestCase):
+    """Request bodies are compressed as they are sent."""
+
+    timeout = 10
+    _port = 9786
+
+    body = "".join('{"line": %d, "level": "info"}\n' % i
+            for i in xrange(20000))
+
+    def setUp(self):
+        self.agent = pendrell.Agent(timeout=5, expectContinueThreshold=None,
+                compressRequest=True)
+        self.server = reactor.listenTCP(self._port,
+                server.Site(_DecodingResource()), interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    def post(self, data, path="/echo", **kw):
+        return self.getPage("http://127.0.0.1:%d%s" % (self._port, path),
+                method="POST", data=data, **kw)
+
+
+    def expected(self, encoding, transferEncoding, body=None):
+        return "%s %s %s" % (encoding, transferEncoding,
+                md5(body or self.body).hexdigest())
+
+
+    def test_encodingBodyProducer(self):
+        producer = EncodingBodyProducer(IteratorBodyProducer(["abc"] * 100),
+                "deflate")
+        consumer = _Consumer()
+        d = producer.startProducing(consumer)
+        d.addCallback(lambda _: self.assertEquals("abc" * 100,
+                zlib.decompress(consumer.content)))
+        return d
+
+
+    @inlineCallbacks
+    def test_str(self):
+        response = yield self.post(self.body)
+        self.assertEquals(self.expected("gzip", None), response.content)
+        self.assertTrue(len(response.request) < len(self.body) / 5)
+
+
+    @inlineCallbacks
+    def test_streamed(self):
+        response = yield self.post(StringIO(self.body),
+                compressRequest="deflate")
+        self.assertEquals(self.expected("deflate", "chunked"),
+                response.content)
+
+
+    @inlineCallbacks
+    def test_skipped(self):
+        response = yield self.post("small")
+        self.assertEquals(self.expected(None, None, "small"),
+                response.content)
+
+        response = yield self.post(self.body,
+                headers={"Content-Type": "image/png"})
+        self.assertEquals(self.expected(None, None), response.content)
+
+        response = yield self.post(self.body, compressRequest=False)
+        self.assertEquals(self.expected(None, None), response.content)
+
+
+    @inlineCallbacks
+    def test_unsupported(self):
+        response = yield self.post(StringIO(self.body), path="/strict")
+        self.assertEquals(self.expected(None, None), response.content)
+
+        request = self.agent.buildRequest(
+                "http://127.0.0.1:%d/strict" % self._port, method="POST",
+                data=self.body)
+        self.assertIdentical(None, request.bodyEncoding)
+
+
+
+class _FormResource(Resource):
+    isLeaf = True
+
+    def render_POST(self, request):
+        # Twisted parses multipart/form-data into request.args.
+        return "%s %s|%s|%s" % (request.getHeader("content-length"),
+                request.args["title"][0], request.args["note"][0],
+                md5(request.args["upload"][0]).hexdigest())
+
+
+
+class MultipartBodyTest(PendrellTestMixin, unittest.TestCase):
+
+    timeout = 10
+    _port = 9785
+
+    def setUp(self):
+        self.agent = pendrell.Agent(timeout=5, expectContinueThreshold=None)
+        self.server = reactor.listenTCP(self._port,
+                server.Site(_FormResource()), interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    def test_encoding(self):
+        body = producers.MultipartBody(fields=[("a", u"\xe9")],
+                files=[("f", ('say "hi".txt', StringIO("hi")))],
+                boundary="XX")
+        self.assertEquals("multipart/form-data; boundary=XX",
+                body.contentType)
+        consumer = _Consumer()
+        d = body.startProducing(consumer)
+        d.addCallback(lambda _: self.assertEquals(
+                '--XX\r\nContent-Disposition: form-data; name="a"\r\n\r\n'
+                '\xc3\xa9\r\n'
+                '--XX\r\nContent-Disposition: form-data; name="f"; '
+                'filename="say %22hi%22.txt"\r\n'
+                'Content-Type: text/plain\r\n\r\nhi\r\n'
+                '--XX--\r\n', consumer.content))
+        d.addCallback(lambda _: self.assertEquals(len(consumer.content),
+                body.length))
+        return d
+
+
+    def test_unknownLength(self):
+        body = producers.MultipartBody(files={"f": _Unseekable("abc")})
+        self.assertEquals(UNKNOWN_LENGTH, body.length)
+        self.assertFalse(body.restartable)
+
+
+    @inlineCallbacks
+    def test_upload(self):
+        path = self.mktemp()
+        content = os.urandom(512 * 1024)
+        with open(path, "wb") as f:
+            f.write(content)
+        body = producers.MultipartBody(
+                fields={"title": "Report", "note": "x" * 100},
+                files={"upload": path})
+        response = yield self.getPage(
+                "http://127.0.0.1:%d/form" % self._port,
+                method="POST", data=body)
+        self.assertEquals("%d Report|%s|%s" % (body.length, "x" * 100,
+                md5(content).hexdigest()), response.content)
+        upload, = [part for part in body._parts if not isinstance(part, str)]
+        self.assertTrue(upload.stream.closed)
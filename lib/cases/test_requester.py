@@ -0,0 +1,258 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.trial.unittest import TestCase
+
+from pendrell.messages import Request
+from pendrell.requester import HTTPRequester, Multiplexer
+
+
+
+class _Requester(object):
+    """Records issued requests and responds when told to."""
+
+    def __init__(self, scheme, host, port, multiplexer=None, **kw):
+        self.multiplexer = multiplexer
+        self.issued = []
+        self._pending = []
+
+    @property
+    def active(self):
+        return bool(self._pending)
+
+    @property
+    def outstanding(self):
+        return len(self._pending)
+
+    @property
+    def outstandingBytes(self):
+        return sum(r.expectedSize for r, d in self._pending)
+
+    @property
+    def paths(self):
+        return [r.url.path.lstrip("/") for r in self.issued]
+
+    def issueRequest(self, request):
+        self.issued.append(request)
+        d = Deferred()
+        self._pending.append((request, d))
+        return d
+
+    def respond(self, size=0):
+        request, d = self._pending.pop(0)
+        response = request.buildResponse()
+        response.gotStatus("HTTP/1.1", "200", "OK")
+        response.gotHeader("Content-Length", "%d" % size)
+        d.callback(response)
+        self.multiplexer.requesterAvailable(self)
+
+    def loseConnection(self):
+        return succeed(True)
+
+
+
+class MultiplexerTestMixin(object):
+
+    def buildMultiplexer(self, **kw):
+        return Multiplexer(_Requester, "http", "localhost", 80, **kw)
+
+
+    def issueRequests(self, mux, *paths, **kw):
+        responses = []
+        for path in paths:
+            request = Request("http://localhost/%s" % path, **kw)
+            d = mux.issueRequest(request)
+            d.addCallback(lambda r: responses.append(r.url.path.lstrip("/")))
+        return responses
+
+
+
+class MultiplexerTest(MultiplexerTestMixin, TestCase):
+
+    def test_waitersAreFIFO(self):
+        mux = self.buildMultiplexer(maxConnections=1)
+        responses = self.issueRequests(mux, "a", "b", "c")
+
+        requester, = mux._requesters
+        self.assertEquals(["a"], requester.paths)
+        self.assertEquals(2, len(mux._waiters))
+
+        requester.respond()
+        self.assertEquals(["a", "b"], requester.paths)
+        requester.respond()
+        requester.respond()
+        self.assertEquals(["a", "b", "c"], requester.paths)
+        self.assertEquals(["a", "b", "c"], responses)
+        self.assertEquals(0, len(mux._waiters))
+
+
+    def test_waiterWakesOnce(self):
+        mux = self.buildMultiplexer(maxConnections=2)
+        self.issueRequests(mux, "a", "b", "c", "d")
+
+        first, second = mux._requesters
+        first.respond()
+        self.assertEquals(["a", "c"], first.paths)
+        self.assertEquals(["b"], second.paths)
+        self.assertEquals(1, len(mux._waiters))
+
+
+    def test_pipeliningLeastOutstanding(self):
+        mux = self.buildMultiplexer(maxConnections=2, pipelineDepth=2)
+        self.issueRequests(mux, "a", "b", "c", "d", "e")
+
+        first, second = mux._requesters
+        self.assertEquals(0, len(mux._waiters))
+        self.assertEquals(["a", "c", "e"], first.paths)
+        self.assertEquals(["b", "d"], second.paths)
+
+        first.respond()
+        first.respond()
+        self.issueRequests(mux, "f")
+        self.assertEquals(["a", "c", "e", "f"], first.paths)
+
+
+    def test_pipelineDepth(self):
+        mux = self.buildMultiplexer(maxConnections=1, pipelineDepth=1)
+        self.issueRequests(mux, "a", "b", "c", "d")
+
+        requester, = mux._requesters
+        self.assertEquals(["a", "b"], requester.paths)
+        self.assertEquals(2, len(mux._waiters))
+
+        requester.respond()
+        self.assertEquals(["a", "b", "c"], requester.paths)
+
+
+    def test_pipeliningNonIdempotent(self):
+        mux = self.buildMultiplexer(maxConnections=1, pipelineDepth=4)
+        self.issueRequests(mux, "a")
+        self.issueRequests(mux, "b", method="POST")
+        self.issueRequests(mux, "c")
+
+        requester, = mux._requesters
+        self.assertEquals(["a"], requester.paths)
+
+        # The POST waits for an idle connection; "c" is issued behind it but
+        # the protocol will not pipeline it.
+        requester.respond()
+        self.assertEquals(["a", "b", "c"], requester.paths)
+
+
+
+class SizeAwareMultiplexerTest(MultiplexerTestMixin, TestCase):
+
+    def buildMultiplexer(self, **kw):
+        kw.setdefault("bulkThreshold", 1024)
+        return MultiplexerTestMixin.buildMultiplexer(self, **kw)
+
+
+    def test_sizeHistory(self):
+        mux = self.buildMultiplexer(maxConnections=1)
+        self.issueRequests(mux, "big")
+        requester, = mux._requesters
+        requester.respond(4096)
+
+        request = Request("http://localhost/big")
+        self.assertEquals(4096, mux.getExpectedSize(request))
+        request = Request("http://localhost/small")
+        self.assertEquals(0, mux.getExpectedSize(request))
+        request = Request("http://localhost/big?page=2")
+        self.assertEquals(0, mux.getExpectedSize(request))
+
+
+    def test_smallNotQueuedBehindBulk(self):
+        mux = self.buildMultiplexer(maxConnections=2, pipelineDepth=2)
+        mux._sizeHistory["/big"] = 4096
+        self.issueRequests(mux, "big", "a", "b", "c")
+
+        first, second = mux._requesters
+        self.assertEquals(["big"], first.paths)
+        self.assertEquals(["a", "b", "c"], second.paths)
+
+        self.issueRequests(mux, "d")
+        self.assertEquals(["big"], first.paths)
+        self.assertEquals(1, len(mux._waiters))
+
+        second.respond()
+        self.assertEquals(["a", "b", "c", "d"], second.paths)
+
+
+    def test_bulkConnections(self):
+        mux = self.buildMultiplexer(maxConnections=2, maxBulkConnections=1)
+        mux._sizeHistory["/big"] = 4096
+        self.issueRequests(mux, "big", "a", "big")
+
+        requester, = mux._requesters
+        bulkRequester, = mux._bulkMultiplexer._requesters
+        self.assertEquals(["a"], requester.paths)
+        self.assertEquals(["big"], bulkRequester.paths)
+        self.assertEquals(1, len(mux._bulkMultiplexer._waiters))
+
+        self.issueRequests(mux, "b")
+        requester.respond()
+        self.assertEquals(["a", "b"], requester.paths)
+
+
+    def test_bulkConnectionsCounted(self):
+        mux = self.buildMultiplexer(maxConnections=3, maxBulkConnections=5)
+        self.assertEquals(2, mux._bulkMultiplexer.maxConnections)
+        self.issueRequests(mux, "a", "b")
+        self.assertEquals(1, len(mux._requesters))
+        self.assertEquals(1, len(mux._waiters))
+
+        mux = self.buildMultiplexer(maxConnections=1, maxBulkConnections=1)
+        self.assertIdentical(None, mux._bulkMultiplexer)
+
+
+
+class _Connector(object):
+    state = "connected"
+
+
+
+class RequesterDispatchTest(TestCase):
+    """Requests are handed to a waiting connection without a reactor
+    iteration.
+    """
+
+    def setUp(self):
+        self.requester = HTTPRequester("http", "localhost", 80)
+        self.requester._connector = _Connector()
+
+
+    def test_handedToWaitingProtocol(self):
+        sent = []
+        self.requester.getNextRequest().addCallback(sent.append)
+
+        request = Request("http://localhost/a")
+        d = self.requester.issueRequest(request)
+        self.assertEquals([request], sent)
+        self.assertTrue(self.requester.active)
+
+        finished = []
+        d.addCallback(finished.append)
+        request.response.callback("response")
+        self.assertEquals(["response"], finished)
+        self.assertFalse(self.requester.active)
+
+
+    def test_callerDeferred(self):
+        self.requester.getNextRequest()
+        request = Request("http://localhost/a")
+        d = self.requester.issueRequest(request)
+        self.assertNotIdentical(request.response, d)
+
+        # The caller's failure is the caller's to handle.
+        failures = []
+        d.addErrback(failures.append)
+        request.response.errback(ValueError("lost"))
+        self.assertEquals([ValueError], [f.type for f in failures])
+        self.assertFalse(self.requester.active)
+
+
+    def test_queuedUntilAsked(self):
+        request = Request("http://localhost/a")
+        self.requester.issueRequest(request)
+
+        sent = []
+        self.requester.getNextRequest().addCallback(sent.append)
+        self.assertEquals([request], sent)
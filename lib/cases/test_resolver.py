@@ -0,0 +1,274 @@
+import socket
+
+from twisted.internet import error as netErr, reactor
+from twisted.internet.defer import Deferred, fail, inlineCallbacks, succeed
+from twisted.internet.task import Clock
+from twisted.names import dns, error as dnsErr
+from twisted.python import failure
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.resource import Resource
+
+from pendrell import agent as pendrell
+from pendrell.cases.util import PendrellTestMixin
+from pendrell.resolver import CachingResolver, NamesLookup
+
+V4, V6 = socket.AF_INET, socket.AF_INET6
+
+
+
+class _Lookup(object):
+    """Answers lookups when told to."""
+
+    def __init__(self):
+        self.pending = []
+
+    def lookup(self, host):
+        d = Deferred()
+        self.pending.append((host, d))
+        return d
+
+    def answer(self, addresses, ttl=None):
+        host, d = self.pending.pop(0)
+        d.callback((addresses, ttl))
+
+    def fail(self):
+        host, d = self.pending.pop(0)
+        d.errback(failure.Failure(netErr.DNSLookupError(host)))
+
+
+
+class _ImmediateLookup(object):
+    """Answers lookups synchronously, as a blocking resolver does."""
+
+    def __init__(self, result):
+        self.result = result
+        self.hosts = []
+
+    def lookup(self, host):
+        self.hosts.append(host)
+        if isinstance(self.result, Exception):
+            return fail(self.result)
+        return succeed(self.result)
+
+
+
+class CachingResolverTest(unittest.TestCase):
+
+    addresses = [(V4, "10.0.0.1"), (V6, "fe80::1")]
+
+    def setUp(self):
+        self.clock = Clock()
+        self.lookup = _Lookup()
+        self.resolver = CachingResolver(lookup=self.lookup, clock=self.clock,
+                negativeTTL=5, prefetch=0.75)
+        self.results = []
+
+
+    def resolve(self, host="example.com"):
+        d = self.resolver.getAddresses(host)
+        d.addBoth(self.results.append)
+        return d
+
+
+    def test_cachedForTTL(self):
+        self.resolve()
+        self.resolve()
+        self.assertEquals(1, len(self.lookup.pending))
+        self.lookup.answer(self.addresses, ttl=30)
+        self.assertEquals([self.addresses] * 2, self.results)
+
+        self.clock.advance(20)
+        self.resolve("EXAMPLE.com")
+        self.assertEquals(0, len(self.lookup.pending))
+
+        self.clock.advance(10)
+        self.resolve()
+        self.assertEquals(1, len(self.lookup.pending))
+
+
+    def test_defaultTTL(self):
+        self.resolve()
+        self.lookup.answer(self.addresses)
+        self.clock.advance(self.resolver.defaultTTL - 1)
+        self.resolve()
+        self.assertEquals(0, len(self.lookup.pending))
+        self.clock.advance(1)
+        self.resolve()
+        self.assertEquals(1, len(self.lookup.pending))
+
+
+    def test_prefetch(self):
+        self.resolve()
+        self.lookup.answer(self.addresses, ttl=100)
+
+        # Not yet hot.
+        self.clock.advance(80)
+        self.resolve()
+        self.assertEquals(0, len(self.lookup.pending))
+
+        self.resolve()
+        self.assertEquals(1, len(self.lookup.pending))
+        self.resolve()
+        self.assertEquals(1, len(self.lookup.pending))
+        self.assertEquals([self.addresses] * 4, self.results)
+
+        self.lookup.answer([(V4, "10.0.0.2")], ttl=100)
+        self.clock.advance(50)
+        self.resolve()
+        self.assertEquals([(V4, "10.0.0.2")], self.results[-1])
+        self.assertEquals(0, len(self.lookup.pending))
+
+
+    def test_failedRefresh(self):
+        self.resolve()
+        self.lookup.answer(self.addresses, ttl=100)
+        self.clock.advance(80)
+        self.resolve()
+        self.resolve()
+        self.lookup.fail()
+
+        self.resolve()
+        self.assertEquals([self.addresses] * 4, self.results)
+        self.clock.advance(20)
+        self.resolve()
+        self.assertEquals(1, len(self.lookup.pending))
+
+
+    def test_negative(self):
+        self.resolve()
+        self.lookup.fail()
+        self.resolve()
+        self.assertEquals(0, len(self.lookup.pending))
+        for result in self.results:
+            result.trap(netErr.DNSLookupError)
+
+        self.clock.advance(5)
+        self.resolve()
+        self.assertEquals(1, len(self.lookup.pending))
+
+
+    def test_overrides(self):
+        self.resolver.setOverride("Example.com", ["10.0.0.9", "::1"])
+        self.resolve()
+        self.resolve("127.0.0.1")
+        self.assertEquals(0, len(self.lookup.pending))
+        self.assertEquals([[(V4, "10.0.0.9"), (V6, "::1")],
+                           [(V4, "127.0.0.1")]], self.results)
+
+
+    def test_getHostByName(self):
+        d = self.resolver.getHostByName("example.com")
+        d.addCallback(self.results.append)
+        self.lookup.answer([(V6, "fe80::1"), (V4, "10.0.0.1")])
+        self.assertEquals(["10.0.0.1"], self.results)
+
+
+    def test_maxEntries(self):
+        self.resolver.maxEntries = 2
+        for host in ("a", "b", "a", "c"):
+            self.resolve(host)
+            if self.lookup.pending:
+                self.lookup.answer(self.addresses)
+        self.assertEquals(2, len(self.resolver))
+        self.resolve("a")
+        self.assertEquals(0, len(self.lookup.pending))
+        self.resolve("b")
+        self.assertEquals(1, len(self.lookup.pending))
+
+
+    def test_synchronousLookup(self):
+        self.resolver.lookup = _ImmediateLookup((self.addresses, 30))
+        self.resolve()
+        self.resolve()
+        self.assertEquals([self.addresses, self.addresses], self.results)
+        self.assertEquals(["example.com"], self.resolver.lookup.hosts)
+
+
+    def test_synchronousFailure(self):
+        self.resolver.lookup = _ImmediateLookup(
+                netErr.DNSLookupError("example.com"))
+        self.resolve()
+        self.assertEquals(1, len(self.results))
+        self.results[0].trap(netErr.DNSLookupError)
+
+
+
+class _NamesResolver(object):
+
+    def __init__(self, a, aaaa):
+        self.a, self.aaaa = a, aaaa
+
+    def lookupAddress(self, name):
+        return self.a
+
+    def lookupIPV6Address(self, name):
+        return self.aaaa
+
+
+
+class NamesLookupTest(unittest.TestCase):
+
+    def record(self, payload, ttl):
+        return dns.RRHeader("example.com", payload.TYPE, ttl=ttl,
+                payload=payload)
+
+
+    @inlineCallbacks
+    def test_minimumTTL(self):
+        a = self.record(dns.Record_A("10.0.0.1"), 300)
+        aaaa = self.record(dns.Record_AAAA("fe80::1"), 60)
+        lookup = NamesLookup(_NamesResolver(succeed(([a], [], [])),
+                succeed(([aaaa], [], []))))
+        addresses, ttl = yield lookup.lookup("example.com")
+        self.assertEquals([(V4, "10.0.0.1"), (V6, "fe80::1")], addresses)
+        self.assertEquals(60, ttl)
+
+
+    @inlineCallbacks
+    def test_oneFamily(self):
+        a = self.record(dns.Record_A("10.0.0.1"), 300)
+        lookup = NamesLookup(_NamesResolver(succeed(([a], [], [])),
+                fail(dnsErr.DNSNameError())))
+        addresses, ttl = yield lookup.lookup("example.com")
+        self.assertEquals([(V4, "10.0.0.1")], addresses)
+
+
+    def test_nxdomain(self):
+        lookup = NamesLookup(_NamesResolver(fail(dnsErr.DNSNameError()),
+                fail(dnsErr.DNSNameError())))
+        return self.assertFailure(lookup.lookup("example.com"),
+                dnsErr.DNSNameError)
+
+
+
+class _PathResource(Resource):
+    isLeaf = True
+
+    def render(self, request):
+        return request.path
+
+
+
+class AgentResolverTest(PendrellTestMixin, unittest.TestCase):
+
+    timeout = 10
+    _port = 9792
+
+    def setUp(self):
+        self.agent = pendrell.Agent(timeout=5,
+                hostOverrides={"example.invalid": "127.0.0.1"})
+        self.server = reactor.listenTCP(self._port,
+                server.Site(_PathResource()), interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    @inlineCallbacks
+    def test_hostOverride(self):
+        response = yield self.getPage(
+                "http://example.invalid:%d/a" % self._port)
+        self.assertEquals("/a", response.content)
@@ -0,0 +1,115 @@
+import socket
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.resource import Resource
+
+from pendrell import agent as pendrell
+from pendrell.cases.util import PendrellTestMixin
+from pendrell.sockets import PROFILES, SocketProfile, TCP_KEEPIDLE
+
+
+
+class SocketProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    def tearDown(self):
+        self.sock.close()
+
+
+    def getOption(self, level, option):
+        return self.sock.getsockopt(level, option)
+
+
+    def test_fromValue(self):
+        profile = SocketProfile(quickAck=True)
+        self.assertIdentical(profile, SocketProfile.fromValue(profile))
+        self.assertIdentical(PROFILES["bulk"], SocketProfile.fromValue("bulk"))
+        self.assertEquals(1024, SocketProfile.fromValue(
+                {"sendBuffer": 1024}).sendBuffer)
+        self.assertTrue(SocketProfile.fromValue(None).noDelay)
+        self.assertRaises(ValueError, SocketProfile.fromValue, "bogus")
+
+
+    def test_connected(self):
+        profile = SocketProfile(noDelay=True, keepAlive=True,
+                keepAliveIdle=42, sendBuffer=64*1024)
+        self.assertTrue(profile.connected(self.sock))
+        self.assertEquals(1, self.getOption(socket.IPPROTO_TCP,
+                socket.TCP_NODELAY))
+        self.assertEquals(1, self.getOption(socket.SOL_SOCKET,
+                socket.SO_KEEPALIVE))
+        # Linux doubles buffer sizes for its bookkeeping.
+        self.assertTrue(self.getOption(socket.SOL_SOCKET,
+                socket.SO_SNDBUF) >= 64*1024)
+        if TCP_KEEPIDLE is not None:
+            self.assertEquals(42, self.getOption(socket.IPPROTO_TCP,
+                    TCP_KEEPIDLE))
+
+
+    def test_unsetOptionsUntouched(self):
+        SocketProfile(noDelay=None).connected(self.sock)
+        self.assertEquals(0, self.getOption(socket.IPPROTO_TCP,
+                socket.TCP_NODELAY))
+
+
+    def test_notTCP(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        self.assertFalse(SocketProfile().connected(sock))
+
+
+
+class _PathResource(Resource):
+    isLeaf = True
+
+    def render(self, request):
+        return request.path
+
+
+
+class AgentSocketProfileTest(PendrellTestMixin, unittest.TestCase):
+
+    timeout = 10
+    _port = 9791
+
+    def setUp(self):
+        self.agent = pendrell.Agent(timeout=5, socketProfiles={
+                "http://localhost:%d" % self._port: "keepalive"})
+        self.server = reactor.listenTCP(self._port,
+                server.Site(_PathResource()), interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    @inlineCallbacks
+    def getSocket(self, host):
+        url = "http://%s:%d/a" % (host, self._port)
+        response = yield self.getPage(url)
+        self.assertEquals("/a", response.content)
+        multiplexer = self.agent.getRequester(self.agent.buildRequest(url))
+        requester, = multiplexer._requesters
+        self.sock = requester._currentProtocol.transport.getHandle()
+
+
+    @inlineCallbacks
+    def test_default(self):
+        yield self.getSocket("127.0.0.1")
+        self.assertEquals(1, self.sock.getsockopt(socket.IPPROTO_TCP,
+                socket.TCP_NODELAY))
+        self.assertEquals(0, self.sock.getsockopt(socket.SOL_SOCKET,
+                socket.SO_KEEPALIVE))
+
+
+    @inlineCallbacks
+    def test_perOrigin(self):
+        yield self.getSocket("localhost")
+        self.assertEquals(1, self.sock.getsockopt(socket.SOL_SOCKET,
+                socket.SO_KEEPALIVE))
@@ -0,0 +1,187 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from pendrell.messages import Request
+from pendrell.timeouts import AdaptiveTimeouts, Timeouts, TimerWheel
+
+
+
+class TimerWheelTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(resolution=0.1, slots=8, clock=self.clock)
+        self.fired = []
+
+
+    def schedule(self, delay, name):
+        return self.wheel.schedule(delay, self.fired.append, name)
+
+
+    def advance(self, seconds, step=0.1):
+        for i in xrange(int(round(seconds / step))):
+            self.clock.advance(step)
+
+
+    def test_fires(self):
+        self.schedule(0.3, "a")
+        self.schedule(0.15, "b")
+        self.advance(0.2)
+        self.assertEquals(["b"], self.fired)
+        self.advance(0.1)
+        self.assertEquals(["b", "a"], self.fired)
+        self.assertEquals(0, len(self.wheel))
+
+
+    def test_singleCall(self):
+        for i in xrange(100):
+            self.schedule(0.5, i)
+        self.assertEquals(1, len(self.clock.getDelayedCalls()))
+
+        self.advance(0.5)
+        self.assertEquals(range(100), self.fired)
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+
+    def test_cancel(self):
+        timer = self.schedule(0.2, "a")
+        self.assertTrue(timer.active())
+        timer.cancel()
+        self.assertFalse(timer.active())
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+        self.advance(0.5)
+        self.assertEquals([], self.fired)
+
+
+    def test_resetPostpones(self):
+        timer = self.schedule(0.2, "a")
+        self.advance(0.1)
+        timer.reset(0.3)
+        self.advance(0.2)
+        self.assertEquals([], self.fired)
+        self.advance(0.1)
+        self.assertEquals(["a"], self.fired)
+
+
+    def test_resetHastens(self):
+        timer = self.schedule(0.5, "a")
+        timer.reset(0.1)
+        self.advance(0.1)
+        self.assertEquals(["a"], self.fired)
+
+
+    def test_beyondRing(self):
+        # 8 slots of 0.1s; 2s wraps the ring several times.
+        self.schedule(2.0, "a")
+        self.advance(1.9)
+        self.assertEquals([], self.fired)
+        self.advance(0.1)
+        self.assertEquals(["a"], self.fired)
+
+
+    def test_lateTick(self):
+        self.schedule(0.2, "a")
+        self.schedule(5.0, "b")
+        self.clock.advance(3)
+        self.assertEquals(["a"], self.fired)
+        self.clock.advance(2)
+        self.assertEquals(["a", "b"], self.fired)
+
+
+
+class TimeoutsTest(TestCase):
+
+    def test_fromNumber(self):
+        timeouts = Timeouts.fromValue(5)
+        self.assertEquals(5, timeouts.connect)
+        self.assertEquals(5, timeouts.idle)
+        self.assertEquals(None, timeouts.total)
+
+
+    def test_fromDict(self):
+        timeouts = Timeouts.fromValue(dict(connect=1, total=30))
+        self.assertEquals(1, timeouts.connect)
+        self.assertEquals(None, timeouts.idle)
+        self.assertEquals(30, timeouts.total)
+
+
+    def test_adaptive(self):
+        self.assertTrue(isinstance(Timeouts.fromValue("adaptive"),
+                AdaptiveTimeouts))
+
+
+
+class AdaptiveTimeoutsTest(TestCase):
+
+    def setUp(self):
+        self.timeouts = AdaptiveTimeouts(quantile=0.9, multiplier=2,
+                floor=0.5, ceiling=10, minSamples=5).forOrigin("http://a")
+
+
+    def test_ceilingUntilLearned(self):
+        for i in xrange(4):
+            self.timeouts.recordFirstByte(0.1)
+        self.assertEquals(10, self.timeouts.firstByte)
+        self.assertEquals(10, self.timeouts.idle)
+
+
+    def test_quantile(self):
+        for i in xrange(1, 11):
+            self.timeouts.recordFirstByte(i / 10.0)
+        self.assertAlmostEqual(2.0, self.timeouts.firstByte)
+        self.assertEquals(10, self.timeouts.idle)
+
+        # The idle timeout is learned from gaps between reads.
+        for i in xrange(10, 0, -1):
+            self.timeouts.recordReadGap(i / 10.0)
+        self.assertAlmostEqual(2.0, self.timeouts.idle)
+        self.assertAlmostEqual(2.0, self.timeouts.firstByte)
+
+
+    def test_window(self):
+        self.timeouts = AdaptiveTimeouts(sampleSize=5, minSamples=5,
+                multiplier=1, floor=0, ceiling=100).forOrigin("http://a")
+        for seconds in (50, 40, 30, 20, 10, 1, 2, 3, 4, 5):
+            self.timeouts.recordFirstByte(seconds)
+        self.assertEquals(5, len(self.timeouts._firstByteTimes))
+        self.assertEquals(5, self.timeouts.firstByte)
+
+
+    def test_bounds(self):
+        for i in xrange(5):
+            self.timeouts.recordFirstByte(0.01)
+        self.assertEquals(0.5, self.timeouts.firstByte)
+        for i in xrange(5):
+            self.timeouts.recordFirstByte(60)
+        self.assertEquals(10, self.timeouts.firstByte)
+
+
+    def test_totalFor(self):
+        request = Request("http://a/")
+        for i in xrange(5):
+            self.timeouts.recordFirstByte(0.5)
+            self.timeouts.recordTransfer(1000, 1.0)
+        self.assertEquals(None, self.timeouts.totalFor(request))
+
+        request.expectedSize = 2000
+        self.assertAlmostEqual(5.0, self.timeouts.totalFor(request))
+
+        # Large transfers are not held to the per-read ceiling.
+        request.expectedSize = 100000
+        self.assertAlmostEqual(201.0, self.timeouts.totalFor(request))
+        self.timeouts.totalCeiling = 120
+        self.assertEquals(120, self.timeouts.totalFor(request))
+
+
+    def test_perOrigin(self):
+        other = self.timeouts.forOrigin("http://b")
+        self.assertIdentical(self.timeouts, other)
+
+        template = AdaptiveTimeouts()
+        a, b = template.forOrigin("http://a"), template.forOrigin("http://b")
+        for i in xrange(5):
+            a.recordFirstByte(30)
+        self.assertEquals(60, a.firstByte)
+        self.assertEquals(60, b.ceiling)
+        self.assertEquals(0, len(b._firstByteTimes))
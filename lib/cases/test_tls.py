@@ -0,0 +1,227 @@
+import os, shutil, socket, tempfile
+from select import select
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.resource import Resource
+
+from pendrell import agent as pendrell
+from pendrell.cases.util import PendrellTestMixin
+
+try:
+    from OpenSSL import SSL, crypto
+except ImportError:
+    SSL = None
+else:
+    from pendrell.cases.certs import ServerContextFactory, buildCertificate
+    from pendrell.tls import TLSContextCache, matchesHostname, sessionReused
+
+
+
+class _PathResource(Resource):
+    isLeaf = True
+
+    def render(self, request):
+        request.setHeader("Connection", "close")
+        return request.path
+
+
+
+class TLSTest(PendrellTestMixin, unittest.TestCase):
+    """Each response closes its connection, so each request handshakes."""
+
+    if SSL is None:
+        skip = "pyOpenSSL is not installed"
+
+    timeout = 10
+    _port = 9794
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.cert, self.key = buildCertificate()
+        self.caCertsFile = self.writeCertificate(self.cert)
+        self.agent = pendrell.Agent(caCertsFile=self.caCertsFile, timeout=5)
+        self.server = None
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        if self.server is not None:
+            yield self.server.stopListening()
+        shutil.rmtree(self.tempDir)
+
+
+    def writeCertificate(self, cert):
+        path = os.path.join(self.tempDir, "ca.pem")
+        with open(path, "w") as pem:
+            pem.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        return path
+
+
+    def listen(self, cert=None, **kw):
+        contextFactory = ServerContextFactory(cert or self.cert, self.key, **kw)
+        self.server = reactor.listenSSL(self._port, server.Site(_PathResource()),
+                contextFactory, interface="127.0.0.1")
+
+
+    def getPath(self, path, host="127.0.0.1"):
+        return self.getPage("https://%s:%d%s" % (host, self._port, path))
+
+
+    def getContextFactory(self, host="127.0.0.1"):
+        return self.agent.tlsContexts.getContextFactory(host, self._port)
+
+
+    @inlineCallbacks
+    def test_sessionResumed(self):
+        self.listen()
+        for path in ("/a", "/b", "/c"):
+            response = yield self.getPath(path)
+            self.assertEquals(path, response.content)
+
+        contextFactory = self.getContextFactory()
+        self.assertEquals(3, contextFactory.handshakes)
+        self.assertEquals(2, contextFactory.resumedHandshakes)
+        self.assertEquals(3, len(contextFactory.handshakeTimes))
+        self.assertEquals(1, len(self.agent.tlsContexts))
+        self.assertTrue(isinstance(contextFactory.getSession(), SSL.Session))
+
+
+    @inlineCallbacks
+    def test_sessionNotResumable(self):
+        self.listen(resumable=False)
+        yield self.getPath("/a")
+        yield self.getPath("/b")
+
+        contextFactory = self.getContextFactory()
+        self.assertEquals(2, contextFactory.handshakes)
+        self.assertEquals(0, contextFactory.resumedHandshakes)
+
+
+    @inlineCallbacks
+    def test_hostname(self):
+        self.listen()
+        response = yield self.getPath("/a", host="localhost")
+        self.assertEquals("/a", response.content)
+
+
+    def test_untrusted(self):
+        self.listen()
+        self.agent = pendrell.Agent(timeout=5)
+        return self.assertFailure(self.getPath("/a"), SSL.Error)
+
+
+    def test_wrongHost(self):
+        cert, self.key = buildCertificate("example.com",
+                altNames="DNS:example.com")
+        self.listen(cert)
+        self.agent = pendrell.Agent(caCertsFile=self.writeCertificate(cert),
+                timeout=5)
+        return self.assertFailure(self.getPath("/a"), SSL.Error)
+
+
+    @inlineCallbacks
+    def test_unverified(self):
+        cert, self.key = buildCertificate("example.com", altNames=None)
+        self.listen(cert)
+        self.agent = pendrell.Agent(verifyCertificates=False, timeout=5)
+        response = yield self.getPath("/a")
+        self.assertEquals("/a", response.content)
+
+
+
+class _KeepAliveResource(Resource):
+    isLeaf = True
+
+    def render(self, request):
+        self.channel = request.channel
+        return request.path
+
+
+
+class TLSStaleTest(PendrellTestMixin, unittest.TestCase):
+    """Idle TLS connections are peeked at through TLS."""
+
+    if SSL is None:
+        skip = "pyOpenSSL is not installed"
+
+    timeout = 10
+    _port = 9793
+
+    def setUp(self):
+        self.agent = pendrell.Agent(verifyCertificates=False, timeout=5)
+        cert, key = buildCertificate()
+        self.resource = _KeepAliveResource()
+        self.server = reactor.listenSSL(self._port,
+                server.Site(self.resource), ServerContextFactory(cert, key),
+                interface="127.0.0.1")
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield PendrellTestMixin.tearDown(self)
+        yield self.server.stopListening()
+
+
+    @inlineCallbacks
+    def test_staleConnection(self):
+        yield self.getPage("https://127.0.0.1:%d/a" % self._port)
+        yield deferLater(reactor, 0.5, lambda: None)
+
+        multiplexer, = self.agent._requesterCache.values()
+        requester, = multiplexer._requesters
+        protocol = requester._currentProtocol
+        self.assertFalse(protocol._isStale())
+
+        # The server closes the connection before the reactor notices.
+        self.resource.channel.transport.socket.sock_shutdown(socket.SHUT_RDWR)
+        select([protocol.transport.getHandle()], [], [], 1)
+        self.assertTrue(protocol._isStale())
+
+
+
+class TLSContextCacheTest(unittest.TestCase):
+
+    if SSL is None:
+        skip = "pyOpenSSL is not installed"
+
+    def test_sharedPerOrigin(self):
+        cache = TLSContextCache()
+        contextFactory = cache.getContextFactory("example.com", 443)
+        self.assertIdentical(contextFactory,
+                cache.getContextFactory("example.com", 443))
+        self.assertIdentical(contextFactory.getContext(),
+                contextFactory.getContext())
+
+        self.assertNotIdentical(contextFactory,
+                cache.getContextFactory("example.com", 8443))
+        self.assertNotIdentical(contextFactory,
+                cache.getContextFactory("example.com", 443, ["h2"]))
+        self.assertEquals(3, len(cache))
+
+
+    def test_sessionReusedUnknown(self):
+        connection = SSL.Connection(SSL.Context(SSL.SSLv23_METHOD))
+        self.assertEquals(False, sessionReused(connection))
+        del connection._ssl
+        self.assertEquals(None, sessionReused(connection))
+
+
+    def test_matchesHostname(self):
+        cert, key = buildCertificate("ignored.com",
+                altNames="DNS:*.example.com, DNS:example.org, IP:10.0.0.1")
+        self.assertTrue(matchesHostname(cert, "www.example.com"))
+        self.assertTrue(matchesHostname(cert, "EXAMPLE.org"))
+        self.assertTrue(matchesHostname(cert, "10.0.0.1"))
+        self.assertFalse(matchesHostname(cert, "example.com"))
+        self.assertFalse(matchesHostname(cert, "a.b.example.com"))
+        self.assertFalse(matchesHostname(cert, "ignored.com"))
+        self.assertFalse(matchesHostname(cert, "10.0.0.2"))
+
+
+    def test_matchesCommonName(self):
+        cert, key = buildCertificate("example.com", altNames=None)
+        self.assertTrue(matchesHostname(cert, "example.com"))
+        self.assertFalse(matchesHostname(cert, "www.example.com"))
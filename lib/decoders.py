@@ -5,12 +5,17 @@ import gzip, zlib
 from twisted.python import urlpath, util
 
 from pendrell import log
+from pendrell.error import MalformedResponse
 from pendrell.util import CRLF
 
 
 
 def getIncrementalDecoder(encoding):
-    if encoding == "chunked":
+    encoding = encoding.strip().lower()
+    if encoding == "identity":
+        decoder = None
+
+    elif encoding == "chunked":
         decoder = ChunkingIncrementalDecoder
 
     elif encoding == "deflate":
@@ -20,7 +25,11 @@ def getIncrementalDecoder(encoding):
         decoder = GzipIncrementalDecoder
 
     else:
-        decoder = codecs.getincrementaldecoder(encoding)
+        try:
+            decoder = _getincrementaldecoder(encoding)
+        except LookupError:
+            log.debug("Unknown coding: %r" % encoding)
+            decoder = None
 
     return decoder
 
@@ -41,6 +50,36 @@ def loadDecoders(encodings):
 
 
 
+class DecodePipeline(object):
+    """Undoes a body's codings, decoder by decoder, as each read arrives.
+
+    Built once per response, when its headers have all arrived.  A body
+    without codings is passed through untouched.
+    """
+
+    def __init__(self, decoders=()):
+        self.decoders = tuple(decoders)
+        if not self.decoders:
+            self.decode = self._identity
+
+
+    @property
+    def identity(self):
+        return not self.decoders
+
+
+    def decode(self, data, final=False):
+        for decoder in self.decoders:
+            data = decoder.decode(data, final)
+        return data
+
+
+    @staticmethod
+    def _identity(data, final=False):
+        return data
+
+
+
 _ZlibIncrementalDecoder = _getincrementaldecoder("zlib")
 
 class ZlibIncrementalDecoder(_ZlibIncrementalDecoder):
@@ -262,134 +301,128 @@ class GzipIncrementalDecoder(ZlibIncrementalDecoder):
 
 
 class ChunkingIncrementalDecoder(object):
+    """Decodes the chunked transfer-coding as it arrives.
 
-    def __init__(self):
-        self._buffer = str()
-        self._chunkCount = long()
-        self._chunk = None
-        self._decodedLength = long()
+    Chunk data is returned as soon as it is read, so a large chunk is never
+    held whole: only a partial chunk-size or trailer line is buffered.
+    Chunk extensions are ignored; trailer fields are kept, as (name, value)
+    pairs, in trailers.  Malformed input raises MalformedResponse.
+    """
 
-        self.finished = False
+    maxLineSize = 64 * 1024  # Of a chunk-size or trailer line
+
+    # States
+    _SIZE, _DATA, _DATA_END, _TRAILER, _DONE = range(5)
+
+
+    def __init__(self):
+        self.reset()
 
 
     def reset(self):
-        self._buffer = str()
+        self._state = self._SIZE
+        self._line = str()  # A partial line
+        self._remaining = 0  # Bytes of the current chunk yet to be read
+        self._extra = str()
         self._chunkCount = long()
-        self._chunk = None
         self._decodedLength = long()
+        self.trailers = list()
 
         self.finished = False
 
 
     def decode(self, raw, endChunking=False):
-        self._buffer += raw
-
-        content = str()
-        chunking = True
-        while chunking:
-            try:
-                chunk, raw = _Chunk.fromString(self._buffer)
-
-            except _IncompleteChunk:
-                chunking = False
-
-            else:
-                assert chunk.length >= 0
-
-                if chunk.length == 0:
-                    chunking = False
-                    endChunking = True
-
+        content = list()
+        pos, end = 0, len(raw)
+        state, remaining = self._state, self._remaining
+        while pos < end and state != self._DONE:
+            if state == self._DATA:
+                stop = pos + remaining
+                if stop > end:
+                    content.append(raw[pos:])
+                    remaining = stop - end
+                    pos = end
+                    break
+                content.append(raw[pos:stop])
+                pos, remaining = stop, 0
+                if raw.startswith(CRLF, pos):
+                    pos += 2
+                    state = self._SIZE
                 else:
-                    content += chunk.content
-                    self._decodedLength += chunk.length
+                    state = self._DATA_END
+                continue
+
+            eol = raw.find("\n", pos)
+            if eol < 0 or self._line:
+                line, pos = self._readLine(raw, pos, eol)
+                if line is None:
+                    break
+            else:
+                line, pos = raw[pos:eol].rstrip("\r"), eol + 1
 
-                self._buffer = raw
+            if state == self._SIZE:
+                remaining = self._parseSize(line)
                 self._chunkCount += 1
+                state = remaining and self._DATA or self._TRAILER
+            elif state == self._DATA_END:
+                if line:
+                    raise MalformedResponse(
+                            "Chunk data not followed by CRLF: %r" % line)
+                state = self._SIZE
+            elif line:
+                self._gotTrailer(line)
+            else:
+                state = self._DONE
+        self._state, self._remaining = state, remaining
 
+        if state == self._DONE:
+            self._extra = raw[pos:]
+            endChunking = True
         self.finished = endChunking
 
+        content = str().join(content)
+        self._decodedLength += len(content)
         return content
 
 
     def getExtra(self):
+        """The data that followed the last chunk, once finished."""
         if self.finished:
-            return self._buffer
-
-
-
-class _IncompleteChunk(Exception):
-    pass
-
-
-class _Chunk(object):
-
-    def __init__(self, length, content):
-        if len(content) != length:
-            raise ValueError("Content %r is not %dB" % (content, length))
-        self.length = long(length)
-        self.content = content
+            return self._extra
 
 
-    @classmethod
-    def fromString(klass, raw):
-        length, raw = klass._parseChunkLength(raw)
-        content, raw = klass._parseChunk(length, raw)
-        chunk = klass(length, content)
-        return chunk, raw
-
-
-    @classmethod
-    def _parseChunkLength(klass, raw):
+    def _readLine(self, raw, pos, eol):
+        """Returns (line, pos): a line without its line-end (or None if it
+        has not all arrived) and the position after it.  eol is the position
+        of the line-end, or -1.
         """
-        Returns:
-            The chunk length as parsed.
-        Postconditions:
-            self._chunkLength is set to number of bytes to be read for this
-            chunk, including the trailing CRLF.
-        """
-        hexLen, crlf, raw = raw.partition(CRLF)
-
-        if not (len(hexLen) > 0 and crlf == CRLF):
-            raise _IncompleteChunk(raw)
+        if eol < 0:
+            self._line += raw[pos:]
+            if len(self._line) > self.maxLineSize:
+                raise MalformedResponse("Chunk line exceeds %d bytes" % (
+                        self.maxLineSize))
+            return None, len(raw)
 
-        # The buffer contains a hex-encoded chunk length followed by CRLF.
-        try:
-            length = int(hexLen, 16)
+        line, self._line = self._line + raw[pos:eol], str()
+        return line.rstrip("\r"), eol + 1
 
-        except TypeError:
-            raise ValueError("No chunk length specified: %r" % hexLen)
-
-        if length < 0:
-            raise ValueError("%r is not a positive integer" % (length))
-
-        return length, raw
 
+    @staticmethod
+    def _parseSize(line):
+        hexSize = line.partition(";")[0].strip()  # Ignore extensions
+        if not hexSize or hexSize.strip(_HEXDIGITS):
+            raise MalformedResponse("Bad chunk size: %r" % line)
+        return int(hexSize, 16)
 
-    @classmethod
-    def _parseChunk(klass, length, raw):
-        """
-        Preconditions:
-            self._chunkLength is set to number of bytes still to be read for
-            this chunk.
-        Returns:
-            A 2-tuple (data, rawData) of strings, where 'data' is chunk-data and
-            'rawData' is any data trailing the parsed data.  Either item may be
-            an empty string.
-        Postconditions:
-            self._chunkLength is set to number of bytes still to be read for
-            this chunk (and therefore may be 0).
-        """
-        if len(raw) < length + len(CRLF):
-            raise _IncompleteChunk(length, raw)
 
-        # The buffer contains the end of the current chunk, so parse the
-        # chunk until the trailing CRLF and buffer the remaining data.
-        chunk = raw[:length]
+    def _gotTrailer(self, line):
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise MalformedResponse("Bad trailer: %r" % line)
+        self.trailers.append((name.strip(), value.strip()))
 
-        raw = raw[length+len(CRLF):]
 
-        return chunk, raw
+_HEXDIGITS = "0123456789abcdefABCDEF"
 
 
 __id__ = """$Id: agent.py 84 2010-06-01 16:01:45Z ver $"""[5:-2]
@@ -114,6 +114,34 @@ class RetryResponse(WebError):
 
 
 
+class StreamReset(Exception, FailableMixin):
+    """An HTTP/2 stream was reset before its response completed."""
+
+    def __init__(self, request, errorCode):
+        Exception.__init__(self, request, errorCode)
+        self.request = request
+        self.errorCode = errorCode
+
+    def __str__(self):
+        return "Stream reset (error %d): %s" % (self.errorCode, self.request)
+
+
+
+class IncompleteRequest(Exception, FailableMixin):
+    """A request body's producer did not produce its declared length."""
+
+
+
+class MalformedResponse(Exception, FailableMixin):
+    """A response's status line or headers could not be parsed."""
+
+
+
+class HeadersTooLarge(MalformedResponse):
+    """A response's headers exceeded the protocol's limits."""
+
+
+
 class InsecureAuthentication(Exception):
     def __init__(self, response, authenticator):
         Exception.__init__(self, response, authenticator)
@@ -0,0 +1,359 @@
+"""Happy Eyeballs (RFC 8305) connections.
+
+A host's addresses are tried in turn, each attempt started attemptDelay
+seconds after the last (or as soon as it fails), so that a blackholed
+address or a broken address family costs a fraction of a second rather than
+a connect timeout.  The first attempt to connect wins; the rest are
+cancelled.
+"""
+
+import socket
+
+from twisted.internet import address, base, error, tcp
+from twisted.python import failure
+
+from pendrell import log
+from pendrell.resolver import getResolver
+
+
+
+class AddressPreferences(object):
+    """Remembers the address (and so the family) each host was last
+    connected to.
+    """
+
+    # RFC 8305 prefers IPv6 until it has been seen not to work.
+    defaultFamily = socket.AF_INET6
+
+    def __init__(self):
+        self._connected = dict()  # Host => (family, address)
+
+
+    def connected(self, host, family, address):
+        self._connected[host] = (family, address)
+
+
+    def getPreferred(self, host):
+        """The (family, address) that host last connected to, or None."""
+        return self._connected.get(host)
+
+
+    def order(self, host, addresses):
+        """Order addresses to be attempted.
+
+        Families alternate, starting with the family that last connected
+        (and the address that did, if it is still among addresses).
+        """
+        preferred = self._connected.get(host)
+        firstFamily = preferred and preferred[0] or self.defaultFamily
+
+        byFamily = dict()
+        families = list()
+        for family, addr in addresses:
+            if family not in byFamily:
+                byFamily[family] = list()
+                families.append(family)
+            byFamily[family].append((family, addr))
+
+        if firstFamily in families:
+            families.remove(firstFamily)
+            families.insert(0, firstFamily)
+        if preferred in byFamily.get(firstFamily, ()):
+            byFamily[firstFamily].remove(preferred)
+            byFamily[firstFamily].insert(0, preferred)
+
+        ordered = list()
+        while any(byFamily.values()):
+            for family in families:
+                if byFamily[family]:
+                    ordered.append(byFamily[family].pop(0))
+        return ordered
+
+
+
+class HappyEyeballsConnector(base.BaseConnector):
+    """Connects a factory to a host by racing connection attempts.
+
+    While connecting, the connector's transport is a _Race of attempts.
+    """
+
+    def __init__(self, eyeballs, host, port, factory, timeout,
+                 bindAddress=None, contextFactory=None):
+        self.eyeballs = eyeballs
+        self.host, self.port = host, port
+        self.bindAddress = bindAddress
+        self.contextFactory = contextFactory
+        base.BaseConnector.__init__(self, factory, timeout, eyeballs.reactor)
+
+
+    def _makeTransport(self):
+        return _Race(self)
+
+
+    def getDestination(self):
+        return address.IPv4Address("TCP", self.host, self.port)
+
+
+    def buildClient(self, family, addr, attempt):
+        """A transport connecting to addr, on behalf of attempt."""
+        if self.contextFactory is None:
+            clientClass = _TCP6Client if family == socket.AF_INET6 \
+                    else tcp.Client
+            client = clientClass(addr, self.port, self.bindAddress, attempt,
+                    self.reactor)
+        else:
+            clientClass = _getSSLClientClass(family)
+            client = clientClass(addr, self.port, self.bindAddress,
+                    self.contextFactory, attempt, self.reactor)
+        self._prepareSocket(client)
+        return client
+
+
+    def _prepareSocket(self, client):
+        # The client connects once the reactor next runs.
+        profile = getattr(self.factory, "socketProfile", None)
+        sock = getattr(client, "socket", None)
+        if profile is not None and sock is not None:
+            profile.beforeConnect(sock)
+
+
+
+class HappyEyeballs(object):
+    """Connects to the first of a host's addresses to accept a connection.
+
+    Provides the reactor's connectTCP and connectSSL.
+
+    Keyword Arguments:
+        resolver --  Provides getAddresses(host), e.g. a
+                     pendrell.resolver.CachingResolver [default: the shared
+                     CachingResolver]
+        attemptDelay --  Seconds between starting attempts [default: 0.25]
+        reactor --  [default: twisted.internet.reactor]
+    """
+
+    connectorClass = HappyEyeballsConnector
+
+    def __init__(self, resolver=None, attemptDelay=0.25, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        if resolver is None:
+            resolver = getResolver()
+        self.resolver = resolver
+        self.attemptDelay = attemptDelay
+        self.reactor = reactor
+        self.preferences = AddressPreferences()
+
+
+    def connectTCP(self, host, port, factory, timeout=30, bindAddress=None):
+        connector = self.connectorClass(self, host, port, factory,
+                timeout, bindAddress)
+        connector.connect()
+        return connector
+
+
+    def connectSSL(self, host, port, factory, contextFactory, timeout=30,
+                   bindAddress=None):
+        connector = self.connectorClass(self, host, port, factory,
+                timeout, bindAddress, contextFactory)
+        connector.connect()
+        return connector
+
+
+
+_happyEyeballs = None
+
+def getHappyEyeballs():
+    """The HappyEyeballs shared by requesters not given a dialer."""
+    global _happyEyeballs
+    if _happyEyeballs is None:
+        _happyEyeballs = HappyEyeballs()
+    return _happyEyeballs
+
+
+
+class _Race(object):
+    """Attempts to connect to each of a host's addresses in turn."""
+
+    def __init__(self, connector):
+        self.connector = connector
+        self.eyeballs = connector.eyeballs
+        self.host = connector.host
+
+        self._addresses = None  # Not yet attempted
+        self._attempts = list()  # In progress
+        self._nextAttempt = None  # DelayedCall
+        self._failure = None  # Of the most recent attempt
+        self._winner = None
+        self._done = False
+
+        self.eyeballs.reactor.callLater(0, self._resolve)
+
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, self.host)
+
+
+    def _resolve(self):
+        if self._done:
+            return
+        d = self.eyeballs.resolver.getAddresses(self.host)
+        d.addCallbacks(self._resolved, self._resolutionFailed)
+
+
+    def _resolved(self, addresses):
+        if self._done:
+            return
+        self._addresses = self.eyeballs.preferences.order(self.host,
+                addresses)
+        if not self._addresses:
+            self.failIfNotConnected(error.DNSLookupError(self.host))
+        else:
+            self._attemptNext()
+
+
+    def _resolutionFailed(self, reason):
+        self.failIfNotConnected(error.DNSLookupError(
+                "%s: %s" % (self.host, reason.getErrorMessage())))
+
+
+    def _attemptNext(self):
+        self._cancelNextAttempt()
+        family, addr = self._addresses.pop(0)
+
+        attempt = _Attempt(self, family, addr)
+        self._attempts.append(attempt)
+        attempt.client = self.connector.buildClient(family, addr, attempt)
+
+        if self._addresses and not self._done:
+            self._nextAttempt = self.eyeballs.reactor.callLater(
+                    self.eyeballs.attemptDelay, self._attemptNext)
+
+
+    def _cancelNextAttempt(self):
+        if self._nextAttempt is not None:
+            if self._nextAttempt.active():
+                self._nextAttempt.cancel()
+            self._nextAttempt = None
+
+
+    def attemptConnected(self, attempt, addr):
+        """The first attempt to connect wins."""
+        self._done = True
+        self._winner = attempt
+        self._cancelNextAttempt()
+        self._attempts.remove(attempt)
+        self._cancelAttempts()
+
+        self.eyeballs.preferences.connected(self.host, attempt.family,
+                attempt.address)
+        return self.connector.buildProtocol(addr)
+
+
+    def attemptFailed(self, attempt, reason):
+        if attempt in self._attempts:
+            self._attempts.remove(attempt)
+        if self._done:
+            return
+
+        log.debug("%r: %s failed: %s" % (self, attempt.address,
+                reason.getErrorMessage()))
+        self._failure = reason
+        if self._addresses:
+            self._attemptNext()
+        elif not self._attempts:
+            self._done = True
+            self.connector.connectionFailed(self._failure)
+
+
+    def _cancelAttempts(self):
+        attempts, self._attempts = self._attempts, list()
+        for attempt in attempts:
+            attempt.client.failIfNotConnected(error.UserError())
+
+
+    def failIfNotConnected(self, err):
+        """Give up on every attempt."""
+        if self._done:
+            return
+        self._done = True
+        self._cancelNextAttempt()
+        self._cancelAttempts()
+        self.connector.connectionFailed(failure.Failure(err))
+
+
+    def loseConnection(self):
+        if self._winner is not None:
+            self._winner.client.loseConnection()
+
+
+    def connectionLost(self, reason):
+        self.connector.connectionLost(reason)
+
+
+
+class _Attempt(object):
+    """Stands in for the connector of one attempt's transport."""
+
+    def __init__(self, race, family, address):
+        self.race = race
+        self.family = family
+        self.address = address
+        self.client = None
+
+
+    def buildProtocol(self, addr):
+        return self.race.attemptConnected(self, addr)
+
+
+    def connectionFailed(self, reason):
+        self.race.attemptFailed(self, reason)
+
+
+    def connectionLost(self, reason):
+        self.race.connectionLost(reason)
+
+
+
+class _IPv6ClientMixin:
+    """Connects over IPv6, which twisted.internet.tcp does not."""
+
+    addressFamily = socket.AF_INET6
+
+    def resolveAddress(self):
+        # Already resolved.
+        self._setRealAddress(self.addr[0])
+
+
+    def getHost(self):
+        host, port = self.socket.getsockname()[:2]
+        return address.IPv4Address("TCP", host, port)
+
+
+    def getPeer(self):
+        host, port = self.realAddress[:2]
+        return address.IPv4Address("TCP", host, port)
+
+
+
+class _TCP6Client(_IPv6ClientMixin, tcp.Client):
+    pass
+
+
+
+_sslClientClasses = dict()
+
+def _getSSLClientClass(family):
+    # twisted.internet.ssl requires pyOpenSSL.
+    if family not in _sslClientClasses:
+        from twisted.internet import ssl
+        if family == socket.AF_INET6:
+            _sslClientClasses[family] = type("_SSL6Client",
+                    (_IPv6ClientMixin, ssl.Client), {})
+        else:
+            _sslClientClasses[family] = ssl.Client
+    return _sslClientClasses[family]
+
+
+
+
+__id__ = "$Id: $"[5:-2]
@@ -0,0 +1,665 @@
+"""HTTP/2 requester.
+
+Requests to one origin are issued as concurrent streams over a single
+connection.  Requires the h2 package.
+"""
+
+from twisted.internet import error as netErr, protocol, reactor
+from twisted.internet.defer import (Deferred, DeferredList, succeed,
+        inlineCallbacks)
+from twisted.python.failure import Failure
+from twisted.web import http
+from zope.interface import implements
+
+from pendrell import log
+from pendrell.error import IncompleteRequest, ResponseTimeout, StreamReset
+from pendrell.protocols import ResponseHandlerMixin
+from pendrell.requester import (IRequester, Multiplexer, RequesterBase,
+        HTTPSRequester)
+from pendrell.sockets import SocketProfile, getTransportSocket
+from pendrell.timeouts import Timeouts, getTimerWheel
+
+try:
+    from h2.config import H2Configuration
+    from h2.connection import H2Connection
+    from h2.errors import ErrorCodes
+    from h2 import events as h2Events
+except ImportError:
+    H2Connection = None
+
+
+
+class HTTP2Protocol(protocol.Protocol, ResponseHandlerMixin):
+    """Multiplexes requests as streams over an HTTP/2 connection.
+
+    Response data is acknowledged, reopening the flow-control window, as it
+    is handed to the response.  Request bodies are sent as the server's
+    flow-control windows allow.
+    """
+
+    # HTTP/1.1 connection-specific headers are not allowed in HTTP/2, nor
+    # is Expect, since bodies are not withheld for a 100 Continue.
+    excludedHeaders = frozenset(("connection", "expect", "host", "keep-alive",
+            "proxy-connection", "te", "transfer-encoding", "upgrade"))
+
+    timeouts = Timeouts()
+    wheel = None
+    socketProfile = SocketProfile()
+
+    def __init__(self):
+        self._connected = False
+        self._ready = None  # Fires once h2 has been negotiated
+        self._closing = False  # The server sent GOAWAY
+        self._streams = dict()  # Stream ID => Response
+        self._outbound = dict()  # Stream ID => _OutboundBody
+        self._slot = None  # Deferred waiting for a stream to be available
+        self._timers = dict()  # (Stream ID, phase) => Timer
+        self._readTimer = None
+
+        self.timedOut = False
+        self.timeOut = None
+        self._handshakeStarted = None
+        self.handshakeTime = None
+        self._quickAckSocket = None
+
+
+    def __repr__(self):
+        netLoc = "%s://%s:%d" % (self.scheme, self.host, self.port)
+        return "<%s: %s>" % (self.__class__.__name__, netLoc)
+
+
+    @property
+    def contentReceived(self):
+        """The number of content bytes received for open streams."""
+        return sum(len(response) for response in self._streams.itervalues())
+
+
+    def connectionMade(self):
+        self._connected = True
+        if self.wheel is None:
+            self.wheel = getTimerWheel()
+        sock = getTransportSocket(self.transport)
+        if sock is not None and self.socketProfile.connected(sock) \
+                and self.socketProfile.quickAck is not None:
+            self._quickAckSocket = sock
+
+        if self.factory.secure:
+            # Wait for ALPN.  Writing the preface starts the handshake.
+            self._ready = Deferred()
+            handle = self.transport.getHandle()
+            handle.set_app_data(self)
+            self.factory.contextFactory.prepareConnection(handle)
+            self._handshakeStarted = self.wheel.seconds()
+        else:
+            self._ready = succeed(True)  # Prior knowledge
+
+        self._h2 = H2Connection(H2Configuration(client_side=True))
+        self._h2.initiate_connection()
+        self._flush()
+
+        self.sendRequests()
+
+
+    def handshakeDone(self):
+        if self.handshakeTime is None:
+            self.handshakeTime = self.wheel.seconds() - self._handshakeStarted
+        # Called from within OpenSSL; check once it has returned.
+        reactor.callLater(0, self._checkNegotiated)
+
+
+    def _checkNegotiated(self):
+        """True once the server has agreed to speak h2."""
+        if self._ready is None:
+            return False  # Declined
+        elif self._ready.called or not self._connected:
+            return self._ready.called
+
+        negotiated = self.transport.getHandle().get_alpn_proto_negotiated()
+        if negotiated == "h2":
+            self._ready.callback(True)
+            return True
+
+        log.debug("%r: server negotiated %r" % (self, negotiated))
+        ready, self._ready = self._ready, None
+        self.factory.negotiationFailed()
+        self.transport.loseConnection()
+        ready.callback(False)
+        return False
+
+
+    def connectionLost(self, reason):
+        self._connected = False
+        self._cancelReadTimer()
+
+        replays, ended = list(), list()
+        for streamId, response in sorted(self._streams.items()):
+            self._cancelStreamTimers(streamId)
+            request = response.request
+            if (not self.timedOut and not response.hasStatus
+                    and request.idempotent and request.bodyReplayable
+                    and request.replayCount < self.factory.maxReplays):
+                request.replayCount += 1
+                replays.append(request)
+            else:
+                ended.append(response)
+        self._streams.clear()
+        for body in self._outbound.values():
+            body.stop()
+        self._outbound.clear()
+
+        if replays:
+            self.factory.replayRequests(replays)
+
+        self._releaseSlot(False)
+        if self._ready is not None and not self._ready.called:
+            self._ready.callback(False)
+
+        # Last: callers may issue further requests.
+        for response in ended:
+            if self.timedOut:
+                self.handleResponse(response)
+            else:
+                response.request.response.errback(reason)
+
+
+    def timeoutConnection(self, timeout=None):
+        self.timedOut = True
+        self.timeOut = timeout
+        self.transport.loseConnection()
+
+
+    def _flush(self):
+        data = self._h2.data_to_send()
+        if data:
+            self.transport.write(data)
+
+
+    #
+    # Sending requests
+    #
+
+    @inlineCallbacks
+    def sendRequests(self):
+        connected = yield self._ready
+
+        while connected:
+            try:
+                request = yield self.factory.getNextRequest()
+                if not self._connected or self._closing:
+                    # Issue it on a new connection.
+                    self.factory.replayRequests([request])
+                    connected = False
+                    continue
+
+                connected = yield self._waitForStream()
+                if connected:
+                    self.sendRequest(request)
+                else:
+                    self.factory.replayRequests([request])
+
+            except (netErr.ConnectionLost, netErr.ConnectionDone):
+                connected = False
+
+
+    def _canOpenStream(self):
+        return (self._h2.open_outbound_streams
+                < self._h2.remote_settings.max_concurrent_streams)
+
+
+    def _waitForStream(self):
+        assert self._slot is None
+        if self._canOpenStream():
+            return succeed(True)
+        d = self._slot = Deferred()
+        return d
+
+
+    def _releaseSlot(self, available=True):
+        if self._slot is not None and (not available or self._canOpenStream()):
+            d, self._slot = self._slot, None
+            d.callback(available)
+
+
+    def sendRequest(self, request):
+        request.prepareHeaders()
+
+        streamId = self._h2.get_next_available_stream_id()
+        self._h2.send_headers(streamId, self._buildHeaders(request),
+                end_stream=not request.hasBody)
+        self._streams[streamId] = request.buildResponse()
+        if request.bodyProducer is not None:
+            # The server is timed once the body has been sent.
+            self._produceBody(streamId, request)
+        else:
+            if request.hasBody:
+                self._outbound[streamId] = _OutboundBody(self, streamId,
+                        request.data)
+                self._sendBody(streamId)
+            self._startStreamTimer(streamId, "firstByte",
+                    self.timeouts.firstByte)
+        self._flush()
+
+        self._startStreamTimer(streamId, "total",
+                self.timeouts.totalFor(request))
+        if self._readTimer is None and self.timeouts.idle is not None:
+            self._readTimer = self.wheel.schedule(self.timeouts.idle,
+                    self._readTimedOut)
+
+
+    def _buildHeaders(self, request):
+        url = request.url
+        path = url.path
+        if url.query:
+            path += "?" + url.query
+
+        headers = [
+            (":method", request.method),
+            (":scheme", request.scheme),
+            (":authority", request.url.netloc),
+            (":path", path),
+            ]
+        for name, value in request.iterHeaders():
+            name = name.lower()
+            if name not in self.excludedHeaders:
+                headers.append((name, str(value)))
+        return headers
+
+
+    def _sendBody(self, streamId):
+        """Send as much of a request body as flow control allows.
+
+        A body's producer is paused while flow control holds back what it
+        has produced.
+        """
+        body = self._outbound[streamId]
+        while body.data:
+            size = min(len(body.data), self._h2.max_outbound_frame_size,
+                    self._h2.local_flow_control_window(streamId))
+            if size <= 0:
+                break
+            chunk, body.data = body.data[:size], body.data[size:]
+            self._h2.send_data(streamId, chunk,
+                    end_stream=body.finished and not body.data)
+
+        if body.finished and not body.data:
+            del self._outbound[streamId]
+        else:
+            body.throttle()
+
+
+    def _produceBody(self, streamId, request):
+        body = self._outbound[streamId] = _OutboundBody(self, streamId,
+                producer=request.bodyProducer)
+        d = request.bodyProducer.startProducing(body)
+        d.addCallbacks(self._finishedProducing, self._producingFailed,
+                callbackArgs=(streamId, request, body),
+                errbackArgs=(streamId, request, body))
+
+
+    def _finishedProducing(self, _, streamId, request, body):
+        if self._outbound.get(streamId) is not body:
+            return  # The stream has closed.
+
+        length = request.bodyLength
+        if length is not None and body.length != length:
+            return self._producingFailed(Failure(IncompleteRequest(
+                    "Sent %d of %d body bytes" % (body.length, length))),
+                    streamId, request, body)
+
+        body.finished = True
+        if body.data:
+            self._sendBody(streamId)
+        else:
+            del self._outbound[streamId]
+            self._h2.end_stream(streamId)
+        self._flush()
+        self._startStreamTimer(streamId, "firstByte",
+                self.timeouts.firstByte)
+
+
+    def _producingFailed(self, reason, streamId, request, body):
+        if self._outbound.get(streamId) is not body:
+            return
+        log.debug("%r: sending the body of %r failed: %s" % (self, request,
+                reason.getErrorMessage()))
+        del self._outbound[streamId]
+        if self._streams.pop(streamId, None) is not None:
+            self._h2.reset_stream(streamId, ErrorCodes.CANCEL)
+            self._flush()
+            self._streamClosed(streamId)
+            request.response.errback(reason)
+        else:
+            self._streamClosed(streamId)
+
+
+    #
+    # Receiving responses
+    #
+
+    def dataReceived(self, data):
+        if self._quickAckSocket is not None:
+            self.socketProfile.readFrom(self._quickAckSocket)
+        if self.factory.secure and not self._checkNegotiated():
+            return
+
+        if self._readTimer is not None:
+            self._readTimer.reset(self.timeouts.idle)
+
+        try:
+            events = self._h2.receive_data(data)
+        except Exception:
+            log.err()
+            self.transport.loseConnection()
+            return
+
+        for event in events:
+            handler = self._eventHandlers.get(event.__class__)
+            if handler:
+                handler(self, event)
+        self._flush()
+
+
+    def _responseReceived(self, event):
+        response = self._streams.get(event.stream_id)
+        if response is None:
+            return
+        self._cancelStreamTimer(event.stream_id, "firstByte")
+
+        headers = list()
+        for name, value in event.headers:
+            if name == ":status":
+                status = int(value)
+            else:
+                headers.append((name, value))
+
+        response.gotStatus("HTTP/2", status, http.RESPONSES.get(status, ""))
+        for name, value in headers:
+            response.gotHeader(name, value)
+
+
+    def _trailersReceived(self, event):
+        response = self._streams.get(event.stream_id)
+        if response is not None:
+            for name, value in event.headers:
+                response.gotHeader(name, value)
+
+
+    def _dataReceived(self, event):
+        response = self._streams.get(event.stream_id)
+        if response is not None:
+            response.dataReceived(event.data)
+        self._h2.acknowledge_received_data(event.flow_controlled_length,
+                event.stream_id)
+
+
+    def _streamEnded(self, event):
+        response = self._streams.pop(event.stream_id, None)
+        self._streamClosed(event.stream_id)
+        if response is not None:
+            response.done()
+            self.handleResponse(response)
+
+
+    def _streamReset(self, event):
+        response = self._streams.pop(event.stream_id, None)
+        self._streamClosed(event.stream_id)
+        if response is not None:
+            request = response.request
+            if (event.error_code == ErrorCodes.REFUSED_STREAM
+                    and request.bodyReplayable
+                    and request.replayCount < self.factory.maxReplays):
+                # Not processed by the server.
+                request.replayCount += 1
+                self.factory.replayRequests([request])
+            else:
+                request.response.errback(
+                        StreamReset.Failure(request, event.error_code))
+
+
+    def _windowUpdated(self, event):
+        if event.stream_id:
+            streamIds = [event.stream_id]
+        else:
+            streamIds = self._outbound.keys()
+        for streamId in streamIds:
+            if streamId in self._outbound:
+                self._sendBody(streamId)
+
+
+    def _connectionTerminated(self, event):
+        """The server sent GOAWAY.
+
+        Streams it did not process are issued again on a new connection;
+        the rest are allowed to complete.
+        """
+        self._closing = True
+        replays, refused = list(), list()
+        for streamId in sorted(self._streams):
+            if streamId > event.last_stream_id:
+                response = self._streams.pop(streamId)
+                self._cancelStreamTimers(streamId)
+                body = self._outbound.pop(streamId, None)
+                if body is not None:
+                    body.stop()
+                if response.request.bodyReplayable:
+                    replays.append(response.request)
+                else:
+                    refused.append(response.request)
+        if replays:
+            self.factory.replayRequests(replays)
+        self._releaseSlot(False)
+        if not self._streams:
+            self.transport.loseConnection()
+        for request in refused:
+            request.response.errback(StreamReset.Failure(request,
+                    ErrorCodes.REFUSED_STREAM))
+
+
+    def _settingsChanged(self, event):
+        self._releaseSlot()
+
+
+    _eventHandlers = dict()
+    if H2Connection is not None:
+        _eventHandlers = {
+            h2Events.ResponseReceived: _responseReceived,
+            h2Events.TrailersReceived: _trailersReceived,
+            h2Events.DataReceived: _dataReceived,
+            h2Events.StreamEnded: _streamEnded,
+            h2Events.StreamReset: _streamReset,
+            h2Events.WindowUpdated: _windowUpdated,
+            h2Events.ConnectionTerminated: _connectionTerminated,
+            h2Events.RemoteSettingsChanged: _settingsChanged,
+            }
+
+
+    def _streamClosed(self, streamId):
+        self._cancelStreamTimers(streamId)
+        body = self._outbound.pop(streamId, None)
+        if body is not None:
+            body.stop()
+        if not self._streams:
+            self._cancelReadTimer()
+            if self._closing:
+                self.transport.loseConnection()
+        self._releaseSlot()
+
+
+    #
+    # Timeouts
+    #
+
+    def _startStreamTimer(self, streamId, phase, timeout):
+        if timeout is not None:
+            self._timers[(streamId, phase)] = self.wheel.schedule(timeout,
+                    self._streamTimedOut, streamId, timeout)
+
+
+    def _cancelStreamTimer(self, streamId, phase):
+        timer = self._timers.pop((streamId, phase), None)
+        if timer is not None:
+            timer.cancel()
+
+
+    def _cancelStreamTimers(self, streamId):
+        for phase in ("firstByte", "total"):
+            self._cancelStreamTimer(streamId, phase)
+
+
+    def _streamTimedOut(self, streamId, timeout):
+        """Cancel one stream; the connection's other streams carry on."""
+        response = self._streams.pop(streamId, None)
+        if response is not None:
+            self._h2.reset_stream(streamId, ErrorCodes.CANCEL)
+            self._flush()
+            response.status = http.REQUEST_TIMEOUT
+            self._streamClosed(streamId)
+            response.request.response.errback(
+                    ResponseTimeout.Failure(response, timeout))
+        else:
+            self._streamClosed(streamId)
+
+
+    def _readTimedOut(self):
+        self._readTimer = None
+        self.timeoutConnection(self.timeouts.idle)
+
+
+    def _cancelReadTimer(self):
+        if self._readTimer is not None:
+            self._readTimer.cancel()
+            self._readTimer = None
+
+
+
+class _OutboundBody(object):
+    """The unsent part of a stream's request body.
+
+    The consumer of the body's producer, if it has one.
+    """
+
+    def __init__(self, protocol, streamId, data="", producer=None):
+        self.protocol = protocol
+        self.streamId = streamId
+        self.data = data
+        self.producer = producer
+        self.finished = producer is None
+        self.length = 0
+        self._paused = False
+
+
+    def write(self, data):
+        self.length += len(data)
+        self.data += data
+        self.protocol._sendBody(self.streamId)
+        self.protocol._flush()
+
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+
+    def throttle(self):
+        """Pause the producer while data is held back."""
+        if self.producer is None or self.finished:
+            return
+        if self.data and not self._paused:
+            self._paused = True
+            self.producer.pauseProducing()
+        elif not self.data and self._paused:
+            self._paused = False
+            self.producer.resumeProducing()
+
+
+    def stop(self):
+        if self.producer is not None and not self.finished:
+            self.finished = True
+            self.producer.stopProducing()
+
+
+
+class HTTP2Requester(RequesterBase):
+    """Issues requests to one origin as streams over one HTTP/2 connection.
+
+    https origins negotiate h2 with ALPN.  If the server declines, this
+    origin's requests are issued over HTTP/1.1 by a Multiplexer built with
+    the remaining keyword arguments.  http origins are assumed to speak h2
+    (prior knowledge).
+    """
+    implements(IRequester)
+
+    protocol = HTTP2Protocol
+    maxConnections = 1
+
+    def __init__(self, scheme, host, port, timeout=None, **fallbackKw):
+        if H2Connection is None:
+            raise ImportError("HTTP/2 requires the h2 package")
+        RequesterBase.__init__(self, scheme, host, port, timeout=timeout,
+                dialer=fallbackKw.get("dialer"),
+                socketProfile=fallbackKw.get("socketProfile"))
+
+        self.secure = (scheme == "https")
+        if self.secure:
+            # Shared with the HTTP/1.1 fallback.
+            from pendrell.tls import getTLSContextCache
+            tlsContexts = fallbackKw.get("tlsContexts")
+            if tlsContexts is None:
+                tlsContexts = getTLSContextCache()
+            self.contextFactory = tlsContexts.getContextFactory(host, port,
+                    alpnProtocols=["h2", "http/1.1"])
+
+        self._fallbackKw = fallbackKw
+        self._fallback = None
+
+
+    def connect(self):
+        assert self.disconnected
+        if self.secure:
+            return self.dialer.connectSSL(self.host, self.port, self,
+                    self.contextFactory, timeout=None)
+        else:
+            return self.dialer.connectTCP(self.host, self.port, self,
+                    timeout=None)
+
+
+    @property
+    def negotiated(self):
+        """False if the server declined HTTP/2."""
+        return self._fallback is None
+
+
+    def issueRequest(self, request):
+        if self._fallback is not None:
+            return self._fallback.issueRequest(request)
+        return RequesterBase.issueRequest(self, request)
+
+
+    def negotiationFailed(self):
+        """Issue this origin's requests over HTTP/1.1 instead."""
+        self._fallback = Multiplexer(HTTPSRequester,
+                self.scheme, self.host, self.port,
+                timeout=self.timeouts, **self._fallbackKw)
+
+        requests = self._replayQueue + self._requestQueue
+        del self._replayQueue[:], self._requestQueue[:]
+        for request in requests:
+            if request in self._pendingRequests:
+                self._pendingRequests.remove(request)
+            # The fallback answers through a fresh channel, which is then
+            # chained to the one this requester (and its caller) awaits.
+            awaited, request.response = request.response, Deferred()
+            self._fallback.issueRequest(request).chainDeferred(awaited)
+
+
+    def loseConnection(self):
+        d = RequesterBase.loseConnection(self)
+        if self._fallback is not None:
+            d = DeferredList([d, self._fallback.loseConnection()])
+        return d
+
+
+
+__id__ = "$Id: $"[5:-2]
@@ -1,6 +1,6 @@
 from base64 import b64encode
 from hashlib import md5
-import os
+import os, stat, tempfile
 from urllib2 import Request as urllib2_Request
 
 try:
@@ -11,12 +11,164 @@ except ImportError:
 from twisted.internet import defer
 from twisted.python import util
 
-from pendrell.decoders import loadDecoders
+from pendrell.decoders import DecodePipeline, loadDecoders
 from pendrell.error import MD5Mismatch
+from pendrell.producers import (UNKNOWN_LENGTH, EncodingBodyProducer,
+        encodeBody, getBodyProducer)
 from pendrell.proxy import Proxy
-from pendrell.util import URLPath
+from pendrell.util import URLPath, CRLF
 
 
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE")
+
+
+
+class HeaderTemplate(object):
+    """Default request headers, serialized once.
+
+    A request's own headers take precedence over its template's.
+    """
+
+    def __init__(self, headers=()):
+        self.headers = tuple((name, str(value)) for name, value in headers)
+        self.names = frozenset(name.lower() for name, value in self.headers)
+        self.block = _formatHeaders(self.headers)
+
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__,
+                ", ".join(name for name, value in self.headers))
+
+
+    def extend(self, headers):
+        """A template with headers added to (or replacing) these."""
+        headers = list(headers)
+        names = set(name.lower() for name, value in headers)
+        return self.__class__([(name, value) for name, value in self.headers
+                if name.lower() not in names] + headers)
+
+
+    def _overridden(self, headers):
+        for name in self.names:
+            if name in headers:
+                return True
+        return False
+
+
+    def iterHeaders(self, headers):
+        """(name, value) pairs of headers, and then of the defaults they
+        do not override.  headers is an InsensitiveDict.
+        """
+        for header in headers.iteritems():
+            yield header
+        for name, value in self.headers:
+            if name not in headers:
+                yield name, value
+
+
+    def serialize(self, headers):
+        """Header lines for headers, and the defaults they do not
+        override.
+        """
+        if not self._overridden(headers):
+            return _formatHeaders(headers.iteritems()) + self.block
+        return _formatHeaders(self.iterHeaders(headers))
+
+
+
+def _formatHeaders(headers):
+    return "".join(["%s: %s%s" % (name, value, CRLF)
+            for name, value in headers])
+
+
+
+# Names shared by every response's headers, by their lowercase and usual
+# spellings.
+_HEADER_NAMES = dict()
+for _name in ("Accept-Ranges", "Age", "Cache-Control", "Connection",
+              "Content-Disposition", "Content-Encoding", "Content-Language",
+              "Content-Length", "Content-Location", "Content-MD5",
+              "Content-Range", "Content-Type", "Date", "ETag", "Expires",
+              "Keep-Alive", "Last-Modified", "Location", "Pragma",
+              "Retry-After", "Server", "Set-Cookie", "Trailer",
+              "Transfer-Encoding", "Vary", "Via", "WWW-Authenticate",
+              "X-Powered-By"):
+    _HEADER_NAMES[_name] = _HEADER_NAMES[_name.lower()] = \
+            intern(_name.lower())
+del _name
+
+
+def _headerName(name):
+    """name in lowercase, shared with other responses' if it is common."""
+    lower = _HEADER_NAMES.get(name)
+    if lower is None:
+        lower = name.lower()
+        lower = _HEADER_NAMES.get(lower, lower)
+    return lower
+
+
+
+class ResponseHeaders(util.InsensitiveDict, object):
+    """A response's headers, kept as the list of (name, value) pairs they
+    arrived as.
+
+    As an InsensitiveDict, they map lowercase names to lists of values; the
+    mapping is only built when it is first used.  getRawHeaders reads the
+    pairs without building it.
+    """
+
+    def __init__(self, headers=None):
+        self.preserve = 1
+        self.raw = list()  # (lowercase name, value)
+        self._data = None
+        if headers:
+            for name, values in headers.items():
+                if isinstance(values, basestring):
+                    values = [values]
+                for value in values:
+                    self.addRawHeader(name, value)
+
+
+    def _getData(self):
+        if self._data is None:
+            data = dict()
+            for name, value in self.raw:
+                if name in data:
+                    data[name][1].append(value)
+                else:
+                    data[name] = (name, [value])
+            self._data = data
+        return self._data
+
+    def _setData(self, data):
+        self._data = data
+
+    data = property(_getData, _setData)
+
+
+    def addRawHeader(self, name, value):
+        name = _headerName(name)
+        self.raw.append((name, value))
+        if self._data is not None:
+            self._data.setdefault(name, (name, []))[1].append(value)
+
+
+    def getRawHeaders(self, name, default=None):
+        """The list of name's values, or default."""
+        if self._data is not None:
+            return self.get(name, default)
+        name = _headerName(name)
+        values = [v for n, v in self.raw if n == name]
+        return values or default
+
+
+    def copy(self):
+        return self.__class__(self)
+
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.raw)
+
 
 class Message(object):
 
@@ -69,7 +221,10 @@ class Response(Message):
 
     def __init__(self, request, url, method="GET", headers=None, **kw):
         assert isinstance(request, Request)
-        Message.__init__(self, url, method=method, headers=headers)
+        Message.__init__(self, url, method=method)
+        if not isinstance(headers, ResponseHeaders):
+            headers = ResponseHeaders(headers)
+        self.headers = headers
 
         assert isinstance(request, Message), "%r is not a Message" % request
         self.request = request
@@ -80,8 +235,16 @@ class Response(Message):
         self._dataLength = long()
 
         self.timedOut = False
+        # False if the connection was lost before the body had all arrived.
+        self.complete = True
+
+        # Connection persistence, as advertised by the server.
+        self.closeConnection = False
+        self.keepAliveTimeout = None
+        self.keepAliveMax = None
 
         self.contentDecoders = list()
+        self._pipeline = None
 
         self.contentMD5 = md5()
 
@@ -140,21 +303,23 @@ class Response(Message):
         self.status = status
         self.message = message
 
-
-    @property
-    def decoders(self):
-        return self.contentDecoders
+        # HTTP/1.0 connections persist only when the server says so.
+        self.closeConnection = (version == "HTTP/1.0")
 
 
     def gotHeader(self, key, val):
-        key = key.lower()  # just for normalcy; headers are insensitive
-
-        self.headers.setdefault(key, [])
-        self.headers[key].append(val)
+        key = _headerName(key)  # just for normalcy; headers are insensitive
+        self.headers.addRawHeader(key, val)
 
         if key == "connection":
-            if val == "close":
+            tokens = [t.strip().lower() for t in val.split(",")]
+            if "close" in tokens:
                 self.closeConnection = True
+            elif "keep-alive" in tokens:
+                self.closeConnection = False
+
+        elif key == "keep-alive":
+            self._gotKeepAlive(val)
 
         # transer-encodings handled by protocol
 
@@ -163,23 +328,46 @@ class Response(Message):
             self.contentDecoders += loadDecoders(encodings)
 
 
+    def _gotKeepAlive(self, val):
+        """Parse Keep-Alive parameters, e.g. 'timeout=5, max=100'."""
+        for param in val.split(","):
+            name, sep, value = param.strip().partition("=")
+            try:
+                if name.lower() == "timeout":
+                    self.keepAliveTimeout = int(value)
+                elif name.lower() == "max":
+                    self.keepAliveMax = int(value)
+            except ValueError:
+                pass  # Advisory; ignore malformed values.
+
+
+    def buildPipeline(self, transferDecoders=()):
+        """Prepare to decode the body, once the headers have all arrived.
+
+        transferDecoders undo transfer-codings other than chunked.  Codings
+        are undone in the reverse of the order they are listed in.  The MD5
+        of the body is only computed if the request asks for it or there is
+        a Content-MD5 header to verify.
+        """
+        self._pipeline = DecodePipeline(reversed(
+                list(self.contentDecoders) + list(transferDecoders)))
+        if not (self.request.digestContent
+                or self.headers.getRawHeaders("content-md5")):
+            self.contentMD5 = None
+
+
     def dataReceived(self, data):
-        data = self.decodeData(data)
+        if self._pipeline is None:
+            self.buildPipeline()
+        data = self._pipeline.decode(data, not data)
 
         self._dataLength += len(data)
-        self.contentMD5.update(data)
+        if self.contentMD5 is not None:
+            self.contentMD5.update(data)
 
         self.handleData(data)
 
 
-    def decodeData(self, data):
-        origLen = len(data)
-        final = bool(origLen == 0)
-        for decoder in self.decoders:
-            data = decoder.decode(data, final)
-        return data
-
-
     def handleData(self, data):
         """Called with data as it is decoded.
         
@@ -200,8 +388,8 @@ class Response(Message):
 
 
     def verifyDigest(self):
-        md5Headers = self.headers.get("content-md5")
-        if md5Headers is not None:
+        md5Headers = self.headers.getRawHeaders("content-md5")
+        if md5Headers is not None and self.contentMD5 is not None:
             assert len(md5Headers) == 1
             givenMD5 = md5Headers[0]
 
@@ -265,10 +453,13 @@ class FileResponse(StreamResponse):
     """Response that is written to file"""
 
     def __init__(self, request, url, path, method="GET", headers=None, **kw):
-        kw["stream"] = open(path, "w")
+        kw["stream"] = self._openStream(path)
         StreamResponse.__init__(self, request, url, method, headers, **kw)
         self.filePath = path
 
+    def _openStream(self, path):
+        return open(path, "w")
+
     def __repr__(self):
         return "<%s: %s: %s: %s>" % (self.__class__.__name__, self.method,
                 self.url, self.filePath)
@@ -280,6 +471,171 @@ class FileResponse(StreamResponse):
         self.stream.close()
 
 
+
+class Validators(object):
+    """Cache validators (ETag, Last-Modified) for a downloaded file.
+
+    Validators are stored in a sidecar file next to the download so that
+    subsequent downloads may be made conditional.
+    """
+
+    suffix = ".validators"
+
+    _headerNames = ("ETag", "Last-Modified")
+
+
+    def __init__(self, etag=None, lastModified=None):
+        self.etag = etag
+        self.lastModified = lastModified
+
+
+    def __nonzero__(self):
+        return bool(self.etag or self.lastModified)
+
+
+    @classmethod
+    def pathFor(klass, path):
+        return path + klass.suffix
+
+
+    @classmethod
+    def fromResponse(klass, response):
+        etag = response.headers.getRawHeaders("etag")
+        lastModified = response.headers.getRawHeaders("last-modified")
+        return klass(etag and etag[-1], lastModified and lastModified[-1])
+
+
+    @classmethod
+    def load(klass, path):
+        """Load the validators stored for path.
+
+        Returns None if path does not exist or no validators are stored for
+        it.
+        """
+        if not os.path.exists(path):
+            return None
+
+        try:
+            f = open(klass.pathFor(path))
+        except IOError:
+            return None
+
+        values = dict()
+        try:
+            for line in f:
+                name, sep, value = line.partition(":")
+                if sep:
+                    values[name.strip().lower()] = value.strip()
+        finally:
+            f.close()
+
+        validators = klass(values.get("etag"), values.get("last-modified"))
+        return validators or None
+
+
+    def save(self, path):
+        sidecarPath = self.pathFor(path)
+        if not self:
+            if os.path.exists(sidecarPath):
+                os.unlink(sidecarPath)
+            return
+
+        fd, tempPath = _mkstempFor(sidecarPath)
+        f = os.fdopen(fd, "w")
+        try:
+            for name, value in zip(self._headerNames,
+                    (self.etag, self.lastModified)):
+                if value:
+                    f.write("%s: %s\n" % (name, value))
+        finally:
+            f.close()
+        _renameOnto(tempPath, sidecarPath)
+
+
+    def conditionalHeaders(self):
+        headers = dict()
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.lastModified:
+            headers["If-Modified-Since"] = self.lastModified
+        return headers
+
+
+
+def _mkstempFor(path):
+    """Create a temporary file alongside path (so it may be renamed onto it).
+    """
+    directory, name = os.path.split(path)
+    return tempfile.mkstemp(prefix=".%s." % name, suffix=".tmp",
+            dir=directory or os.curdir)
+
+
+def _renameOnto(tempPath, path):
+    """Replace path with tempPath, giving it the mode of the file it replaces
+    (or of a newly created file) rather than mkstemp's 0600.
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0666 & ~umask
+    os.chmod(tempPath, mode)
+    os.rename(tempPath, path)
+
+
+
+class SyncedFileResponse(FileResponse):
+    """Response that replaces a file only when the remote resource changed.
+
+    Content is written to a temporary file which is atomically renamed onto
+    the target path once a successful response is complete.  Any other
+    response (i.e. 304 Not Modified, or a body cut short) leaves the target
+    file untouched.
+    """
+
+    def __init__(self, *args, **kw):
+        self._tempPath = None
+        FileResponse.__init__(self, *args, **kw)
+
+
+    def _openStream(self, path):
+        fd, self._tempPath = _mkstempFor(path)
+        return os.fdopen(fd, "wb")
+
+
+    def __del__(self):
+        FileResponse.__del__(self)
+        self._discard()
+
+
+    def _discard(self):
+        if self._tempPath is not None:
+            tempPath, self._tempPath = self._tempPath, None
+            if os.path.exists(tempPath):
+                os.unlink(tempPath)
+
+
+    @property
+    def modified(self):
+        return bool(200 <= (self.status or 0) < 300)
+
+
+    def done(self):
+        # Flush content decoders before the stream is closed.
+        Response.done(self)
+        FileResponse.done(self)
+
+        if self.modified and self.complete and not self.timedOut:
+            tempPath, self._tempPath = self._tempPath, None
+            _renameOnto(tempPath, self.filePath)
+            Validators.fromResponse(self).save(self.filePath)
+
+        else:
+            self._discard()
+
+
+
 class Request(Message, urllib2_Request):
     # urllib2 compatibility is maintained for things like cookielib.
 
@@ -293,8 +649,33 @@ class Request(Message, urllib2_Request):
 
     def __init__(self, url, method="GET", headers=None, data=None,
                  downloadTo=None, closeConnection=False, proxy=None,
-                 redirectedFrom=None, unredirectedHeaders=None, **kw):
+                 redirectedFrom=None, unredirectedHeaders=None,
+                 syncDownload=False, expectContinue=None,
+                 compressRequest=None, headerTemplate=None,
+                 digestContent=True, **kw):
         """
+        Keyword Arguments:
+            compressRequest --  "gzip" or "deflate" (or True, for gzip) to
+                    compress the body, and False not to.  None leaves the
+                    choice to the Agent.
+            data --  The body: a str, a file-like object, an iterable of
+                    strs, or an IBodyProducer (e.g. a
+                    pendrell.producers.MultipartBody, whose Content-Type is
+                    set).  A body whose length is not known is sent
+                    chunked.
+            digestContent --  If False, the response body's MD5
+                    (Response.contentMD5) is only computed when there is a
+                    Content-MD5 header to verify.
+            expectContinue --  If True, the body is sent with
+                    "Expect: 100-continue" only once the server has agreed
+                    to receive it.  None leaves the choice to the Agent,
+                    according to the size of the body.
+            headerTemplate --  A HeaderTemplate of default headers, which
+                    the request's own headers override.  Set by the Agent.
+            syncDownload --  If True and downloadTo is a path, the request is
+                    made conditional on the validators stored with a prior
+                    download, and the file is only replaced when the
+                    resource has changed.
         """
         headers = headers or dict()
         urllib2_Request.__init__(
@@ -303,6 +684,8 @@ class Request(Message, urllib2_Request):
                 unverifiable=kw.get("unverifiable", False),
             )
         Message.__init__(self, url, method, self.headers)
+        self.bodyProducer = getBodyProducer(data)
+        self._setBodyContentType()
         self.host = self._url.host
         self.port = self._url.port
         self.setProxy(proxy)
@@ -312,23 +695,50 @@ class Request(Message, urllib2_Request):
         self.unredirectedHeaders = util.InsensitiveDict(unredirectedHeaders)
 
         self.closeConnection = closeConnection is True
+        self.expectContinue = expectContinue
+        self.headerTemplate = headerTemplate
+        self.digestContent = digestContent
+        self.compressRequest = compressRequest
+        self.bodyEncoding = None
+        self._unencodedBody = None
 
         self.downloadTo = downloadTo
+        self.syncDownload = bool(syncDownload
+                and isinstance(downloadTo, basestring))
+        if self.syncDownload:
+            validators = Validators.load(downloadTo)
+            if validators:
+                for name, value in validators.conditionalHeaders().iteritems():
+                    self.headers.setdefault(name, value)
+
         self.redirectedTo = None
         self.redirectedFrom = tuple()
+        self.replayCount = 0
+        self.expectedSize = 0  # Estimated response size (see Multiplexer)
         self.response = defer.Deferred()
 
 
     @classmethod
     def fromRequest(klass, request, **kwArgs):
         from copy import deepcopy
+        # Copies are compressed afresh, if at all.
+        data, producer = request._unencodedBody \
+                or (request.data, request.bodyProducer)
+        headers = deepcopy(request.headers)
+        if request.bodyEncoding and "Content-Encoding" in headers:
+            del headers["Content-Encoding"]
         kw = dict(
                 closeConnection = request.closeConnection,
-                data = request.data,
+                compressRequest = request.compressRequest,
+                data = producer or data,
+                digestContent = request.digestContent,
                 downloadTo = request.downloadTo,
-                headers = deepcopy(request.headers),
+                expectContinue = request.expectContinue,
+                headerTemplate = request.headerTemplate,
+                headers = headers,
                 method = request.method,
                 redirectedFrom = request.redirectedFrom,
+                syncDownload = request.syncDownload,
                 unredirectedHeaders = deepcopy(request.unredirectedHeaders),
                 url = request.url,
             )
@@ -342,13 +752,79 @@ class Request(Message, urllib2_Request):
 
 
     def setData(self, data):
-        if data:
-            self.headers.setdefault("Content-length", len(data))
+        self.data = data
+        self.bodyProducer = getBodyProducer(data)
+        self._setBodyContentType()
+
+        if self.bodyLength:
+            self.headers.setdefault("Content-length", self.bodyLength)
 
         elif "Content-length" in self.headers:
             del self.headers["Content-length"]
 
-        self.data = data
+
+    def iterHeaders(self):
+        """(name, value) pairs of the headers to be sent, the template's
+        included.
+        """
+        if self.headerTemplate is None:
+            return self.headers.iteritems()
+        return self.headerTemplate.iterHeaders(self.headers)
+
+
+    def serializeHeaders(self):
+        """The header lines to be sent."""
+        if self.headerTemplate is None:
+            return _formatHeaders(self.headers.iteritems())
+        return self.headerTemplate.serialize(self.headers)
+
+
+    def _setBodyContentType(self):
+        # e.g. a MultipartBody's boundary
+        contentType = getattr(self.bodyProducer, "contentType", None)
+        if contentType:
+            self.headers.setdefault("Content-Type", contentType)
+
+
+    def encodeBody(self, encoding):
+        """Compress the body with a Content-Encoding ("gzip" or
+        "deflate").  A str body is compressed at once; others as they are
+        sent.
+        """
+        self._unencodedBody = (self.data, self.bodyProducer)
+        if self.bodyProducer is None:
+            self.data = encodeBody(self.data, encoding)
+        else:
+            self.bodyProducer = EncodingBodyProducer(self.bodyProducer,
+                    encoding)
+        self.bodyEncoding = encoding
+        self.headers["Content-Encoding"] = encoding
+
+
+    def __len__(self):
+        return self.bodyLength or 0
+
+
+    @property
+    def hasBody(self):
+        return bool(self.bodyProducer is not None or self.data)
+
+
+    @property
+    def bodyLength(self):
+        """The length of the body, or None if it is not known."""
+        if self.bodyProducer is None:
+            return len(self.data or "")
+        elif self.bodyProducer.length == UNKNOWN_LENGTH:
+            return None
+        return self.bodyProducer.length
+
+
+    @property
+    def bodyReplayable(self):
+        """True if the body may be sent again."""
+        return bool(self.bodyProducer is None
+                or getattr(self.bodyProducer, "restartable", False))
 
 
     def redirect(self, location):
@@ -361,9 +837,18 @@ class Request(Message, urllib2_Request):
         return self.redirectedTo is not None
 
 
+    @property
+    def idempotent(self):
+        return self.method.upper() in IDEMPOTENT_METHODS
+
+
     def buildResponse(self):
         downloadTo = self.downloadTo
-        if isinstance(downloadTo, basestring):
+        if self.syncDownload:
+            response = SyncedFileResponse(self, self.url, downloadTo,
+                    self.method)
+
+        elif isinstance(downloadTo, basestring):
             response = FileResponse(self, self.url, downloadTo, self.method)
 
         elif hasattr(downloadTo, "write"):
@@ -378,14 +863,31 @@ class Request(Message, urllib2_Request):
 
 
     def prepareHeaders(self):
-        if self.data:
-            self.headers["Content-Length"] = "%d" % len(self.data)
-
-        self.headers.setdefault("Host", self.host)
+        if self.hasBody and self.bodyLength is None:
+            if "Content-Length" in self.headers:
+                del self.headers["Content-Length"]
+            self.headers["Transfer-Encoding"] = "chunked"
+        elif self.hasBody:
+            self.headers["Content-Length"] = "%d" % self.bodyLength
+            if "Transfer-Encoding" in self.headers:
+                # Left by a copy of a chunked request.
+                del self.headers["Transfer-Encoding"]
+
+        if self.scheme == "http+unix":
+            # The URL's host names a socket rather than a server.
+            self.headers.setdefault("Host", "localhost")
+        else:
+            self.headers.setdefault("Host", self.host)
 
         if self.closeConnection:
            self.headers.setdefault("Connection", "close")
 
+        if self.expectContinue and self.hasBody:
+            self.headers["Expect"] = "100-continue"
+        elif "Expect" in self.headers \
+                and self.headers["Expect"].lower() == "100-continue":
+            del self.headers["Expect"]
+
         return self.headers
 
 
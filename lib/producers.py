@@ -0,0 +1,609 @@
+"""Request bodies that are read as they are sent.
+
+A request's data may be a str, a file-like object, an iterable of strs, or
+any IBodyProducer.  Bodies that are not strs are written as the connection
+accepts them, so that they need not be held in memory.
+
+Regular files sent over plain TCP connections are copied from the file to
+the socket by the kernel, with sendfile(2), when it is available (os.sendfile
+or the pysendfile package).
+
+Bodies may be compressed as they are sent (see EncodingBodyProducer), and
+forms are encoded as multipart/form-data as they are sent (see
+MultipartBody).
+"""
+
+import errno, mimetypes, os, stat, uuid, zlib
+
+from twisted.internet import task
+from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IPullProducer
+from twisted.python.failure import Failure
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+from zope.interface import implements
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+
+
+class _CooperativeProducer(object):
+    """Writes the chunks of an iterator to a consumer, yielding to the
+    reactor between chunks.
+    """
+
+    implements(IBodyProducer)
+
+    length = UNKNOWN_LENGTH
+    restartable = False
+
+    def __init__(self, cooperator=task):
+        self._cooperator = cooperator
+        self._task = None
+        self._paused = 0  # Pauses requested before producing started
+
+
+    def _chunks(self):
+        raise NotImplementedError()
+
+
+    def startProducing(self, consumer):
+        self._task = self._cooperator.cooperate(
+                consumer.write(chunk) for chunk in self._chunks())
+        for i in xrange(self._paused):
+            self._task.pause()
+        self._paused = 0
+
+        d = self._task.whenDone()
+        d.addCallbacks(lambda _: None, self._maybeStopped)
+        return d
+
+
+    def _maybeStopped(self, reason):
+        # Whoever stopped us is not waiting to hear about it.
+        reason.trap(task.TaskStopped)
+        return Deferred()
+
+
+    def pauseProducing(self):
+        if self._task is None:
+            self._paused += 1
+        else:
+            self._task.pause()
+
+
+    def resumeProducing(self):
+        if self._task is None:
+            self._paused = max(self._paused - 1, 0)
+        else:
+            try:
+                self._task.resume()
+            except task.SchedulerError:
+                pass  # Finished, or not paused
+
+
+    def stopProducing(self):
+        if self._task is not None:
+            try:
+                self._task.stop()
+            except task.TaskFinished:
+                pass
+
+
+
+class FileBodyProducer(_CooperativeProducer):
+    """Reads a file as it is sent.
+
+    A seekable file is read from the position it had when the producer was
+    built each time the body is sent, so that its request may be sent again
+    (e.g. when redirected, or after a lost connection).  A file opened from
+    a path is closed whenever the body has been sent, and opened again if it
+    is sent again.
+
+    Keyword Arguments:
+        length --  The number of bytes to send [default: the rest of the
+                   file, if that can be known]
+        readSize --  [default: 64KB]
+        cooperator --  [default: twisted.internet.task]
+    """
+
+    readSize = 64 * 1024
+
+    def __init__(self, stream, length=None, readSize=None, cooperator=task):
+        _CooperativeProducer.__init__(self, cooperator)
+        self.stream = stream
+        self._path = None  # Set if the producer opened the file
+        if readSize is not None:
+            self.readSize = readSize
+
+        try:
+            self._start = stream.tell()
+        except (AttributeError, EnvironmentError):
+            self._start = None
+        self.restartable = self._start is not None
+
+        if length is None:
+            length = self._determineLength()
+        self.length = length
+
+
+    @classmethod
+    def fromPath(klass, path, **kw):
+        """Send the file at path."""
+        producer = klass(open(path, "rb"), **kw)
+        producer._path = path
+        return producer
+
+
+    @property
+    def sendfileable(self):
+        """True if the body is a known length of a regular file."""
+        if self._start is None or self.length == UNKNOWN_LENGTH:
+            return False
+        try:
+            if self._path is not None:
+                info = os.stat(self._path)  # The file may be closed.
+            else:
+                info = os.fstat(self.stream.fileno())
+        except (AttributeError, EnvironmentError):
+            return False
+        return stat.S_ISREG(info.st_mode)
+
+
+    def _determineLength(self):
+        try:
+            info = os.fstat(self.stream.fileno())
+        except (AttributeError, EnvironmentError):
+            info = None
+        if info is not None and stat.S_ISREG(info.st_mode) \
+                and self._start is not None:
+            return info.st_size - self._start
+
+        if self._start is not None:
+            try:
+                self.stream.seek(0, os.SEEK_END)
+                end = self.stream.tell()
+                self.stream.seek(self._start)
+                return end - self._start
+            except (AttributeError, EnvironmentError):
+                pass
+        return UNKNOWN_LENGTH
+
+
+    def rewind(self):
+        """Seek to the start of the body, opening the file again if it was
+        opened from a path and has been closed since.
+        """
+        if self._path is not None and self.stream.closed:
+            self.stream = open(self._path, "rb")
+        if self._start is not None:
+            self.stream.seek(self._start)
+
+
+    def chunks(self):
+        """Iterate over the body's strs, from its start."""
+        self.rewind()
+        return self._chunks()
+
+
+    def close(self):
+        """Close the file, if it was opened from a path."""
+        if self._path is not None:
+            self.stream.close()
+
+
+    def startProducing(self, consumer):
+        self.rewind()
+        d = _CooperativeProducer.startProducing(self, consumer)
+        d.addBoth(_closing, self)
+        return d
+
+
+    def stopProducing(self):
+        _CooperativeProducer.stopProducing(self)
+        self.close()
+
+
+    def _chunks(self):
+        remaining = self.length
+        while remaining is UNKNOWN_LENGTH or remaining > 0:
+            size = self.readSize
+            if remaining is not UNKNOWN_LENGTH:
+                size = min(size, remaining)
+            chunk = self.stream.read(size)
+            if not chunk:
+                break
+            if remaining is not UNKNOWN_LENGTH:
+                remaining -= len(chunk)
+            yield chunk
+
+
+
+class IteratorBodyProducer(_CooperativeProducer):
+    """Sends the strs of an iterable, e.g. a generator.
+
+    Keyword Arguments:
+        length --  The total length of the strs, if known, so that the body
+                   need not be chunked. [default: UNKNOWN_LENGTH]
+        cooperator --  [default: twisted.internet.task]
+    """
+
+    def __init__(self, iterable, length=UNKNOWN_LENGTH, cooperator=task):
+        _CooperativeProducer.__init__(self, cooperator)
+        self.iterable = iterable
+        self.length = length
+
+
+    def _chunks(self):
+        for chunk in self.iterable:
+            if chunk:
+                yield chunk
+
+
+
+class SendfileWriter(object):
+    """Copies a FileBodyProducer's file to a transport's socket with
+    sendfile(2).
+
+    Registered with the transport as a pull producer, so that the transport
+    asks for more once it has written everything it holds (e.g. the request
+    headers) and whenever the socket becomes writable again.  The body is
+    closed once it has been sent, or sending it stops.
+    """
+
+    implements(IPullProducer)
+
+    # Bytes sent each time the transport asks, so that other connections
+    # are not starved.
+    sendSize = 4 * 1024 * 1024
+
+    # Private to twisted.internet.abstract.FileDescriptor; read to learn
+    # whether the transport still has data to write first.
+    _bufferAttributes = ("dataBuffer", "offset", "_tempDataLen")
+
+    def __init__(self, transport, body):
+        self.transport = transport
+        self.body = body
+        self.length = 0  # Sent
+        body.rewind()
+        self._offset = body.stream.tell()
+        self._remaining = body.length
+        self._done = None
+
+
+    @classmethod
+    def canSend(klass, transport, body):
+        """True if body may be sent to transport with sendfile(2)."""
+        if sendfile is None or not isinstance(body, FileBodyProducer) \
+                or not body.sendfileable:
+            return False
+        try:
+            handle = transport.getHandle()
+        except AttributeError:
+            return False
+        # TLS connections encrypt in user space.
+        if not hasattr(handle, "fileno") or hasattr(handle, "set_app_data"):
+            return False
+        # A Twisted that buffers differently gets FileBodyProducer instead.
+        for name in klass._bufferAttributes:
+            if not hasattr(transport, name):
+                return False
+        return True
+
+
+    def start(self):
+        """Fires once the body has been sent."""
+        self._done = Deferred()
+        self.transport.registerProducer(self, False)
+        return self._done
+
+
+    def _buffered(self):
+        t = self.transport
+        return len(t.dataBuffer) - t.offset + t._tempDataLen
+
+
+    def resumeProducing(self):
+        if self._done is None or self._buffered():
+            return  # Stopped, or the transport has data to send first.
+
+        inFD = self.body.stream.fileno()
+        outFD = self.transport.getHandle().fileno()
+        sent = 0
+        while self._remaining and sent < self.sendSize:
+            size = min(self._remaining, self.sendSize - sent)
+            try:
+                n = sendfile(outFD, inFD, self._offset, size)
+            except (OSError, IOError), e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                return self._finish(Failure())
+            if n == 0:
+                # The file is shorter than it was; the requester notices.
+                return self._finish(None)
+            sent += n
+            self._offset += n
+            self._remaining -= n
+            self.length += n
+
+        if self._remaining:
+            # Called again once the socket is writable.
+            self.transport.startWriting()
+        else:
+            self._finish(None)
+
+
+    def _finish(self, result):
+        d, self._done = self._done, None
+        if d is None:
+            return
+        self.body.close()
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+
+    def stopProducing(self):
+        self._done = None
+        self.body.close()
+
+
+    def finish(self):
+        pass
+
+
+
+class MultipartBody(_CooperativeProducer):
+    """A multipart/form-data body, whose file parts are read as they are
+    sent.
+
+    The body's length is known (so it need not be chunked) when the length
+    of each of its files is.  Its contentType, which names the boundary
+    between parts, is the request's Content-Type.
+
+    Keyword Arguments:
+        fields --  A dict or sequence of (name, value) pairs.
+        files --  A dict or sequence of (name, file) pairs, where a file is
+                  a path, a file-like object, or a (filename, file-like
+                  object[, content type]) tuple.
+        boundary --  [default: random]
+    """
+
+    readSize = FileBodyProducer.readSize
+
+    def __init__(self, fields=(), files=(), boundary=None, cooperator=task):
+        _CooperativeProducer.__init__(self, cooperator)
+        self.boundary = boundary or uuid.uuid4().hex
+        self._parts = []
+        for name, value in _items(fields):
+            self.addField(name, value)
+        for name, f in _items(files):
+            if isinstance(f, tuple):
+                self.addFile(name, f[1], f[0], *f[2:])
+            else:
+                self.addFile(name, f)
+
+
+    @property
+    def contentType(self):
+        return "multipart/form-data; boundary=%s" % self.boundary
+
+
+    def addField(self, name, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        self._addPart(self._partHeader(name), str(value))
+
+
+    def addFile(self, name, stream, filename=None, contentType=None):
+        """Add a file part, from a path or a file-like object."""
+        if isinstance(stream, basestring):
+            filename = filename or os.path.basename(stream)
+            content = FileBodyProducer.fromPath(stream,
+                    readSize=self.readSize)
+        else:
+            if filename is None:
+                filename = os.path.basename(getattr(stream, "name", "") or "")
+            content = FileBodyProducer(stream, readSize=self.readSize)
+        if contentType is None:
+            contentType = mimetypes.guess_type(filename or "")[0] \
+                    or "application/octet-stream"
+        header = self._partHeader(name, filename) \
+                + "Content-Type: %s\r\n" % contentType
+        self._addPart(header, content)
+
+
+    def _partHeader(self, name, filename=None):
+        disposition = 'form-data; name="%s"' % _quote(name)
+        if filename is not None:
+            disposition += '; filename="%s"' % _quote(filename)
+        return "--%s\r\nContent-Disposition: %s\r\n" % (self.boundary,
+                disposition)
+
+
+    def _addPart(self, header, content):
+        self._parts.append(header + "\r\n")
+        self._parts.append(content)
+        self._parts.append("\r\n")
+
+
+    @property
+    def _trailer(self):
+        return "--%s--\r\n" % self.boundary
+
+
+    @property
+    def length(self):
+        length = len(self._trailer)
+        for part in self._parts:
+            if isinstance(part, str):
+                length += len(part)
+            elif part.length == UNKNOWN_LENGTH:
+                return UNKNOWN_LENGTH
+            else:
+                length += part.length
+        return length
+
+
+    @property
+    def restartable(self):
+        return all(getattr(part, "restartable", True) for part in self._parts)
+
+
+    def _chunks(self):
+        for part in self._parts:
+            if isinstance(part, str):
+                yield part
+            else:
+                for chunk in part.chunks():
+                    yield chunk
+        yield self._trailer
+
+
+    def close(self):
+        """Close the files of parts added from paths."""
+        for part in self._parts:
+            if not isinstance(part, str):
+                part.close()
+
+
+    def startProducing(self, consumer):
+        d = _CooperativeProducer.startProducing(self, consumer)
+        d.addBoth(_closing, self)
+        return d
+
+
+    def stopProducing(self):
+        _CooperativeProducer.stopProducing(self)
+        self.close()
+
+
+
+def _closing(result, body):
+    body.close()
+    return result
+
+
+def _items(pairs):
+    if isinstance(pairs, dict):
+        return pairs.iteritems()
+    return pairs
+
+
+def _quote(value):
+    # As browsers do (HTML5).
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return value.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+
+# Content-Encodings that request bodies may be compressed with.
+BODY_ENCODINGS = ("gzip", "deflate")
+
+def getCompressor(encoding, level=6):
+    """A zlib compressobj for a Content-Encoding.
+
+    "deflate" is the zlib format (RFC 1950), as HTTP specifies.
+    """
+    if encoding == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        return zlib.compressobj(level)
+    else:
+        raise ValueError("Unsupported body encoding: %r" % (encoding,))
+
+
+def encodeBody(data, encoding):
+    """Compress a str body."""
+    compressor = getCompressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+
+class EncodingBodyProducer(object):
+    """Compresses another IBodyProducer's body as it is produced.
+
+    The compressed length is not known until the body has been sent, so
+    it is sent chunked.
+    """
+
+    implements(IBodyProducer)
+
+    length = UNKNOWN_LENGTH
+
+    def __init__(self, producer, encoding):
+        getCompressor(encoding)  # Unsupported encodings fail now.
+        self.producer = producer
+        self.encoding = encoding
+
+
+    @property
+    def restartable(self):
+        return getattr(self.producer, "restartable", False)
+
+
+    def startProducing(self, consumer):
+        compressor = getCompressor(self.encoding)
+        def write(data):
+            data = compressor.compress(data)
+            if data:
+                consumer.write(data)
+        def flush(_):
+            data = compressor.flush()
+            if data:
+                consumer.write(data)
+
+        d = self.producer.startProducing(_WriteConsumer(write))
+        d.addCallback(flush)
+        return d
+
+
+    def pauseProducing(self):
+        self.producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.producer.resumeProducing()
+
+    def stopProducing(self):
+        self.producer.stopProducing()
+
+
+
+class _WriteConsumer(object):
+
+    def __init__(self, write):
+        self.write = write
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+
+
+def getBodyProducer(data):
+    """An IBodyProducer for request data, or None if data is a str (or
+    empty).
+    """
+    if not data or isinstance(data, basestring):
+        return None
+    elif IBodyProducer.providedBy(data):
+        return data
+    elif hasattr(data, "read"):
+        return FileBodyProducer(data)
+    elif hasattr(data, "__iter__"):
+        return IteratorBodyProducer(data)
+    else:
+        raise TypeError("Unsupported request body: %r" % (data,))
+
+
+
+__id__ = "$Id: $"[5:-2]
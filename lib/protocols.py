@@ -1,23 +1,35 @@
+import errno, socket
 from struct import calcsize, pack, unpack, error as UnpackError
 
 from socket import inet_aton, inet_ntoa
+
+try:
+    from OpenSSL import SSL
+except ImportError:
+    SSL = None
 from urlparse import urlunsplit
 
 from twisted.internet import (error as netErr,
         interfaces as netInterfaces, protocol, reactor)
-from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
-from twisted.protocols import basic, policies
+from twisted.internet.defer import (Deferred, succeed,
+        inlineCallbacks, returnValue)
 from twisted.python.failure import Failure
 from twisted.web import http
 
 from pendrell import log
 from pendrell.decoders import ChunkingIncrementalDecoder, getIncrementalDecoder
-from pendrell.error import (IncompleteResponse, RedirectedResponse,
+from pendrell.error import (HeadersTooLarge, IncompleteRequest,
+        IncompleteResponse, MalformedResponse, RedirectedResponse,
         ResponseTimeout, RetryResponse, UnauthorizedResponse, WebError,
         FailableMixin)
+from pendrell.producers import SendfileWriter
+from pendrell.sockets import SocketProfile, getTransportSocket
+from pendrell.timeouts import Timeouts, getTimerWheel
 from pendrell.util import URLPath, CRLF
 
 
+CONTINUE = 100
+SWITCHING_PROTOCOLS = 101
 OKAY_CODES= range(200, 300)
 NO_BODY_CODES = http.NO_BODY_CODES
 REDIRECT_CODES = (
@@ -35,19 +47,137 @@ UNAUTHORIZED_CODES = (
 
 
 
-class HTTPProtocol(basic.LineReceiver, policies.TimeoutMixin):
+class ResponseHandlerMixin(object):
+    """Completes a request's response Deferred according to the status of
+    the response.
+
+    The Deferred's callbacks run at once and may issue further requests, so
+    protocols call handleResponse() once they are ready to send them.
+
+    Requires timedOut and timeOut attributes.
+    """
+
+    def handleResponse(self, response):
+        # Done processing the current request
+        #logFmt = "%r: %s: handling %%s response %r [%d]" % (
+        #         self, response.request, response, len(response))
+
+        if self.timedOut:
+            #log.debug(logFmt % "timed-out")
+            response.status = http.REQUEST_TIMEOUT
+            responseValue = ResponseTimeout.Failure(response, self.timeOut)
+
+        elif response.status in REDIRECT_CODES:
+            # Response redirected
+            #log.debug(logFmt % "redirect")
+            responseValue = RedirectedResponse.Failure(response)
+
+        elif response.status in RETRY_CODES:
+            # Response redirected
+            #log.debug(logFmt % "redirect")
+            responseValue = RetryResponse.Failure(response)
+
+        elif response.status in UNAUTHORIZED_CODES:
+            # Response unauthorized
+            #log.debug(logFmt % "unauthorized")
+            responseValue = UnauthorizedResponse.Failure(response)
+
+        elif response.status in OKAY_CODES and not response.complete:
+            # The connection was lost before the body had all arrived.
+            responseValue = IncompleteResponse.Failure(response)
+
+        elif (response.status == http.NOT_MODIFIED
+                and response.request.syncDownload):
+            # The synced download is already up-to-date.
+            responseValue = response
+
+        elif response.status in OKAY_CODES:
+            # SUCCESS
+            #log.debug(logFmt % "success")
+            responseValue = response
+
+        else:
+            # Generic failure
+            #log.debug(logFmt % "failure")
+            responseValue = WebError.Failure(response)
+
+        response.request.response.callback(responseValue)
+
+
+
+class HTTPProtocol(protocol.Protocol, ResponseHandlerMixin):
     """Represents an HTTP channel.
+
+    Each phase of a request is timed according to self.timeouts on a shared
+    TimerWheel.
+
+    A response's status line and headers are parsed as one block once all
+    of them have been received; its content is then read from the same
+    data.
     """
 
+    # Number of requests that may be sent while a response is outstanding.
+    # Only idempotent requests are pipelined.
+    pipelineDepth = 0
+
+    # Idle connections are retired this many seconds before the server's
+    # advertised Keep-Alive timeout would close them.
+    keepAliveMargin = 1.0
+
+    # Connections reused after idling this many seconds are first checked
+    # for a close the reactor has not processed yet.
+    staleCheckAfter = 0.25
+
+    # A body withheld for "Expect: 100-continue" is sent anyway after this
+    # many seconds, since servers need not support expectations.
+    continueTimeout = 1.0
+
+    # Copy file bodies to plain TCP sockets in the kernel, when possible.
+    useSendfile = True
+
+    # Limits on a response's status line and headers, together.
+    maxHeaderSize = 64 * 1024
+    maxHeaders = 256
+
+    timeouts = Timeouts()
+    wheel = None
+    socketProfile = SocketProfile()
+
     def __init__(self):
         self._pendingResponses = list()
+        self._sendable = None  # (request, Deferred) waiting for the pipeline
+        self._continuing = None  # (request, Timer) whose body awaits 100
+        self._producing = None  # (request, producer) whose body is streaming
+
+        self._retiring = False
+        self._requestsSent = 0
+        self._responsesReceived = 0
+        self._requestLimit = None
+        self._keepAliveTimeout = None
+        self._idleCall = None
+        self._idleSince = None
 
         self.timedOut = False
-
+        self.timeOut = None  # The timeout that expired
+
+        self._handshakeTimer = None
+        self._handshakeStarted = None
+        self.handshakeTime = None  # Seconds, once a TLS handshake completes
+        self._readTimer = None  # Times firstByte or idle
+        self._readPhase = None
+        self._waitStarted = None  # When the current firstByte wait began
+        self._firstByteAt = None
+        self._lastReadAt = None  # Of the response being read
+        self._totalTimers = dict()  # Response => Timer
+
+        self._outgoing = list()  # Requests to be written together
+        self._headerBuffer = ""  # A response's headers, until all are read
+        self._readingContent = False
         self._contentLength = None
         self._contentSize = None
 
         self._chunkDecoder = None
+        self._quickAckSocket = None  # Re-armed after each read
 
 
     def __repr__(self):
@@ -62,19 +192,188 @@ class HTTPProtocol(basic.LineReceiver, policies.TimeoutMixin):
 
     def connectionMade(self):
         self._connected = True
-        basic.LineReceiver.connectionMade(self)
+        if self.wheel is None:
+            self.wheel = getTimerWheel()
+        self._applySocketProfile()
+        self._startHandshake()
         self.sendRequests()
 
 
     def connectionLost(self, reason):
         self._connected = False
-        return basic.LineReceiver.connectionLost(self, reason)
+        self._producing = None  # The transport has stopped the producer.
+        self._cancelIdleTimeout()
+        self._cancelTimers()
+        if self._handshakeFailed(reason):
+            # Re-sending will not help, e.g. the certificate is not trusted.
+            self._failPendingResponses(reason)
+        self._replayUnansweredRequests()
+
+
+    def _applySocketProfile(self):
+        sock = getTransportSocket(self.transport)
+        if sock is not None and self.socketProfile.connected(sock) \
+                and self.socketProfile.quickAck is not None:
+            self._quickAckSocket = sock
+
+
+    def _handshakeFailed(self, reason):
+        return bool(self._handshakeStarted is not None
+                and self.handshakeTime is None
+                and not reason.check(netErr.ConnectionDone,
+                                     netErr.ConnectionLost))
+
 
+    def _failPendingResponses(self, reason):
+        while self._pendingResponses:
+            response = self._pendingResponses.pop(0)
+            response.request.response.errback(reason)
+
+
+    def _replayUnansweredRequests(self):
+        """Hand requests that may safely be re-sent back to the factory.
+
+        Idempotent requests whose responses had not begun are re-sent, as is
+        a request that was waiting for room in the pipeline.
+        """
+        replays = list()
+        if not self.timedOut:
+            for response in list(self._pendingResponses):
+                if self._isReplayable(response):
+                    self._pendingResponses.remove(response)
+                    response.request.replayCount += 1
+                    replays.append(response.request)
+
+        sendable, self._sendable = self._sendable, None
+        if sendable:
+            replays.append(sendable[0])
+
+        if replays:
+            self.factory.replayRequests(replays)
+
+        if sendable:
+            sendable[1].callback(False)
 
-    def timeoutConnection(self):
+
+    def _isReplayable(self, response):
+        request = response.request
+        return bool(not response.hasStatus
+                and request.idempotent
+                and request.bodyReplayable
+                and request.replayCount < self.factory.maxReplays)
+
+
+    def timeoutConnection(self, timeout=None):
         #log.debug("%r: connection timeout" % self)
         self.timedOut = True
-        return policies.TimeoutMixin.timeoutConnection(self)
+        self.timeOut = timeout
+        self.transport.loseConnection()
+
+
+    #
+    # Phase timers
+    #
+
+    def _startHandshake(self):
+        """Prepare and time the TLS handshake, if the transport is secure.
+
+        The requester's context reports completion via handshakeDone().
+        """
+        try:
+            handle = self.transport.getHandle()
+        except AttributeError:
+            handle = None
+        if not hasattr(handle, "set_app_data"):
+            return
+
+        handle.set_app_data(self)
+        self.factory.contextFactory.prepareConnection(handle)
+        self._handshakeStarted = self.wheel.seconds()
+        if self.timeouts.handshake is not None:
+            self._handshakeTimer = self.wheel.schedule(
+                    self.timeouts.handshake,
+                    self.timeoutConnection, self.timeouts.handshake)
+
+
+    def handshakeDone(self):
+        if self.handshakeTime is None and self._handshakeStarted is not None:
+            self.handshakeTime = self.wheel.seconds() - self._handshakeStarted
+        self._cancelHandshakeTimer()
+
+
+    def _cancelHandshakeTimer(self):
+        if self._handshakeTimer is not None:
+            self._handshakeTimer.cancel()
+            self._handshakeTimer = None
+
+
+    def _setReadTimer(self, phase):
+        """Time the wait for the server with the given phase's timeout."""
+        self._readPhase = phase
+        if phase == "firstByte":
+            self._waitStarted = self.wheel.seconds()
+        delay = getattr(self.timeouts, phase)
+        if delay is None:
+            self._cancelReadTimer()
+        elif self._readTimer is not None and self._readTimer.active():
+            self._readTimer.reset(delay)
+        else:
+            self._readTimer = self.wheel.schedule(delay, self._readTimedOut)
+
+
+    def _cancelReadTimer(self):
+        if self._readTimer is not None:
+            self._readTimer.cancel()
+            self._readTimer = None
+
+
+    def _readTimedOut(self):
+        self._readTimer = None
+        if self._readPhase == "firstByte":
+            # The server took at least this long.
+            self.timeouts.recordFirstByte(
+                    self.wheel.seconds() - self._waitStarted)
+        self.timeoutConnection(getattr(self.timeouts, self._readPhase))
+
+
+    def _cancelTimers(self):
+        self._cancelHandshakeTimer()
+        if self._continuing is not None:
+            self._continuing[1].cancel()
+            self._continuing = None
+        self._cancelReadTimer()
+        for timer in self._totalTimers.itervalues():
+            timer.cancel()
+        self._totalTimers.clear()
+
+
+    def dataReceived(self, data):
+        if self._quickAckSocket is not None:
+            self.socketProfile.readFrom(self._quickAckSocket)
+        if self._pendingResponses:
+            now = self.wheel.seconds()
+            if self._readPhase == "firstByte":
+                self._firstByteAt = now
+                self.timeouts.recordFirstByte(now - self._waitStarted)
+                self._setReadTimer("idle")
+            else:
+                if self._lastReadAt is not None:
+                    self.timeouts.recordReadGap(now - self._lastReadAt)
+                if self._readTimer is not None:
+                    self._readTimer.reset(self.timeouts.idle)
+            self._lastReadAt = now
+
+        # Each pass reads one response's headers, or its content.
+        while data:
+            if not self._pendingResponses:
+                log.debug("%r: unexpected data: %r" % (self, data[:80]))
+                self._retiring = True
+                self.transport.loseConnection()
+                break
+            elif self._readingContent:
+                data = self.rawDataReceived(data)
+            else:
+                data = self._headerDataReceived(data)
 
 
     @inlineCallbacks
@@ -83,16 +382,191 @@ class HTTPProtocol(basic.LineReceiver, policies.TimeoutMixin):
 
         while connected:
             try:
-                request = yield self.factory.getNextRequest()
-                self.sendRequest(request)
+                # Requests sent in the same turn are written together.
+                d = self.factory.getNextRequest()
+                if not d.called:
+                    self._flushRequests()
+                request = yield d
+                if self._requestLimitReached or self._isStale(request):
+                    self._retire()
+                if not self._connected or self._retiring:
+                    # Lost while the request was being handed to us, or no
+                    # longer accepting requests: send it on a new connection.
+                    self.factory.replayRequests([request])
+                    connected = False
+                    continue
+
+                d = self._waitToSend(request)
+                if not d.called:
+                    self._flushRequests()
+                connected = yield d
+                if connected:
+                    self.sendRequest(request)
 
             except (netErr.ConnectionLost, netErr.ConnectionDone) :
                 connected = False
+            except Exception:
+                # Lost for another reason, e.g. a failed TLS handshake.
+                if self._connected:
+                    raise
+                connected = False
+        self._flushRequests()
 
-        while self._pendingResponses:
+        # A retiring connection still reads its outstanding responses.
+        while self._pendingResponses and not self._connected:
             self.handleResponseEnd()
 
 
+    def _canSend(self, request):
+        pending = self._pendingResponses
+        if self._continuing is not None or self._producing is not None:
+            return False  # A body has yet to be sent.
+        if not pending:
+            return True
+
+        # A 100 Continue answers the request being answered.
+        return bool(len(pending) <= self.pipelineDepth
+                and request.idempotent
+                and not request.expectContinue
+                and all(r.request.idempotent for r in pending))
+
+
+    def _waitToSend(self, request):
+        """Wait until request may be written to the connection.
+
+        Fires True when it may be sent, or False if the connection is lost
+        first.
+        """
+        assert self._sendable is None
+        if self._canSend(request):
+            d = succeed(True)
+        else:
+            d = Deferred()
+            self._sendable = (request, d)
+        return d
+
+
+    def _sendWaitingRequest(self):
+        if self._sendable and self._canSend(self._sendable[0]):
+            (_, d), self._sendable = self._sendable, None
+            d.callback(True)
+
+
+    #
+    # Connection persistence
+    #
+
+    @property
+    def _requestLimitReached(self):
+        return bool(self._requestLimit is not None
+                and self._requestsSent >= self._requestLimit)
+
+
+    def _updatePersistence(self, response):
+        """Apply the persistence parameters advertised by a response.
+
+        Keep-Alive's max counts the requests the server will still accept
+        after this response.
+        """
+        if response.keepAliveMax is not None:
+            self._requestLimit = self._responsesReceived+response.keepAliveMax
+        if response.keepAliveTimeout is not None:
+            self._keepAliveTimeout = response.keepAliveTimeout
+
+        if (response.closeConnection or response.request.closeConnection
+                or self._requestLimitReached):
+            self._retire()
+
+
+    def _retire(self):
+        """Stop sending requests and close once all responses are read.
+
+        A request waiting for the pipeline is handed back to the factory.
+        """
+        self._retiring = True
+        self._cancelIdleTimeout()
+
+        sendable, self._sendable = self._sendable, None
+        if sendable:
+            self.factory.replayRequests([sendable[0]])
+            sendable[1].callback(False)
+
+        if not self._pendingResponses and self._connected:
+            self.transport.loseConnection()
+
+
+    def _startIdleTimeout(self):
+        if self._keepAliveTimeout is not None and not self._retiring:
+            self._cancelIdleTimeout()
+            delay = max(self._keepAliveTimeout - self.keepAliveMargin, 0)
+            self._idleCall = self.wheel.schedule(delay, self._idleTimedOut)
+
+
+    def _cancelIdleTimeout(self):
+        if self._idleCall is not None:
+            self._idleCall.cancel()
+            self._idleCall = None
+
+
+    def _idleTimedOut(self):
+        self._idleCall = None
+        if not (self._pendingResponses or self._sendable):
+            self._retire()
+
+
+    def _isStale(self, request=None):
+        """True if an idle connection has become readable.
+
+        Nothing is expected from the server between responses, so data or
+        EOF waiting on an idle socket means the server has closed (or is
+        closing) the connection.  The socket is peeked at, through TLS if
+        need be, since TLS records such as session tickets may arrive on a
+        healthy connection.  Requests that may not be replayed are
+        checked for however briefly the connection has idled, since they are
+        handed over as soon as the previous response is read.
+        """
+        if (not self._connected or self._pendingResponses
+                or self._idleSince is None):
+            return False
+        if (reactor.seconds() - self._idleSince < self.staleCheckAfter
+                and (request is None
+                     or request.idempotent and request.bodyReplayable)):
+            return False
+
+        sock = getTransportSocket(self.transport)
+        if sock is None:
+            return False
+        elif hasattr(sock, "set_app_data"):
+            return self._isTLSClosed(sock)
+
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except socket.error, e:
+            return e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                     errno.EINTR)
+        except AttributeError:
+            return False  # Not a socket
+        return True  # Data, or EOF
+
+
+    @staticmethod
+    def _isTLSClosed(connection):
+        """Peek at an OpenSSL Connection for data, a close_notify or an
+        error.
+        """
+        if SSL is None:
+            return False
+        try:
+            connection.recv(1, socket.MSG_PEEK)
+        except (SSL.WantReadError, SSL.WantWriteError):
+            return False  # Only TLS records, if anything, were waiting.
+        except TypeError:
+            return False  # pyOpenSSL before 0.15 cannot peek.
+        except SSL.Error:
+            return True  # Closed, or broken
+        return True
+
+
     #
     # HTTP requesting methods 
     #
@@ -102,106 +576,326 @@ class HTTPProtocol(basic.LineReceiver, policies.TimeoutMixin):
         request.prepareHeaders()
 
         #log.debug("Sending request" % request)
-        self.sendCommand(request)
-        self.sendHeaders(request)
-        self.sendContent(request)
+        self._cancelIdleTimeout()
+        self._idleSince = None
+        self._requestsSent += 1
+        inline = bool(request.bodyProducer is None
+                and not (request.expectContinue and request.hasBody))
+        self._outgoing.extend(self.formatRequest(request, inline))
+        if not inline:
+            # The body follows the request on the transport.
+            self._flushRequests()
 
         response = request.buildResponse()
         self._pendingResponses.append(response)
 
+        total = self.timeouts.totalFor(request)
+        if total is not None:
+            self._totalTimers[response] = self.wheel.schedule(total,
+                    self.timeoutConnection, total)
+
+        if request.expectContinue and request.hasBody:
+            self._waitForContinue(request)
+        elif not inline:
+            self.sendContent(request)
+        if len(self._pendingResponses) == 1 and self._producing is None:
+            self._setReadTimer("firstByte")
+
 
     def _urlToRequestString(self, url):
         return urlunsplit((None, None, url.path, url.query, None))
 
 
-    def sendCommand(self, request):
+    def formatRequest(self, request, inline=True):
+        """The request line, headers and (if inline) str body, as a list
+        of strs to be written together.
+        """
+        data = [self.formatCommand(request), request.serializeHeaders(), CRLF]
+        if inline and request.data and request.bodyProducer is None:
+            data.append(request.data)
+        return data
+
+
+    def _flushRequests(self):
+        if self._outgoing:
+            outgoing, self._outgoing = self._outgoing, list()
+            if self._connected:
+                self.transport.writeSequence(outgoing)
+
+
+    def formatCommand(self, request):
         path = self._urlToRequestString(request.url)
-        command = "%s %s HTTP/1.1%s" % (request.method, path, CRLF)
-        self.transport.write(command)
+        return "%s %s HTTP/1.1%s" % (request.method, path, CRLF)
+
+
+    def sendCommand(self, request):
+        self.transport.write(self.formatCommand(request))
 
 
     def sendHeaders(self, request):
-        for name, value in request.headers.iteritems():
-            header = "%s: %s%s" % (name, value, CRLF)
-            self.transport.write(header)
-        self.transport.write(CRLF)    
+        self.transport.writeSequence([request.serializeHeaders(), CRLF])
 
     
     def sendContent(self, request):
-        content = request.data
-        if content:
-            self.transport.write(content)
+        if request.bodyProducer is not None:
+            self._produceContent(request)
+        elif request.data:
+            self.transport.write(request.data)
 
 
     #
-    # HTTP Headers received as lines
+    # Streaming request bodies
     #
 
-    def lineReceived(self, line):
-        assert self._pendingResponses
+    def _produceContent(self, request):
+        """Stream request's body as the transport accepts it, chunked if its
+        length is not known.  Files are sent with sendfile(2) over plain TCP.
 
-        if line == "":
-            self.handleEndHeaders()
+        The server is not timed while the body is sent.
+        """
+        producer = request.bodyProducer
+        self._cancelReadTimer()
+
+        if self.useSendfile and SendfileWriter.canSend(self.transport,
+                                                       producer):
+            consumer = SendfileWriter(self.transport, producer)
+            self._producing = (request, consumer)
+            d = consumer.start()
+        else:
+            consumer = _BodyConsumer(self.transport,
+                    chunked=(request.bodyLength is None))
+            self._producing = (request, producer)
+            self.transport.registerProducer(producer, True)
+            d = producer.startProducing(consumer)
 
-            if self._currentResponseHasContent():
-                self.setRawMode()
+        d.addCallbacks(self._finishedProducing, self._producingFailed,
+                callbackArgs=(request, consumer), errbackArgs=(request,))
 
-            else:
-                self.handleResponseEnd()
 
-        elif not self._currentResponse.hasStatus:
-            self._parseStatusMessage(line)
+    def _isProducing(self, request):
+        return bool(self._producing is not None
+                and self._producing[0] is request)
 
-        else:
-            self._parseHeader(line)
 
+    def _finishedProducing(self, _, request, consumer):
+        if not self._isProducing(request):
+            return  # Stopped
+        self._producing = None
+        self.transport.unregisterProducer()
+
+        length = request.bodyLength
+        if length is not None and consumer.length != length:
+            return self._producingFailed(Failure(IncompleteRequest(
+                    "Sent %d of %d body bytes" % (consumer.length, length))),
+                    request)
+
+        consumer.finish()
+        if self._readTimer is None and self._pendingResponses:
+            self._setReadTimer("firstByte")
+        self._sendWaitingRequest()
 
-    def _parseStatusMessage(self, line):
-        info = line.split(None, 2)
-        if len(info) == 3:
-            version, status, message = info
-        else:
-            version, status = info
-            message = ""
+
+    def _producingFailed(self, reason, request):
+        """The body could not be sent, and so neither can anything else on
+        this connection.
+        """
+        if not self._isProducing(request):
+            return
+        self._producing = None
+        self.transport.unregisterProducer()
+
+        log.debug("%r: sending the body of %r failed: %s" % (self, request,
+                reason.getErrorMessage()))
+        for response in list(self._pendingResponses):
+            if response.request is request:
+                self._pendingResponses.remove(response)
+                request.response.errback(reason)
+        self._retiring = True
+        self.transport.loseConnection()
+
+
+    def _stopProducing(self):
+        """The server responded before reading the whole body."""
+        (_, producer), self._producing = self._producing, None
+        self.transport.unregisterProducer()
+        producer.stopProducing()
+        self._retire()
+
+
+    #
+    # Expect: 100-continue
+    #
+
+    def _waitForContinue(self, request):
+        timer = self.wheel.schedule(self.continueTimeout,
+                self._sendContinuedContent)
+        self._continuing = (request, timer)
+
+
+    def _sendContinuedContent(self):
+        """The server asked for the body, or did not answer in time."""
+        (request, timer), self._continuing = self._continuing, None
+        timer.cancel()
+        self.sendContent(request)
+        if self._producing is None:
+            self._sendWaitingRequest()
+
+
+    def _abandonContinuedContent(self):
+        """The server responded without the body.
+
+        The server may still expect the body it was promised, so the
+        connection is not reused.
+        """
+        (_, timer), self._continuing = self._continuing, None
+        timer.cancel()
+        self._retire()
+
+
+    def _expectationFailed(self, response):
+        """If the server refused the expectation (417), send the request
+        again without it, on a new connection.
+        """
+        request = response.request
+        if not (response.status == http.EXPECTATION_FAILED
+                and request.expectContinue and not self.timedOut):
+            return False
+        request.expectContinue = False
+        self._retire()
+        self.factory.replayRequests([request])
+        return True
+
+
+    #
+    # HTTP Headers received as a block
+    #
+
+    def _headerDataReceived(self, data):
+        """Buffer data until a response's headers end, and handle them.
+
+        Returns the data following the headers.
+        """
+        searchFrom = max(len(self._headerBuffer) - 3, 0)
+        data = self._headerBuffer + data
+        if searchFrom == 0:
+            # Empty lines may precede a status line.
+            data = data.lstrip(CRLF)
+        end = data.find(CRLF + CRLF, searchFrom)
+
+        if end < 0 and len(data) <= self.maxHeaderSize:
+            self._headerBuffer = data
+            return ""
+        self._headerBuffer = ""
+        if end < 0 or end > self.maxHeaderSize:
+            self._malformedResponse(HeadersTooLarge(
+                    "Response headers exceed %d bytes" % self.maxHeaderSize))
+            return ""
+
+        try:
+            self._parseHeaderBlock(data[:end])
+        except MalformedResponse, e:
+            self._malformedResponse(e)
+            return ""
+        return data[end+4:]
+
+
+    def _parseHeaderBlock(self, block):
+        lines = block.split(CRLF)
+        version, status, message = self._parseStatusLine(lines.pop(0))
+        if 100 <= status < 200 and status != SWITCHING_PROTOCOLS:
+            # An interim response's headers are of no interest.
+            self.handleInformational(status)
+            return
+
+        headers = list()
+        for line in lines:
+            if line[:1] in (" ", "\t") and headers:
+                # Obsolete line folding continues the previous header.
+                key, value = headers[-1]
+                headers[-1] = (key, value + " " + line.strip())
+                continue
+            key, sep, value = line.partition(":")
+            if not sep:
+                raise MalformedResponse("Bad header: %r" % line)
+            headers.append((key.strip(), value.strip()))
+        if len(headers) > self.maxHeaders:
+            raise HeadersTooLarge("Response has more than %d headers" % (
+                    self.maxHeaders))
 
         self.handleStatus(version, status, message)
+        self.handleHeaders(headers)
+        self.handleEndHeaders()
 
+        if self._currentResponseHasContent():
+            self._startContent()
+        else:
+            self.handleResponseEnd()
 
-    def _parseHeader(self, header):
-        key, val = header.split(": ", 1)
-        self.handleHeader(key, val)
+
+    def _parseStatusLine(self, line):
+        info = line.split(None, 2)
+        try:
+            if len(info) == 3:
+                version, status, message = info
+            else:
+                version, status = info
+                message = ""
+            status = int(status)
+        except ValueError:
+            raise MalformedResponse("Bad status line: %r" % line)
+        if not 0 < status < 1000:
+            raise MalformedResponse("Bad status: %r" % line)
+        return version, status, message
+
+
+    def _malformedResponse(self, reason):
+        """Fail the current response; the connection cannot be trusted to
+        deliver the rest.
+        """
+        log.debug("%r: %s" % (self, reason))
+        response = self._pendingResponses.pop(0)
+        totalTimer = self._totalTimers.pop(response, None)
+        if totalTimer is not None:
+            totalTimer.cancel()
+        self._retiring = True
+        self.transport.loseConnection()
+        response.request.response.errback(Failure(reason))
 
 
     def _loadDecoders(self):
+        """Prepare the current response's body to be decoded: chunking
+        here, and its other codings by the response.
+        """
         self._chunkDecoder = None
-        self._genericDecoders = list()
+        transferDecoders = list()
 
-        encodingHeaders = self._currentResponse.headers.get("transfer-encoding")
+        encodingHeaders = self._currentResponse.headers.getRawHeaders(
+                "transfer-encoding")
         if encodingHeaders:
-            encodings = encodingHeaders[0].split(",")
+            encodings = ",".join(encodingHeaders).lower().split(",")
 
             for encoding in encodings:
                 decoderClass = getIncrementalDecoder(encoding)
-                if decoderClass:
-                    if encoding == "chunked":
-                        self._chunkDecoder = decoderClass()
-                    else:
-                        self._genericDecoders.append(decoderClass())
-
+                if decoderClass is ChunkingIncrementalDecoder:
+                    self._chunkDecoder = decoderClass()
+                elif decoderClass:
+                    transferDecoders.append(decoderClass())
 
-    def _decodeData(self, data):
-        assert data is not None
+        self._currentResponse.buildPipeline(transferDecoders)
 
-        for decoder in self._genericDecoders:
-            data = decoder.decode(data)
 
-        return data
+    def _determineContentLength(self):
+        lengths = self._currentResponse.headers.getRawHeaders(
+                "content-length")
+        if lengths:
+            self._contentLength = int(lengths[-1])
+            self._currentResponse.request.expectedSize = self._contentLength
 
 
-    def _determineContentLength(self):
-        if "content-length" in self._currentResponse.headers:
-            length = self._currentResponse.headers["content-length"][-1]
-            self._contentLength = int(length)
+    @property
+    def contentReceived(self):
+        """The number of content bytes received for the current response."""
+        return self._contentSize or 0
 
 
     def _currentResponseHasContent(self):
@@ -214,60 +908,73 @@ class HTTPProtocol(basic.LineReceiver, policies.TimeoutMixin):
     # HTTP Content received as raw data
     #
 
-    def setRawMode(self):
-        basic.LineReceiver.setRawMode(self)
+    def _startContent(self):
+        self._readingContent = True
         self._contentSize = 0
 
 
     def rawDataReceived(self, raw):
-        content, final, raw = self._processContent(raw)
+        """Handle content.  Returns data following the response."""
+        try:
+            content, final, raw = self._processContent(raw)
+        except MalformedResponse, e:
+            self._readingContent = False
+            self._malformedResponse(e)
+            return ""
 
-        self.handleContent(content)
+        if content:
+            self.handleContent(content)
 
         assert not (raw and not final)
         if final:
             self.handleResponseEnd()
+        return raw
 
-            if raw:
-                self.dataReceived(raw)
+
+    def _contentComplete(self):
+        """Whether the current response's body (if any) has all arrived."""
+        if self.timedOut:
+            return False
+        elif not self._readingContent:
+            return True
+        elif self._chunkDecoder is not None:
+            return False  # It is dropped once the last chunk is read.
+        elif self._contentLength is not None:
+            return self._contentSize == self._contentLength
+        return True  # Delimited by the end of the connection
 
 
     def _processContent(self, raw):
+        """Returns (content, final, raw): the content in raw, still in any
+        codings other than chunked; whether it ends the response; and the
+        data following it.
+        """
         if self._chunkDecoder:
-            data = self._chunkDecoder.decode(raw)
+            content = self._chunkDecoder.decode(raw)
             final = self._chunkDecoder.finished
             if final:
                 raw = self._chunkDecoder.getExtra()
+                for name, value in self._chunkDecoder.trailers:
+                    self.handleHeader(name, value)
                 self._chunkDecoder = None
             else:
                 raw = ""
 
-            content = self._decodeData(data)
-            self._contentSize += len(content)
+        elif self._contentLength is None:
+            content, final, raw = raw, False, ""
 
         else:
-            assert self._contentSize is not None
-            if self._contentLength is not None:
-                assert 0 <= self._contentSize <= self._contentLength, \
-                        "Content size (%d) is greater than content length (%d)" % \
-                        (self._contentSize, self._contentLength)
-
-                if self._contentSize + len(raw) > self._contentLength:
-                    dataLen = self._contentLength - self._contentSize
-                    data, raw = raw[:dataLen], raw[dataLen:]
-                else:
-                    data, raw = raw, ""
-            else:
-                data, raw = raw, ""
-
-            self._contentSize += len(data)
-            content = self._decodeData(data)
-
-            if self._contentLength is not None:
-                final = bool(self._contentSize == self._contentLength)
+            assert 0 <= self._contentSize <= self._contentLength, \
+                    "Content size (%d) is greater than content length (%d)" % \
+                    (self._contentSize, self._contentLength)
+            remaining = self._contentLength - self._contentSize
+            if len(raw) < remaining:
+                content, final, raw = raw, False, ""
             else:
-                final = False
+                content, raw = raw[:remaining], raw[remaining:]
+                final = True
 
+        self._contentSize += len(content)
         return (content, final, raw)
 
 
@@ -275,9 +982,26 @@ class HTTPProtocol(basic.LineReceiver, policies.TimeoutMixin):
     # Handle the response as it is parsed
     #
 
+    def handleInformational(self, status):
+        """An interim (1xx) response preceded the current response."""
+        if status == CONTINUE and self._continuing is not None:
+            self._sendContinuedContent()
+
+
     def handleStatus(self, version, status, message):
         """Initial response."""
         self._currentResponse.gotStatus(version, status, message)
+        if self._continuing is not None:
+            self._abandonContinuedContent()
+        elif (self._isProducing(self._currentResponse.request)
+                and self._currentResponse.status not in OKAY_CODES):
+            self._stopProducing()
+
+
+    def handleHeaders(self, headers):
+        """A response's headers, as (key, value) pairs."""
+        for key, value in headers:
+            self.handleHeader(key, value)
 
 
     def handleHeader(self, key, value):
@@ -295,48 +1019,77 @@ class HTTPProtocol(basic.LineReceiver, policies.TimeoutMixin):
 
     def handleResponseEnd(self):
         response = self._pendingResponses.pop(0)
+        response.complete = self._contentComplete()
         response.done()
 
-        self.handleResponse(response)
-        self.setLineMode()
+        totalTimer = self._totalTimers.pop(response, None)
+        if totalTimer is not None:
+            totalTimer.cancel()
+        if self._connected and self._firstByteAt is not None:
+            self.timeouts.recordTransfer(self.contentReceived,
+                    self.wheel.seconds() - self._firstByteAt)
+            self._firstByteAt = None
+        self._lastReadAt = None
+
+        if self._pendingResponses:
+            self._setReadTimer("firstByte")
+        else:
+            self._cancelReadTimer()
 
+        self._contentLength = None
+        self._contentSize = None
+        self._responsesReceived += 1
 
-    def handleResponse(self, response):
-        # Done processing the current request
-        #logFmt = "%r: %s: handling %%s response %r [%d]" % (
-        #         self, response.request, response, len(response))
+        answered = not self._expectationFailed(response)
+        self._readingContent = False
 
-        if self.timedOut:
-            #log.debug(logFmt % "timed-out")
-            response.status = http.REQUEST_TIMEOUT
-            responseValue = ResponseTimeout.Failure(response, self.timeOut)
+        self._updatePersistence(response)
+        if self._retiring:
+            if not self._pendingResponses and self._connected:
+                self.transport.loseConnection()
+        else:
+            self._sendWaitingRequest()
+            if not (self._pendingResponses or self._sendable):
+                self._idleSince = reactor.seconds()
+                self._startIdleTimeout()
 
-        elif response.status in REDIRECT_CODES:
-            # Response redirected
-            #log.debug(logFmt % "redirect")
-            responseValue = RedirectedResponse.Failure(response)
+        if answered:
+            # Last: the caller may issue its next request to us directly.
+            self.handleResponse(response)
 
-        elif response.status in RETRY_CODES:
-            # Response redirected
-            #log.debug(logFmt % "redirect")
-            responseValue = RetryResponse.Failure(response)
 
-        elif response.status in UNAUTHORIZED_CODES:
-            # Response unauthorized
-            #log.debug(logFmt % "unauthorized")
-            responseValue = UnauthorizedResponse.Failure(response)
 
-        elif response.status in OKAY_CODES:
-            # SUCCESS
-            #log.debug(logFmt % "success")
-            responseValue = response
+class _BodyConsumer(object):
+    """Writes a request body to a transport, in chunks if chunked."""
 
+    def __init__(self, transport, chunked=False):
+        self.transport = transport
+        self.chunked = chunked
+        self.length = 0
+
+
+    def write(self, data):
+        if not data:
+            return
+        self.length += len(data)
+        if self.chunked:
+            self.transport.writeSequence(["%x%s" % (len(data), CRLF),
+                                          data, CRLF])
         else:
-            # Generic failure
-            #log.debug(logFmt % "failure")
-            responseValue = WebError.Failure(response)
+            self.transport.write(data)
+
+
+    def registerProducer(self, producer, streaming):
+        pass  # The protocol registers it with the transport.
+
 
-        reactor.callLater(0, response.request.response.callback, responseValue)
+    def unregisterProducer(self):
+        pass
+
+
+    def finish(self):
+        if self.chunked:
+            self.transport.write("0%s%s" % (CRLF, CRLF))
 
 
 
@@ -356,6 +1109,8 @@ class SOCKSv4ClientProtocol(protocol.Protocol):
     _REQUEST_REJECTED_IDENTD_CODE = 0x5c
     _REQUEST_REJECTED_USER_CODE = 0x5d
 
+    resolver = None  # An IResolverSimple [default: reactor.resolver]
+
     def __init__(self):
         self.__tunnel = None
 
@@ -372,7 +1127,8 @@ class SOCKSv4ClientProtocol(protocol.Protocol):
 
     @inlineCallbacks
     def openConnection(self, host, port, user=""):
-        hostIP = yield reactor.resolve(host)
+        resolver = self.resolver or reactor.resolver
+        hostIP = yield resolver.getHostByName(host)
         server = inet_aton(hostIP)
 
         packed = pack("!BBH", self._VERSION_CODE, self._CONNECT_CODE, port)
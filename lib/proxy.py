@@ -45,6 +45,8 @@ class Proxy(RequesterBase):
         protocol = RequesterBase.buildProtocol(self, addr)
         protocol.remoteHost = self.remoteHost
         protocol.remotePort = self.remotePort
+        # Resolve the remote host as connections resolve theirs.
+        protocol.resolver = getattr(self.dialer, "resolver", None)
 
         return protocol
 
@@ -59,9 +61,8 @@ class HTTPProxy(Proxy):
 
 class HTTPProxyProtocol(HTTPProtocol):
 
-    def sendCommand(self, request):
-        command = "%s %s HTTP/1.1%s" % (request.method, request.url, CRLF)
-        self.transport.write(command)
+    def formatCommand(self, request):
+        return "%s %s HTTP/1.1%s" % (request.method, request.url, CRLF)
 
 
 
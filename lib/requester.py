@@ -1,14 +1,19 @@
+from collections import deque, OrderedDict
+from urllib import unquote
+
 from twisted.internet import reactor
-from twisted.internet.defer import (
-        Deferred, DeferredList, succeed,
-        inlineCallbacks, returnValue)
+from twisted.internet.defer import Deferred, DeferredList, succeed
 from twisted.internet.interfaces import IProtocolFactory
-from twisted.internet.error import ConnectionDone
+from twisted.internet.error import ConnectionDone, TimeoutError
 
 from twisted.internet.protocol import ClientFactory as _ClientFactory
 from zope.interface import Attribute, Interface, implements
 
+from pendrell import log
+from pendrell.eyeballs import getHappyEyeballs
 from pendrell.protocols import HTTPProtocol
+from pendrell.sockets import SocketProfile
+from pendrell.timeouts import Timeouts, getTimerWheel
 
 
 
@@ -28,14 +33,35 @@ class IRequester(IProtocolFactory):
 
 
 class Multiplexer(object):
+    """Dispatches requests over a bounded set of connections to one site.
+
+    When all connections are busy, requests wait in a single FIFO queue and
+    requesters hand themselves directly to the first waiter as they become
+    available.  If pipelining is allowed (pipelineDepth > 0), idempotent
+    requests are instead issued to the requester with the fewest outstanding
+    bytes and requests, provided it has room in its pipeline.
+
+    The size of each response is remembered by path and query.  Requests
+    expected to be smaller than bulkThreshold are not queued behind a
+    connection that is transferring at least bulkThreshold bytes.  If
+    maxBulkConnections is non-zero, that many of the maxConnections (leaving
+    at least one) are set aside for larger requests, so that they cannot tie
+    up the connections used by small requests.
+    """
     implements(IRequester)
 
     maxConnections = 2
     timeout = None
+    pipelineDepth = 0
+
+    bulkThreshold = 1024 * 1024
+    maxBulkConnections = 0
+    maxSizeHistory = 1024
 
     def __init__(self, requesterClass, scheme, host, port, **kw):
         self.requesterClass = requesterClass
         self._requesters = list()
+        self._waiters = deque()
 
         self.scheme = scheme
         self.host = host
@@ -43,6 +69,27 @@ class Multiplexer(object):
 
         self.maxConnections = kw.pop("maxConnections", self.maxConnections)
         self.timeout = kw.pop("timeout", self.timeout)
+        self.timeouts = Timeouts.fromValue(self.timeout).forOrigin(str(self))
+        self.pipelineDepth = int(kw.pop("pipelineDepth", self.pipelineDepth))
+        self.bulkThreshold = kw.pop("bulkThreshold", self.bulkThreshold)
+        self.maxBulkConnections = kw.pop("maxBulkConnections",
+                self.maxBulkConnections)
+        self._requesterKw = kw  # Passed on to requesterClass
+
+        self._sizeHistory = OrderedDict()
+        if self.maxConnections is not None:
+            self.maxBulkConnections = min(self.maxBulkConnections,
+                    self.maxConnections - 1)
+        if self.bulkThreshold and self.maxBulkConnections:
+            self._bulkMultiplexer = self.__class__(requesterClass,
+                    scheme, host, port,
+                    maxConnections = self.maxBulkConnections,
+                    timeout = self.timeouts,
+                    pipelineDepth = self.pipelineDepth,
+                    bulkThreshold = None,
+                    **kw)
+        else:
+            self._bulkMultiplexer = None
 
 
     @property
@@ -59,45 +106,147 @@ class Multiplexer(object):
 
     def buildRequester(self):
         return self.requesterClass(self.scheme, self.host, self.port,
-                timeout=self.timeout)
+                timeout=self.timeouts, multiplexer=self,
+                pipelineDepth=self.pipelineDepth, **self._requesterKw)
 
 
     def getAvailableRequesters(self):
         return [r for r in self._requesters if not r.active]
 
 
-    @inlineCallbacks
     def issueRequest(self, request):
-        requester = yield self._waitForAvailableRequester()
-        response = yield requester.issueRequest(request)
-        returnValue(response)
+        request.expectedSize = self.getExpectedSize(request)
+
+        if self._bulkMultiplexer is not None and self._isBulk(request):
+            d = self._bulkMultiplexer.issueRequest(request)
+
+        else:
+            requester = self._getAvailableRequester(request)
+            if requester is not None:
+                d = requester.issueRequest(request)
+            else:
+                # Handed a requester by requesterAvailable().
+                d = Deferred()
+                self._waiters.append((request, d))
+                d.addCallback(self._issueTo, request)
+
+        d.addCallback(self._responded, request)
+        return d
+
+
+    def _issueTo(self, requester, request):
+        return requester.issueRequest(request)
+
+
+    def _responded(self, response, request):
+        self._recordSize(request, response)
+        return response
+
+
+    def _sizeKey(self, request):
+        # The query often selects a different entity (e.g. ?page=2).
+        url = request.url
+        if url.query:
+            return "%s?%s" % (url.path, url.query)
+        return url.path
+
+
+    def getExpectedSize(self, request):
+        """Estimate the size of a request's response from prior responses."""
+        key = self._sizeKey(request)
+        size = self._sizeHistory.pop(key, None)
+        if size is None:
+            return request.expectedSize
+        self._sizeHistory[key] = size
+        return size
+
+
+    def _recordSize(self, request, response):
+        # Only complete entities describe the resource's size.
+        if request.method == "HEAD" or response.status != 200:
+            return
+
+        lengths = response.headers.getRawHeaders("content-length")
+        size = int(lengths[-1]) if lengths else len(response)
+
+        key = self._sizeKey(request)
+        self._sizeHistory.pop(key, None)
+        self._sizeHistory[key] = size
+        while len(self._sizeHistory) > self.maxSizeHistory:
+            self._sizeHistory.popitem(last=False)
+
+
+    def _isBulk(self, request):
+        return bool(self.bulkThreshold
+                and request.expectedSize >= self.bulkThreshold)
 
 
-    @inlineCallbacks
-    def _waitForAvailableRequester(self):
-        available = self.getAvailableRequesters()
-        if available:
-            requester = available[0]
+    def _isLoaded(self, requester):
+        return bool(self.bulkThreshold
+                and requester.outstandingBytes >= self.bulkThreshold)
 
-        elif (self.maxConnections is None
-                or len(self._requesters) < self.maxConnections):
+
+    def _getAvailableRequester(self, request):
+        """A requester that request may be issued to now, or None if it
+        must wait.
+        """
+        for requester in self._requesters:
+            if not requester.active:
+                return requester
+
+        if (self.maxConnections is None
+                or len(self._requesters) < self._maxOwnConnections):
             requester = self.buildRequester()
             self._requesters.append(requester)
+            return requester
 
-        else:
-            assert (self.maxConnections is None 
-                    or len(self._requesters) == self.maxConnections)
-            requester, idx = yield DeferredList(
-                [r.waitForAvailability() for r in self._requesters],
-                fireOnOneCallback=True)
+        assert len(self._requesters) == self._maxOwnConnections
+        if self.pipelineDepth and not self._waiters:
+            requester = self._getLeastOutstandingRequester()
+            if self._canIssue(requester, request):
+                return requester
+        return None
+
+
+    @property
+    def _maxOwnConnections(self):
+        # Bulk connections count against maxConnections.
+        if self._bulkMultiplexer is None:
+            return self.maxConnections
+        return self.maxConnections - self._bulkMultiplexer.maxConnections
+
+
+    def _getLeastOutstandingRequester(self):
+        return min(self._requesters,
+                key=lambda r: (r.outstandingBytes, r.outstanding))
+
+
+    def _canIssue(self, requester, request):
+        """True iff request may be issued to requester immediately."""
+        if not requester.active:
+            return True
+        if not (self.pipelineDepth and request.idempotent
+                and requester.outstanding <= self.pipelineDepth):
+            return False
+        return self._isBulk(request) or not self._isLoaded(requester)
 
-        returnValue(requester)
+
+    def requesterAvailable(self, requester):
+        """Hand a requester to the longest-waiting request, if it may be
+        issued to it.
+
+        Requesters call this whenever one of their responses completes.
+        """
+        while self._waiters and self._canIssue(requester, self._waiters[0][0]):
+            request, d = self._waiters.popleft()
+            d.callback(requester)
 
 
     def loseConnection(self):
-        return DeferredList([
-            r.loseConnection() for r in self._requesters
-            ])
+        ds = [r.loseConnection() for r in self._requesters]
+        if self._bulkMultiplexer is not None:
+            ds.append(self._bulkMultiplexer.loseConnection())
+        return DeferredList(ds)
 
 
 
@@ -105,20 +254,34 @@ class RequesterBase(_ClientFactory):
 
     noisy = False
     secure = False
+    contextFactory = None  # Builds TLS contexts, for secure requesters
+
+    # Number of times a request may be re-sent after its connection is lost.
+    maxReplays = 2
 
-    def __init__(self, scheme, host, port, timeout=None):
+    def __init__(self, scheme, host, port, timeout=None, multiplexer=None,
+            pipelineDepth=0, dialer=None, socketProfile=None):
         self.scheme = scheme
         self.host, self.port = host, int(port)
 
-        self._availability = None
         self._requestQueue = list()  # Queue of unissued requests
+        self._replayQueue = list()  # Requests to be re-sent
         self._nextRequest = None
-        self._pendingResponseCount = 0
+        self._pendingRequests = list()  # Sent (or being sent) requests
 
         self._connector = None
+        self._connectTimer = None
+        self._currentProtocol = None
         self._connectionLost = None
 
         self.timeout = timeout
+        self.timeouts = Timeouts.fromValue(timeout)
+        self.wheel = getTimerWheel()
+        self.multiplexer = multiplexer
+        self.pipelineDepth = pipelineDepth
+        # Provides connectTCP and connectSSL, like the reactor.
+        self.dialer = dialer or getHappyEyeballs()
+        self.socketProfile = SocketProfile.fromValue(socketProfile)
 
 
     def __str__(self):
@@ -130,16 +293,40 @@ class RequesterBase(_ClientFactory):
 
     @property
     def active(self):
-        return bool(self._pendingResponseCount or self._requestQueue)
+        return bool(self._pendingRequests or self._requestQueue)
+
+
+    @property
+    def outstanding(self):
+        """The number of issued requests that have not been responded to."""
+        return len(self._pendingRequests) + len(self._requestQueue)
+
+
+    @property
+    def outstandingBytes(self):
+        """The number of response bytes expected but not yet received."""
+        expected = sum(r.expectedSize for r in self._pendingRequests) \
+                + sum(r.expectedSize for r in self._requestQueue)
+        if self._currentProtocol is not None:
+            expected -= self._currentProtocol.contentReceived
+        return max(expected, 0)
 
 
-    @inlineCallbacks
     def issueRequest(self, request):
+        """Queue request for the connection.
+
+        Returns a Deferred that fires with request's response once this
+        requester has finished with the request, so that a follow-up request
+        may reuse the connection.  request.response is the protocol's
+        channel to the requester, and callers do not add to it.
+        """
         assert self._nextRequest is None or len(self._requestQueue) == 0
 
         # Buffer requests until the connection is made.  Once connected,
         # send requests to the server.
         self._requestQueue.append(request)
+        d = Deferred()
+        request.response.addBoth(self._responded, request, d)
 
         # Otherwise, queue the request and initiate a connection.
         # Once the connection is complete, the protocol will call
@@ -147,15 +334,19 @@ class RequesterBase(_ClientFactory):
         if self.disconnected:
             self.connect()
 
-        # If a connected protocol is waiting for a request, issue it
-        # (after the execution chain terminates).
-        if self._nextRequest:
-            reactor.callLater(0, self._nextRequest.callback, request)
-            self._nextRequest = None
+        # A connected protocol waiting for a request is handed it now.  It
+        # took its Deferred from getNextRequest() last, so may be resumed
+        # here.
+        if self._nextRequest is not None:
+            waiting, self._nextRequest = self._nextRequest, None
+            waiting.callback(self._dequeueRequest())
 
-        response = yield request.response
+        return d
 
-        returnValue(response)
+
+    def _responded(self, result, request, d):
+        self._requestFinished(request)
+        d.callback(result)
 
 
     @property
@@ -164,59 +355,54 @@ class RequesterBase(_ClientFactory):
                 or self._connector.state == "disconnected")
 
 
-    @inlineCallbacks
     def getNextRequest(self):
-        if len(self._requestQueue) == 0:
-            yield self._waitForRequest()
-
-        request = self._requestQueue.pop(0)
-
-        self._watchResponseFor(request)
-
-        returnValue(request)
-
+        """Fires with the next request to send, as soon as there is one."""
+        if self._replayQueue:
+            # Already being watched.
+            return succeed(self._replayQueue.pop(0))
 
-    def _waitForRequest(self):
-        assert len(self._requestQueue) == 0
+        if self._requestQueue:
+            return succeed(self._dequeueRequest())
 
         if self._nextRequest is None:
             self._nextRequest = Deferred()
-
         return self._nextRequest
 
 
-    @inlineCallbacks
+    def _dequeueRequest(self):
+        request = self._requestQueue.pop(0)
+        self._watchResponseFor(request)
+        return request
+
+
     def _watchResponseFor(self, request):
-        assert self._pendingResponseCount >= 0
+        self._pendingRequests.append(request)
 
-        self._pendingResponseCount += 1
-        try:
-            response = yield request.response
 
-        finally:
-            assert self._pendingResponseCount > 0
-            self._pendingResponseCount -= 1
+    def _requestFinished(self, request):
+        if request in self._pendingRequests:
+            self._pendingRequests.remove(request)
+            self._becameAvailable()
 
-            if not self.active:
-                if self._availability is not None:
-                    a, self._availability = self._availability, None
-                    reactor.callLater(0, a.callback, self)
 
-        returnValue(response)
+    def replayRequests(self, requests):
+        """Re-send requests that were not answered before their connection was
+        lost.  They are sent before any queued requests once reconnected.
+        """
+        self._replayQueue.extend(requests)
+        if self.disconnected:
+            self.connect()
 
-    def waitForAvailability(self):
-        if self._availability is not None:
-            d = self._availability
-        elif not self.active:
-            d = succeed(self)
-        else:
-            d = self._availability = Deferred()
-        return d
+
+    def _becameAvailable(self):
+        if self.multiplexer is not None:
+            self.multiplexer.requesterAvailable(self)
 
 
     def connect(self):
         assert self.disconnected
-        return reactor.connectTCP(self.host, self.port, self, timeout=self.timeout)
+        # Connection timeouts are kept on the timer wheel.
+        return self.dialer.connectTCP(self.host, self.port, self, timeout=None)
 
 
     def buildProtocol(self, addr):
@@ -226,18 +412,39 @@ class RequesterBase(_ClientFactory):
         proto.host = self.host
         proto.port = self.port
 
-        if self.timeout is not None:
-            proto.setTimeout(self.timeout)
+        proto.pipelineDepth = self.pipelineDepth
+        proto.timeouts = self.timeouts
+        proto.wheel = self.wheel
+        proto.socketProfile = self.socketProfile
+        self._currentProtocol = proto
+        self._cancelConnectTimer()
 
         return proto
 
 
     def startedConnecting(self, connector):
         self._connector = connector
+        if self.timeouts.connect is not None:
+            self._connectTimer = self.wheel.schedule(self.timeouts.connect,
+                    self._connectTimedOut, connector)
+
+
+    def _connectTimedOut(self, connector):
+        self._connectTimer = None
+        if connector.state == "connecting":
+            connector.transport.failIfNotConnected(TimeoutError())
+
+
+    def _cancelConnectTimer(self):
+        if self._connectTimer is not None:
+            self._connectTimer.cancel()
+            self._connectTimer = None
 
 
     def clientConnectionLost(self, connector, reason):
         """Called when an established connection is lost."""
+        self._currentProtocol = None
+
         if self._connectionLost:
             self._connectionLost.callback(True)
             self._connectionLost = None
@@ -246,7 +453,7 @@ class RequesterBase(_ClientFactory):
             self._nextRequest.errback(reason)
             self._nextRequest = None
 
-        if reason.check(ConnectionDone):
+        if self._replayQueue or reason.check(ConnectionDone):
             self._reconnectIfRequestsQueued(connector)
         else:
             self._failQueuedRequests(reason)
@@ -254,6 +461,7 @@ class RequesterBase(_ClientFactory):
 
     def clientConnectionFailed(self, connector, reason):
         assert self._nextRequest is None
+        self._cancelConnectTimer()
 
         #self._reconnectIfRequestsQueued(connector)
         self._failQueuedRequests(reason)
@@ -269,13 +477,18 @@ class RequesterBase(_ClientFactory):
 
 
     def _failQueuedRequests(self, reason):
+        while self._replayQueue:
+            self._replayQueue.pop(0).response.errback(reason)
+
         while self._requestQueue:
             self._requestQueue.pop(0).response.errback(reason)
 
+        self._becameAvailable()
+
 
     def _reconnectIfRequestsQueued(self, connector):
-        # TODO Limit number of retries
-        count = len(self._requestQueue)
+        # Replays are limited by maxReplays.
+        count = len(self._replayQueue) + len(self._requestQueue)
         if count > 0:
             connector.connect()
 
@@ -298,20 +511,46 @@ class HTTPSRequester(HTTPRequester):
 
     secure = True
 
-    def __init__(self, *args, **kw):
-        HTTPRequester.__init__(self, *args, **kw)
+    def __init__(self, scheme, host, port, tlsContexts=None, **kw):
+        HTTPRequester.__init__(self, scheme, host, port, **kw)
 
         if not self.scheme == "https":
-            log.warn("Unexpected URL scheme: %s" % scheme)
-        from twisted.internet import ssl
+            log.warn("Unexpected URL scheme: %s" % self.scheme)
 
-        # XXX AFAIK this does nothing to handle trusted CAs
-        self._context =  ssl.ClientContextFactory()
+        # Connections to an origin share a context, to resume TLS sessions.
+        from pendrell.tls import getTLSContextCache
+        if tlsContexts is None:
+            tlsContexts = getTLSContextCache()
+        self.contextFactory = tlsContexts.getContextFactory(self.host,
+                self.port)
 
 
     def connect(self):
         log.debug("Connecting over SSL to %s:%s" % (self.host, self.port))
-        reactor.connectSSL(self.host, self.port, self, self._context)
+        return self.dialer.connectSSL(self.host, self.port, self,
+                self.contextFactory, timeout=None)
+
+
+
+class HTTPUNIXRequester(HTTPRequester):
+    """Issues HTTP requests over a Unix domain socket.
+
+    The socket is socketPath or, for http+unix URLs, the URL's
+    percent-encoded host (e.g. http+unix://%2Fvar%2Frun%2Fapi.sock/path).
+    """
+
+    def __init__(self, scheme, host, port, socketPath=None, **kw):
+        HTTPRequester.__init__(self, scheme, host, port, **kw)
+        self.socketPath = socketPath or unquote(host)
+
+
+    def __str__(self):
+        return "%s://%s" % (self.scheme, self.socketPath)
+
+
+    def connect(self):
+        assert self.disconnected
+        return reactor.connectUNIX(self.socketPath, self, timeout=None)
 
 
 
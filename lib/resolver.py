@@ -0,0 +1,301 @@
+"""Host name resolution.
+
+A CachingResolver keeps each host's addresses for the TTL of its records,
+refreshes names still in use shortly before they expire, briefly remembers
+names that failed to resolve, and answers overridden hosts without a lookup.
+
+Lookups provide lookup(host), firing with (addresses, ttl): addresses are
+(family, address) pairs and ttl is seconds, or None if it is unknown.
+"""
+
+import socket
+from collections import OrderedDict
+
+from twisted.internet import error as netErr, threads
+from twisted.internet.defer import Deferred, DeferredList, fail, succeed
+
+from pendrell import log
+from pendrell.util import addressFamily, isAddress
+
+
+
+class SystemLookup(object):
+    """Resolves with getaddrinfo(3), in a thread.  TTLs are not known."""
+
+    def lookup(self, host):
+        return threads.deferToThread(self._lookup, host)
+
+
+    def _lookup(self, host):
+        try:
+            results = socket.getaddrinfo(host, None, socket.AF_UNSPEC,
+                    socket.SOCK_STREAM)
+        except socket.gaierror, e:
+            raise netErr.DNSLookupError("%s: %s" % (host, e.args[-1]))
+
+        addresses = list()
+        for family, _, _, _, sockaddr in results:
+            if (family, sockaddr[0]) not in addresses:
+                addresses.append((family, sockaddr[0]))
+        return (addresses, None)
+
+
+
+class SimpleLookup(object):
+    """Resolves with an IResolverSimple, e.g. reactor.resolver.  Only IPv4
+    addresses are found, and TTLs are not known.
+    """
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+
+    def lookup(self, host):
+        d = self.resolver.getHostByName(host)
+        d.addCallback(lambda addr: ([(socket.AF_INET, addr)], None))
+        return d
+
+
+
+class NamesLookup(object):
+    """Queries DNS for A and AAAA records with twisted.names, and so learns
+    their TTLs.
+
+    Keyword Arguments:
+        resolver --  An IResolver [default: twisted.names.client's]
+    """
+
+    def __init__(self, resolver=None):
+        if resolver is None:
+            from twisted.names import client
+            resolver = client.getResolver()
+        self.resolver = resolver
+
+
+    def lookup(self, host):
+        # Either query may fail alone.
+        d = DeferredList([self.resolver.lookupAddress(host),
+                          self.resolver.lookupIPV6Address(host)],
+                consumeErrors=True)
+        d.addCallback(self._gotRecords, host)
+        return d
+
+
+    def _gotRecords(self, results, host):
+        from twisted.names import dns
+
+        addresses, ttls, reasons = list(), list(), list()
+        for succeeded, result in results:
+            if not succeeded:
+                reasons.append(result)
+                continue
+            answers, authority, additional = result
+            for record in answers:
+                if record.type == dns.A:
+                    addresses.append((socket.AF_INET,
+                            record.payload.dottedQuad()))
+                elif record.type == dns.AAAA:
+                    addresses.append((socket.AF_INET6, socket.inet_ntop(
+                            socket.AF_INET6, record.payload.address)))
+                else:
+                    continue
+                ttls.append(record.ttl)
+
+        if not addresses:
+            if reasons:
+                return reasons[0]
+            raise netErr.DNSLookupError(host)
+        return (addresses, min(ttls))
+
+
+
+class _Entry(object):
+
+    def __init__(self, addresses, reason, fetched, ttl):
+        self.addresses = addresses
+        self.reason = reason  # A Failure, if the lookup failed
+        self.fetched = fetched
+        self.expires = fetched + ttl
+        self.hits = 0
+        self.refreshing = False
+
+
+
+class CachingResolver(object):
+    """Caches the addresses of hosts.
+
+    Provides getAddresses(host), firing with a list of (family, address),
+    and IResolverSimple's getHostByName().
+
+    The default SystemLookup learns no TTLs, so every name it resolves is
+    kept for defaultTTL; use a NamesLookup to honor the TTLs of records.
+
+    Keyword Arguments:
+        lookup --  [default: SystemLookup(), which gives no TTLs]
+        overrides --  A dict mapping hosts to an address or a list of
+                      addresses, which are not looked up. [default: {}]
+        defaultTTL --  Seconds to keep addresses when the lookup does not
+                       give a TTL [default: 60]
+        minTTL, maxTTL --  Bounds on TTLs [default: 1, 3600]
+        negativeTTL --  Seconds to remember that a host did not resolve
+                        [default: 5]
+        prefetch --  A host used at least twice is refreshed when it is
+                     looked up after this fraction of its TTL has passed.
+                     0 disables refreshing. [default: 0.75]
+        maxEntries --  [default: 1024]
+        clock --  An IReactorTime provider [default: reactor]
+    """
+
+    def __init__(self, lookup=None, overrides=None, defaultTTL=60,
+                 minTTL=1, maxTTL=3600, negativeTTL=5, prefetch=0.75,
+                 maxEntries=1024, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.lookup = lookup or SystemLookup()
+        self.defaultTTL = defaultTTL
+        self.minTTL, self.maxTTL = minTTL, maxTTL
+        self.negativeTTL = negativeTTL
+        self.prefetch = prefetch
+        self.maxEntries = maxEntries
+        self.clock = clock
+
+        self.overrides = dict()
+        for host, addresses in (overrides or {}).iteritems():
+            self.setOverride(host, addresses)
+
+        self._entries = OrderedDict()  # Host => _Entry, least recent first
+        self._lookups = dict()  # Host => [Deferred] awaiting a lookup
+        self._pending = set()  # Hosts being looked up
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def setOverride(self, host, addresses):
+        """Resolve host to addresses (one, or a list) without a lookup."""
+        if isinstance(addresses, basestring):
+            addresses = [addresses]
+        self.overrides[host.lower()] = [(addressFamily(a), a)
+                for a in addresses]
+
+
+    def getAddresses(self, host):
+        host = host.lower()
+        if host in self.overrides:
+            return succeed(list(self.overrides[host]))
+        if isAddress(host):
+            return succeed([(addressFamily(host), host)])
+
+        entry = self._getEntry(host)
+        if entry is None:
+            return self._waitForLookup(host)
+
+        entry.hits += 1
+        if entry.reason is not None:
+            return fail(entry.reason)
+        if self._shouldRefresh(entry):
+            entry.refreshing = True
+            self._lookup(host)
+        return succeed(list(entry.addresses))
+
+
+    def getHostByName(self, name, timeout=None):
+        """The first IPv4 address of name."""
+        d = self.getAddresses(name)
+        d.addCallback(self._firstIPv4Address, name)
+        return d
+
+
+    def _firstIPv4Address(self, addresses, name):
+        for family, addr in addresses:
+            if family == socket.AF_INET:
+                return addr
+        raise netErr.DNSLookupError("%s has no IPv4 address" % name)
+
+
+    def _getEntry(self, host):
+        entry = self._entries.get(host)
+        if entry is not None:
+            if entry.expires <= self.clock.seconds():
+                del self._entries[host]
+                return None
+            # Most recently used last.
+            del self._entries[host]
+            self._entries[host] = entry
+        return entry
+
+
+    def _shouldRefresh(self, entry):
+        if not self.prefetch or entry.refreshing or entry.hits < 2:
+            return False
+        age = self.clock.seconds() - entry.fetched
+        return age >= self.prefetch * (entry.expires - entry.fetched)
+
+
+    def _waitForLookup(self, host):
+        # Wait before looking up: the lookup may fire synchronously.
+        d = Deferred()
+        self._lookups.setdefault(host, []).append(d)
+        self._lookup(host)
+        return d
+
+
+    def _lookup(self, host):
+        if host in self._pending:
+            return
+        self._pending.add(host)
+        d = self.lookup.lookup(host)
+        d.addCallbacks(self._gotAddresses, self._lookupFailed,
+                callbackArgs=(host,), errbackArgs=(host,))
+
+
+    def _gotAddresses(self, result, host):
+        self._pending.discard(host)
+        addresses, ttl = result
+        if ttl is None:
+            ttl = self.defaultTTL
+        ttl = min(max(ttl, self.minTTL), self.maxTTL)
+        self._store(host, _Entry(addresses, None, self.clock.seconds(), ttl))
+
+        for d in self._lookups.pop(host, []):
+            d.callback(list(addresses))
+
+
+    def _lookupFailed(self, reason, host):
+        self._pending.discard(host)
+        waiters = self._lookups.pop(host, [])
+        entry = self._entries.get(host)
+        if entry is not None and entry.reason is None and not waiters:
+            # A refresh failed; the addresses stand until they expire.
+            log.debug("Refreshing %s failed: %s" % (host,
+                    reason.getErrorMessage()))
+            entry.refreshing = False
+            return
+
+        self._store(host, _Entry(None, reason, self.clock.seconds(),
+                self.negativeTTL))
+        for d in waiters:
+            d.errback(reason)
+
+
+    def _store(self, host, entry):
+        self._entries.pop(host, None)
+        self._entries[host] = entry
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+
+
+
+_resolver = None
+
+def getResolver():
+    """The CachingResolver shared by connections not given one."""
+    global _resolver
+    if _resolver is None:
+        _resolver = CachingResolver()
+    return _resolver
+
+
+
+__id__ = "$Id: $"[5:-2]
@@ -0,0 +1,187 @@
+"""Socket options for HTTP connections.
+
+A SocketProfile is applied to each TCP connection a requester makes: before
+it connects, when the dialer allows (buffer sizes are best set before the
+window scale is negotiated, and TCP Fast Open must be), and again once it
+has.  Options the platform lacks are skipped.
+"""
+
+import socket, sys
+
+from pendrell import log
+
+
+# Linux constants that the socket module may not define.
+_LINUX = sys.platform.startswith("linux")
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", _LINUX and 12 or None)
+TCP_KEEPIDLE = getattr(socket, "TCP_KEEPIDLE", _LINUX and 4 or None)
+TCP_KEEPINTVL = getattr(socket, "TCP_KEEPINTVL", _LINUX and 5 or None)
+TCP_KEEPCNT = getattr(socket, "TCP_KEEPCNT", _LINUX and 6 or None)
+TCP_FASTOPEN_CONNECT = getattr(socket, "TCP_FASTOPEN_CONNECT",
+        _LINUX and 30 or None)
+
+_TCP_FAMILIES = (socket.AF_INET, socket.AF_INET6)
+
+
+
+class SocketProfile(object):
+    """Socket options for a site's connections.
+
+    An option that is None is left at the system's default.
+
+    Attributes:
+        noDelay --  Disable Nagle's algorithm (TCP_NODELAY), so that small
+                    writes are not held back waiting for an ACK.
+        receiveBuffer, sendBuffer --  SO_RCVBUF and SO_SNDBUF, in bytes.
+        quickAck --  ACK every read immediately (TCP_QUICKACK, Linux).  The
+                     kernel clears it, so it is set again after each read.
+        keepAlive --  Probe idle connections (SO_KEEPALIVE).
+        keepAliveIdle, keepAliveInterval --  Seconds idle before the first
+                                             probe, and between probes.
+        keepAliveCount --  Unanswered probes before the connection is
+                           dropped.
+        fastOpen --  Send the first request with the SYN
+                     (TCP_FASTOPEN_CONNECT, Linux 4.11) once the server has
+                     issued a cookie.  Only set by dialers that build their
+                     own sockets, e.g. pendrell.eyeballs.HappyEyeballs.
+                     Connecting then succeeds at once, so a refused
+                     connection is only noticed when the request is sent,
+                     and Happy Eyeballs cannot race a site's addresses.
+    """
+
+    options = ("noDelay", "receiveBuffer", "sendBuffer", "quickAck",
+               "keepAlive", "keepAliveIdle", "keepAliveInterval",
+               "keepAliveCount", "fastOpen")
+
+    def __init__(self, noDelay=True, receiveBuffer=None, sendBuffer=None,
+                 quickAck=None, keepAlive=None, keepAliveIdle=None,
+                 keepAliveInterval=None, keepAliveCount=None, fastOpen=None):
+        self.noDelay = noDelay
+        self.receiveBuffer = receiveBuffer
+        self.sendBuffer = sendBuffer
+        self.quickAck = quickAck
+        self.keepAlive = keepAlive
+        self.keepAliveIdle = keepAliveIdle
+        self.keepAliveInterval = keepAliveInterval
+        self.keepAliveCount = keepAliveCount
+        self.fastOpen = fastOpen
+
+
+    def __repr__(self):
+        options = ", ".join("%s=%r" % (o, getattr(self, o))
+                for o in self.options if getattr(self, o) is not None)
+        return "<%s: %s>" % (self.__class__.__name__, options)
+
+
+    @classmethod
+    def fromValue(klass, profile):
+        """Build a SocketProfile from a SocketProfile, a dict of options, or
+        the name of one of the profiles below.
+        """
+        if profile is None:
+            return klass()
+        elif isinstance(profile, SocketProfile):
+            return profile
+        elif isinstance(profile, dict):
+            return klass(**profile)
+        elif profile in PROFILES:
+            return PROFILES[profile]
+        else:
+            raise ValueError("Unknown socket profile: %r" % (profile,))
+
+
+    def beforeConnect(self, sock):
+        """Set the options that must precede connect(2)."""
+        if getattr(sock, "family", None) not in _TCP_FAMILIES:
+            return
+        self._setBuffers(sock)
+        if self.fastOpen is not None:
+            self._set(sock, socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT,
+                    self.fastOpen, "TCP_FASTOPEN_CONNECT")
+
+
+    def connected(self, sock):
+        """Set the options of a connected socket.
+
+        Returns True if sock is a TCP socket.
+        """
+        if getattr(sock, "family", None) not in _TCP_FAMILIES:
+            return False
+
+        self._setBuffers(sock)
+        if self.noDelay is not None:
+            self._set(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                    self.noDelay, "TCP_NODELAY")
+        self.readFrom(sock)
+
+        if self.keepAlive is not None:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_KEEPALIVE,
+                    self.keepAlive, "SO_KEEPALIVE")
+        if self.keepAlive:
+            for value, option, name in (
+                    (self.keepAliveIdle, TCP_KEEPIDLE, "TCP_KEEPIDLE"),
+                    (self.keepAliveInterval, TCP_KEEPINTVL, "TCP_KEEPINTVL"),
+                    (self.keepAliveCount, TCP_KEEPCNT, "TCP_KEEPCNT")):
+                if value is not None:
+                    self._set(sock, socket.IPPROTO_TCP, option, value, name)
+        return True
+
+
+    def readFrom(self, sock):
+        """Called after each read from a connected TCP socket."""
+        if self.quickAck is not None:
+            self._set(sock, socket.IPPROTO_TCP, TCP_QUICKACK, self.quickAck,
+                    "TCP_QUICKACK")
+
+
+    def _setBuffers(self, sock):
+        if self.receiveBuffer is not None:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_RCVBUF,
+                    self.receiveBuffer, "SO_RCVBUF")
+        if self.sendBuffer is not None:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_SNDBUF,
+                    self.sendBuffer, "SO_SNDBUF")
+
+
+    def _set(self, sock, level, option, value, name):
+        if option is None:
+            return  # Not on this platform
+        try:
+            sock.setsockopt(level, option, int(value))
+        except (socket.error, EnvironmentError), e:
+            log.debug("Could not set %s: %s" % (name, e))
+
+
+
+PROFILES = {
+    # Nagle's algorithm off; otherwise the system's defaults.
+    "default": SocketProfile(),
+    # Requests and responses go out as soon as they are written.
+    "latency": SocketProfile(noDelay=True, quickAck=True),
+    # Large buffers for fast, distant transfers.
+    "bulk": SocketProfile(noDelay=True, receiveBuffer=4*1024*1024,
+                          sendBuffer=1024*1024),
+    # Long-lived connections through NATs and firewalls that forget them.
+    "keepalive": SocketProfile(noDelay=True, keepAlive=True,
+                               keepAliveIdle=60, keepAliveInterval=15,
+                               keepAliveCount=4),
+    # The system's defaults, Nagle's algorithm included.
+    "system": SocketProfile(noDelay=None),
+    }
+
+
+
+def getTransportSocket(transport):
+    """The socket underlying transport, or None.
+
+    TLS transports' handles are OpenSSL Connections, which pass socket
+    options on to their sockets.
+    """
+    try:
+        return transport.getHandle()
+    except AttributeError:
+        return None
+
+
+
+__id__ = "$Id: $"[5:-2]
@@ -0,0 +1,378 @@
+"""Connection timeouts.
+
+Timeouts for many connections are kept on a single hashed timer wheel
+rather than with a DelayedCall per connection per phase.
+"""
+
+from bisect import bisect_left, insort
+from collections import deque
+from math import ceil, floor
+
+from pendrell import log
+
+
+
+class Timeouts(object):
+    """Timeouts, in seconds, for each phase of a request.
+
+    A phase whose timeout is None is not timed.
+
+    Attributes:
+        connect --  Establishing the TCP connection.
+        handshake --  Completing the TLS handshake.
+        firstByte --  Waiting for the first byte of a response once its
+                      request has been sent.
+        idle --  Waiting between reads while a response is being received.
+        total --  Sending a request and receiving its entire response.
+    """
+
+    phases = ("connect", "handshake", "firstByte", "idle", "total")
+
+    def __init__(self, connect=None, handshake=None, firstByte=None,
+                 idle=None, total=None):
+        self.connect = connect
+        self.handshake = handshake
+        self.firstByte = firstByte
+        self.idle = idle
+        self.total = total
+
+
+    def __repr__(self):
+        phases = ", ".join("%s=%r" % (p, getattr(self, p))
+                for p in self.phases if getattr(self, p) is not None)
+        return "<%s: %s>" % (self.__class__.__name__, phases)
+
+
+    @classmethod
+    def fromValue(klass, timeout):
+        """Build Timeouts from a Timeouts, a dict of phases, a number, or
+        "adaptive".
+
+        A single number bounds connecting and each wait for the server, but
+        not the lifetime of a connection.
+        """
+        if timeout is None:
+            return klass()
+        elif isinstance(timeout, Timeouts):
+            return timeout
+        elif isinstance(timeout, dict):
+            return klass(**timeout)
+        elif timeout == "adaptive":
+            return AdaptiveTimeouts()
+        else:
+            return klass(connect=timeout, handshake=timeout,
+                         firstByte=timeout, idle=timeout)
+
+
+    def forOrigin(self, origin):
+        """The Timeouts to use for requests to origin."""
+        return self
+
+
+    def totalFor(self, request):
+        """The total timeout for request."""
+        return self.total
+
+
+    def recordFirstByte(self, seconds):
+        """Observe the time a response took to begin."""
+
+
+    def recordReadGap(self, seconds):
+        """Observe the time between two reads of a response."""
+
+
+    def recordTransfer(self, size, seconds):
+        """Observe the time a response body of size bytes took to arrive."""
+
+
+
+class _Samples(object):
+    """The most recent observations, also kept sorted for quantiles."""
+
+    def __init__(self, size):
+        self.size = size
+        self._recent = deque()
+        self._sorted = list()
+
+
+    def __len__(self):
+        return len(self._recent)
+
+
+    def add(self, value):
+        if len(self._recent) == self.size:
+            del self._sorted[bisect_left(self._sorted, self._recent.popleft())]
+        self._recent.append(value)
+        insort(self._sorted, value)
+
+
+    def quantile(self, quantile):
+        ordered = self._sorted
+        return ordered[min(int(quantile * len(ordered)), len(ordered) - 1)]
+
+
+
+class AdaptiveTimeouts(Timeouts):
+    """Timeouts learned from the latency of one origin.
+
+    The firstByte timeout is the given quantile of recent times to first
+    byte, times multiplier, and the idle timeout likewise of recent gaps
+    between reads.  Both are bounded by floor and ceiling; until minSamples
+    have been observed, ceiling applies.  A request's total timeout adds the
+    time to transfer its expected size at the same quantile of recent
+    transfer rates (times multiplier); it is at least floor, and at most
+    totalCeiling.
+
+    An instance is a template: forOrigin() gives each origin its own
+    estimates.
+
+    Keyword Arguments:
+        quantile --  [default: 0.95]
+        multiplier --  [default: 2.0]
+        floor --  Seconds [default: 1.0]
+        ceiling --  Seconds [default: 60.0]
+        totalCeiling --  Seconds, or None for no limit [default: None]
+        sampleSize --  Number of recent observations kept [default: 64]
+        minSamples --  [default: 5]
+        connect, handshake --  Fixed timeouts, as for Timeouts.
+    """
+
+    def __init__(self, quantile=0.95, multiplier=2.0, floor=1.0, ceiling=60.0,
+                 sampleSize=64, minSamples=5, connect=None, handshake=None,
+                 totalCeiling=None):
+        self.quantile = quantile
+        self.multiplier = multiplier
+        self.floor = floor
+        self.ceiling = ceiling
+        self.totalCeiling = totalCeiling
+        self.sampleSize = sampleSize
+        self.minSamples = minSamples
+
+        Timeouts.__init__(self, connect=connect, handshake=handshake,
+                firstByte=ceiling, idle=ceiling)
+
+        self.origin = None
+        self._firstByteTimes = _Samples(sampleSize)
+        self._readGaps = _Samples(sampleSize)
+        self._transferRates = _Samples(sampleSize)  # Bytes per second
+
+
+    def forOrigin(self, origin):
+        if self.origin is not None:
+            return self
+        timeouts = self.__class__(
+                quantile = self.quantile,
+                multiplier = self.multiplier,
+                floor = self.floor,
+                ceiling = self.ceiling,
+                sampleSize = self.sampleSize,
+                minSamples = self.minSamples,
+                connect = self.connect,
+                handshake = self.handshake,
+                totalCeiling = self.totalCeiling)
+        timeouts.origin = origin
+        return timeouts
+
+
+    def _bound(self, seconds):
+        return min(max(seconds, self.floor), self.ceiling)
+
+
+    def recordFirstByte(self, seconds):
+        self._firstByteTimes.add(seconds)
+        if len(self._firstByteTimes) >= self.minSamples:
+            wait = self._firstByteTimes.quantile(self.quantile)
+            self.firstByte = self._bound(wait * self.multiplier)
+
+
+    def recordReadGap(self, seconds):
+        self._readGaps.add(seconds)
+        if len(self._readGaps) >= self.minSamples:
+            gap = self._readGaps.quantile(self.quantile)
+            self.idle = self._bound(gap * self.multiplier)
+
+
+    def recordTransfer(self, size, seconds):
+        if size > 0 and seconds > 0:
+            self._transferRates.add(size / float(seconds))
+
+
+    def totalFor(self, request):
+        """Bounds requests of a known expected size once rates are known."""
+        if (request.expectedSize <= 0
+                or len(self._firstByteTimes) < self.minSamples
+                or len(self._transferRates) < self.minSamples):
+            return None
+
+        wait = self._firstByteTimes.quantile(self.quantile)
+        # Slow transfers are in the low tail.
+        rate = self._transferRates.quantile(1 - self.quantile)
+        total = max((wait + request.expectedSize / rate) * self.multiplier,
+                    self.floor)
+        if self.totalCeiling is not None:
+            total = min(total, self.totalCeiling)
+        return total
+
+
+
+class Timer(object):
+    """A call scheduled on a TimerWheel."""
+
+    _count = 0
+
+    def __init__(self, wheel, deadline, f, args, kw):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.seq = Timer._count = Timer._count + 1  # Orders equal deadlines
+        self.f, self.args, self.kw = f, args, kw
+        self._tick = None  # The tick of the slot holding this timer.
+
+
+    def __repr__(self):
+        return "<%s: %r at %.3f>" % (self.__class__.__name__,
+                self.f, self.deadline)
+
+
+    def active(self):
+        return self._tick is not None
+
+
+    def cancel(self):
+        self.wheel._remove(self)
+
+
+    def reset(self, delay):
+        """Reschedule the timer delay seconds from now.
+
+        Postponing a timer only updates its deadline; it is moved to a later
+        slot when its current slot comes due.
+        """
+        self.deadline = self.wheel.seconds() + delay
+        if (self._tick is None
+                or self.wheel._tickFor(self.deadline) < self._tick):
+            self.wheel._remove(self)
+            self.wheel._insert(self)
+
+
+
+class TimerWheel(object):
+    """Schedules coarse-grained timers in a ring of slots.
+
+    Timers are hashed into slots by the tick in which they expire.  A single
+    DelayedCall advances the wheel every resolution seconds, and only while
+    timers are scheduled.
+
+    Keyword Arguments:
+        resolution --  Seconds per tick [default: 0.1]
+        slots --  Number of slots in the ring [default: 512]
+        clock --  An IReactorTime provider [default: reactor]
+    """
+
+    def __init__(self, resolution=0.1, slots=512, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.resolution = resolution
+        self.clock = clock
+
+        self._slots = [set() for _ in xrange(slots)]
+        self._count = 0
+        self._tick = self._currentTick()  # Last tick processed
+        self._call = None
+
+
+    def __len__(self):
+        return self._count
+
+
+    def seconds(self):
+        return self.clock.seconds()
+
+
+    def schedule(self, delay, f, *args, **kw):
+        """Call f(*args, **kw) in about delay seconds.  Returns a Timer."""
+        timer = Timer(self, self.seconds() + delay, f, args, kw)
+        self._insert(timer)
+        return timer
+
+
+    # Tolerates float error in tick arithmetic, e.g. 4.3 / 0.1 < 43.
+    _epsilon = 1e-6
+
+    def _tickFor(self, when):
+        return int(ceil(when / self.resolution - self._epsilon))
+
+
+    def _currentTick(self):
+        return int(floor(self.seconds() / self.resolution + self._epsilon))
+
+
+    def _insert(self, timer):
+        if self._call is None:
+            # Ticks are not processed while the wheel is stopped.
+            self._tick = self._currentTick()
+
+        timer._tick = max(self._tickFor(timer.deadline), self._tick + 1)
+        self._slots[timer._tick % len(self._slots)].add(timer)
+        self._count += 1
+
+        if self._call is None:
+            self._call = self.clock.callLater(self.resolution, self._advance)
+
+
+    def _remove(self, timer):
+        if timer._tick is not None:
+            self._slots[timer._tick % len(self._slots)].discard(timer)
+            timer._tick = None
+            self._count -= 1
+
+            if self._count == 0 and self._call is not None:
+                self._call.cancel()
+                self._call = None
+
+
+    def _advance(self):
+        self._call = None
+        target = self._currentTick()
+
+        expired = list()
+        first = self._tick + 1
+        last = min(target, self._tick + len(self._slots))
+        for tick in xrange(first, last + 1):
+            slot = self._slots[tick % len(self._slots)]
+            for timer in list(slot):
+                if self._tickFor(timer.deadline) <= target:
+                    expired.append(timer)
+                    self._remove(timer)
+
+                elif timer._tick <= target:
+                    # Postponed since it was scheduled.
+                    self._remove(timer)
+                    self._insert(timer)
+        self._tick = target
+
+        expired.sort(key=lambda t: (t.deadline, t.seq))
+        for timer in expired:
+            try:
+                timer.f(*timer.args, **timer.kw)
+            except:
+                log.err()
+
+        if self._count and self._call is None:
+            delay = (self._tick + 1) * self.resolution - self.seconds()
+            self._call = self.clock.callLater(max(delay, 0), self._advance)
+
+
+
+_timerWheel = None
+
+def getTimerWheel():
+    """The TimerWheel shared by all connections."""
+    global _timerWheel
+    if _timerWheel is None:
+        _timerWheel = TimerWheel()
+    return _timerWheel
+
+
+
+__id__ = "$Id: $"[5:-2]
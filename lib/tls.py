@@ -0,0 +1,259 @@
+"""Client TLS contexts.
+
+Each origin's connections share one SSL context, so that a new connection to
+a known origin resumes the TLS session of an earlier one (by session ID or
+session ticket) with an abbreviated handshake.
+"""
+
+import socket
+from collections import deque
+from weakref import WeakKeyDictionary
+
+from OpenSSL import SSL
+
+from pendrell import log
+from pendrell.util import addressFamily, isAddress
+
+
+
+class ClientContextFactory(object):
+    """Builds the TLS context for connections to one origin.
+
+    Connections are prepared with prepareConnection() before they handshake:
+    the origin's host name is sent for SNI, and the session of the last
+    connection is offered for resumption.  Once the handshake completes, the
+    connection's protocol (its app data) is told via handshakeDone().
+
+    Keyword Arguments:
+        verify --  Verify the server's certificate chain and that it was
+                   issued for host. [default: True]
+        caCertsFile --  A PEM file of trusted CA certificates.  [default: the
+                        default OpenSSL trust store]
+        alpnProtocols --  Protocols offered with ALPN. [default: None]
+        sampleSize --  Number of recent handshake times kept [default: 64]
+
+    Attributes:
+        handshakes --  Number of completed handshakes.
+        resumedHandshakes --  Number of those known to have resumed a
+                              session.
+        handshakeTimes --  Recent handshake durations, in seconds.
+    """
+
+    isClient = 1
+    method = SSL.SSLv23_METHOD
+
+    def __init__(self, host, verify=True, caCertsFile=None,
+                 alpnProtocols=None, sampleSize=64):
+        self.host = host
+        self.verify = verify
+        self.caCertsFile = caCertsFile
+        self.alpnProtocols = alpnProtocols
+
+        self.handshakes = 0
+        self.resumedHandshakes = 0
+        self.handshakeTimes = deque(maxlen=sampleSize)
+
+        self._context = None
+        self._session = None
+        self._handshaken = WeakKeyDictionary()  # Connections past handshake
+
+
+    def __repr__(self):
+        return "<%s: %s verify=%r>" % (self.__class__.__name__,
+                self.host, self.verify)
+
+
+    def getContext(self):
+        if self._context is None:
+            self._context = self._buildContext()
+        return self._context
+
+
+    def _buildContext(self):
+        ctx = SSL.Context(self.method)
+        ctx.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+        ctx.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        ctx.set_info_callback(self._infoCallback)
+
+        if self.verify:
+            if self.caCertsFile:
+                ctx.load_verify_locations(self.caCertsFile)
+            else:
+                ctx.set_default_verify_paths()
+            ctx.set_verify(SSL.VERIFY_PEER, self._verifyCallback)
+
+        if self.alpnProtocols:
+            ctx.set_alpn_protos(self.alpnProtocols)
+        return ctx
+
+
+    def prepareConnection(self, connection):
+        """Set up connection before its handshake begins."""
+        if not isAddress(self.host):
+            connection.set_tlsext_host_name(self.host)
+
+        session = self.getSession()
+        if session is not None:
+            connection.set_session(session)
+
+
+    def getSession(self):
+        """The session of the last connection to complete a handshake."""
+        return self._session
+
+
+    def _infoCallback(self, connection, where, ret):
+        if where & SSL.SSL_CB_HANDSHAKE_DONE:
+            protocol = connection.get_app_data()
+            if protocol is not None:
+                protocol.handshakeDone()
+            self._recordHandshake(connection,
+                    getattr(protocol, "handshakeTime", None))
+        elif where & SSL.SSL_CB_EXIT and connection in self._handshaken:
+            # TLS 1.3 tickets arrive after the handshake.
+            self._session = connection.get_session()
+
+
+    def _recordHandshake(self, connection, seconds):
+        self._session = connection.get_session()
+        if connection in self._handshaken:
+            return  # Renegotiated
+        self._handshaken[connection] = True
+
+        self.handshakes += 1
+        if sessionReused(connection):
+            self.resumedHandshakes += 1
+        if seconds is not None:
+            self.handshakeTimes.append(seconds)
+
+
+    def _verifyCallback(self, connection, x509, errno, depth, ok):
+        if not ok:
+            log.debug("%r: certificate verification failed at depth %d: %d"
+                    % (self, depth, errno))
+            return False
+        if depth == 0 and not matchesHostname(x509, self.host):
+            log.debug("%r: certificate is for %r" % (self, certificateNames(
+                    x509)))
+            return False
+        return True
+
+
+
+class TLSContextCache(object):
+    """ClientContextFactories shared by the requesters of an Agent.
+
+    Contexts are kept per origin, verification settings, and ALPN
+    protocols.
+
+    Keyword Arguments:
+        verify --  [default: True]
+        caCertsFile --  [default: None]
+    """
+
+    contextFactoryClass = ClientContextFactory
+
+    def __init__(self, verify=True, caCertsFile=None):
+        self.verify = verify
+        self.caCertsFile = caCertsFile
+        self._contextFactories = dict()
+
+
+    def __len__(self):
+        return len(self._contextFactories)
+
+
+    def getContextFactory(self, host, port, alpnProtocols=None):
+        alpn = tuple(alpnProtocols or ())
+        key = (host, port, self.verify, self.caCertsFile, alpn)
+        contextFactory = self._contextFactories.get(key)
+        if contextFactory is None:
+            contextFactory = self.contextFactoryClass(host,
+                    verify = self.verify,
+                    caCertsFile = self.caCertsFile,
+                    alpnProtocols = list(alpn) or None)
+            self._contextFactories[key] = contextFactory
+        return contextFactory
+
+
+
+_tlsContextCache = None
+
+def getTLSContextCache():
+    """The TLSContextCache shared by requesters not given one."""
+    global _tlsContextCache
+    if _tlsContextCache is None:
+        _tlsContextCache = TLSContextCache()
+    return _tlsContextCache
+
+
+
+def sessionReused(connection):
+    """True if connection resumed a session, False if it did not, or None if
+    this pyOpenSSL cannot tell."""
+    # pyOpenSSL does not wrap SSL_session_reused(); use its private binding
+    # only while it is there.
+    reused = getattr(getattr(SSL, "_lib", None), "SSL_session_reused", None)
+    ssl = getattr(connection, "_ssl", None)
+    if reused is None or ssl is None:
+        return None
+    return bool(reused(ssl))
+
+
+
+def _packAddress(address):
+    try:
+        return socket.inet_pton(addressFamily(address), address)
+    except socket.error:
+        return None
+
+
+
+def certificateNames(x509):
+    """The DNS names and IP addresses a certificate was issued for.
+
+    Returns (dnsNames, addresses).  Without subjectAltName DNS entries, the
+    subject's common name is used.
+    """
+    dnsNames, addresses = list(), list()
+    for i in xrange(x509.get_extension_count()):
+        extension = x509.get_extension(i)
+        if extension.get_short_name() != "subjectAltName":
+            continue
+        for entry in str(extension).split(","):
+            kind, _, value = entry.strip().partition(":")
+            if kind == "DNS":
+                dnsNames.append(value.lower())
+            elif kind == "IP Address":
+                addresses.append(_packAddress(value))
+
+    if not dnsNames:
+        commonName = x509.get_subject().commonName
+        if commonName:
+            dnsNames.append(commonName.lower())
+    return dnsNames, addresses
+
+
+def matchesHostname(x509, host):
+    """True if the certificate was issued for host.
+
+    A wildcard matches a single, leftmost label.  Addresses only match IP
+    subjectAltName entries.
+    """
+    dnsNames, addresses = certificateNames(x509)
+    host = host.lower()
+    if isAddress(host):
+        return _packAddress(host) in addresses
+
+    for name in dnsNames:
+        if name == host:
+            return True
+        if name.startswith("*.") and "." in host:
+            label, domain = host.split(".", 1)
+            if label and domain == name[2:]:
+                return True
+    return False
+
+
+
+__id__ = "$Id: $"[5:-2]
@@ -1,4 +1,4 @@
-import os
+import os, socket
 from base64 import b64encode
 
 from twisted.python import urlpath
@@ -15,6 +15,7 @@ class URLPath(urlpath.URLPath):
             ftp = 21,
             file = None,  # No ports for local paths
         )
+    DEFAULT_PORTS["http+unix"] = 0  # The host names a socket
 
 
     def __init__(self, scheme=None, netloc=None, path=None,
@@ -90,3 +91,16 @@ def normalizeBytes(size, suffix):
 def b64random(length):
     return b64encode(os.urandom(length))[:length]
 
+
+def addressFamily(host):
+    return socket.AF_INET6 if ":" in host else socket.AF_INET
+
+
+def isAddress(host):
+    """True if host is an IPv4 or IPv6 address."""
+    try:
+        socket.inet_pton(addressFamily(host), host)
+    except socket.error:
+        return False
+    return True
+